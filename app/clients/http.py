@@ -0,0 +1,117 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from app import config
+from app.utils import telemetria
+
+class _AdapterContado(HTTPAdapter):
+    """
+    HTTPAdapter que cuenta las conexiones que abre (cada connect() de urllib3, también
+    las reconexiones de un keep-alive que se cayó): los demás requests reusaron una del pool.
+    """
+    def __init__(self, *args, **kwargs):
+        self.conexiones = 0
+        self._lock_conexiones = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        def contada(clase_pool):
+            class Conexion(clase_pool.ConnectionCls):
+                def connect(self):
+                    super().connect()
+                    with adapter._lock_conexiones:
+                        adapter.conexiones += 1
+            return type(clase_pool.__name__, (clase_pool,), {"ConnectionCls": Conexion})
+
+        clases = self.poolmanager.pool_classes_by_scheme
+        self.poolmanager.pool_classes_by_scheme = {esquema: contada(clase) for esquema, clase in clases.items()}
+
+class UpstreamSession:
+    """
+    Sesión HTTP compartida (keep-alive) para un upstream: un requests.Session con su
+    pool de conexiones acotado y timeouts propios. Es segura entre threads para el uso
+    que le damos (requests sin cookies de sesión): el pool de urllib3 tiene su propio lock.
+    """
+    def __init__(self, nombre: str, timeout, pool_maxsize: int):
+        self.nombre = nombre
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.pool_maxsize = pool_maxsize
+        adapter = _AdapterContado(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._adapter = adapter
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errores = 0
+        self.segundos = 0.0
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        t0 = time.perf_counter()
+        try:
+            resp = self.session.request(method, url, **kwargs)
+            if not kwargs.get("stream"):
+                # Cuerpo ya leído: cuenta para la etapa del sync que lo pidió (los streams los cuenta quien los lee)
+                telemetria.sumar(bytes=len(resp.content))
+            return resp
+        except requests.RequestException:
+            with self._lock:
+                self.errores += 1
+            raise
+        finally:
+            with self._lock:
+                self.requests += 1
+                self.segundos += time.perf_counter() - t0
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> dict:
+        with self._adapter._lock_conexiones:
+            abiertas = self._adapter.conexiones
+        with self._lock:
+            total = self.requests
+            # Los requests que fallaron pueden no haber llegado a usar una conexión
+            exitosos = total - self.errores
+            return {
+                "requests": total,
+                "errores": self.errores,
+                "conexiones_abiertas": abiertas,
+                "pool_maxsize": self.pool_maxsize,
+                "reuso": round(max(0.0, 1 - abiertas / exitosos), 4) if exitosos else 0.0,
+                "latencia_media_ms": round(self.segundos / total * 1000, 1) if total else 0.0,
+                "timeout": self.timeout,
+            }
+
+# Timeouts (connect, read) y tamaño de pool por upstream
+_UPSTREAMS = {
+    "ispcube": lambda: ((config.HTTP_CONNECT_TIMEOUT, config.ISPCUBE_TIMEOUT), config.ISPCUBE_POOL_SIZE),
+    "smartolt": lambda: ((config.HTTP_CONNECT_TIMEOUT, config.SMARTOLT_API_TIMEOUT), config.SMARTOLT_POOL_SIZE),
+    "graylog": lambda: ((config.HTTP_CONNECT_TIMEOUT, config.ORACULO_GRAYLOG_TIMEOUT_SEC), config.ORACULO_GRAYLOG_POOL_SIZE),
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(nombre: str) -> UpstreamSession:
+    """Sesión compartida del upstream (se crea la primera vez que se pide)."""
+    with _sessions_lock:
+        sesion = _sessions.get(nombre)
+        if sesion is None:
+            timeout, pool_maxsize = _UPSTREAMS[nombre]()
+            sesion = UpstreamSession(nombre, timeout, pool_maxsize)
+            _sessions[nombre] = sesion
+        return sesion
+
+def stats() -> dict:
+    with _sessions_lock:
+        sesiones = dict(_sessions)
+    return {nombre: s.stats() for nombre, s in sesiones.items()}
@@ -1,7 +1,12 @@
-import requests
 import sys
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from app import config
 from app.config import logger
+from app.clients.http import get_session
+from app.utils import telemetria
 
 ISPCUBE_BASEURL = config.ISPCUBE_BASEURL
 ISPCUBE_APIKEY = config.ISPCUBE_APIKEY
@@ -10,6 +15,7 @@ ISPCUBE_PASSWORD = config.ISPCUBE_PASSWORD
 ISPCUBE_CLIENTID = config.ISPCUBE_CLIENTID
 
 _token_cache = None
+_http = get_session("ispcube")
 
 def _obtener_token():
     url = f"{ISPCUBE_BASEURL}/sanctum/token"
@@ -21,7 +27,7 @@ def _obtener_token():
         "client-id": ISPCUBE_CLIENTID,
         "login-type": "api"
     }
-    resp = requests.post(url, json=payload, headers=headers)
+    resp = _http.post(url, json=payload, headers=headers)
     resp.raise_for_status()
     return resp.json()["token"]
 
@@ -46,13 +52,14 @@ def _request(method, url, **kwargs):
     headers = kwargs.pop("headers", {})
     headers.update(_headers(token))
     
-    resp = requests.request(method, url, headers=headers, **kwargs)
+    resp = _http.request(method, url, headers=headers, **kwargs)
     
     if resp.status_code == 401:
         logger.warning("Token expirado, renovando...")
+        telemetria.sumar(reintentos=1)
         token = _get_token(force_refresh=True)
         headers.update(_headers(token))
-        resp = requests.request(method, url, headers=headers, **kwargs)
+        resp = _http.request(method, url, headers=headers, **kwargs)
     
     resp.raise_for_status()
     return resp
@@ -119,37 +126,128 @@ def obtener_planes():
         })
     return resultado
 
-def obtener_clientes():
+def _bajar_pagina_clientes(url, offset, limit, reintentos, medicion=None, params=None):
+    """Baja una página de clientes; reintenta solo esa página con backoff antes de fallar."""
+    # Corre en un worker: bytes y reintentos se suman a la medición de la etapa que pidió la página
+    with telemetria.usar(medicion):
+        for intento in range(reintentos + 1):
+            try:
+                query = {**(params or {}), "limit": limit, "offset": offset}
+                batch = _request("GET", url, params=query, timeout=config.ISPCUBE_TIMEOUT).json()
+                if not isinstance(batch, list):
+                    raise ValueError(f"respuesta inesperada ({type(batch).__name__})")
+                return offset, batch
+            except Exception as e:
+                if intento == reintentos:
+                    raise RuntimeError(f"página offset={offset} falló tras {reintentos + 1} intentos: {e}") from e
+                espera = 2 ** intento
+                logger.warning(f"[ISPCube] Página offset={offset} falló ({e}), reintento en {espera}s...")
+                telemetria.sumar(reintentos=1)
+                time.sleep(espera)
+
+def iterar_paginas_clientes(limit=None, en_vuelo=None, reintentos=None):
     """
-    Devuelve lista completa de clientes usando PAGINACIÓN (esto sí funciona bien).
+    Generador de páginas de /customers/customers_list, en el orden en que llegan.
+    Mantiene a lo sumo `en_vuelo` páginas pedidas a la vez: cada página completa
+    libera el lugar para la siguiente, así la memoria es de unas pocas páginas y no
+    de toda la base de clientes. Una página que no baja después de sus reintentos
+    corta la descarga con excepción (nunca se devuelve una lista incompleta en silencio).
+    """
+    for _, batch in iterar_paginas_clientes_offset(limit, en_vuelo, reintentos):
+        if batch:
+            yield batch
+
+def iterar_paginas_clientes_offset(limit=None, en_vuelo=None, reintentos=None, saltear=()):
+    """
+    Igual que iterar_paginas_clientes pero devuelve (offset, página), también las vacías,
+    y no pide los offsets de `saltear` (páginas ya guardadas por una corrida cortada).
     """
     url = f"{ISPCUBE_BASEURL}/customers/customers_list"
-    all_customers = []
-    LIMIT = 500
+    limit = limit or config.ISPCUBE_PAGE_SIZE
+    en_vuelo = max(1, en_vuelo or config.ISPCUBE_MAX_IN_FLIGHT)
+    reintentos = config.ISPCUBE_PAGE_RETRIES if reintentos is None else reintentos
+    saltear = set(saltear)
+    medicion = telemetria.actual()
+
+    with ThreadPoolExecutor(max_workers=en_vuelo, thread_name_prefix="ispcube-clientes") as pool:
+        siguiente = 0
+        fin = None  # offset de la primera página incompleta: no se piden páginas después
+        pendientes = set()
+        try:
+            while True:
+                while len(pendientes) < en_vuelo and (fin is None or siguiente < fin):
+                    if siguiente not in saltear:
+                        pendientes.add(pool.submit(_bajar_pagina_clientes, url, siguiente, limit, reintentos, medicion))
+                    siguiente += limit
+                if not pendientes:
+                    return
+                listos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+                for futuro in listos:
+                    offset, batch = futuro.result()
+                    if len(batch) < limit:
+                        fin = offset if fin is None else min(fin, offset)
+                    yield offset, batch
+        finally:
+            for futuro in pendientes:
+                futuro.cancel()
+
+def _fecha(valor):
+    """Fecha de ISPCube (ISO, con o sin zona) -> datetime naive en UTC si trae zona; None si no se entiende."""
+    if not valor:
+        return None
+    try:
+        fecha = datetime.fromisoformat(str(valor).strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if fecha.tzinfo is not None:
+        fecha = fecha.astimezone(timezone.utc).replace(tzinfo=None)
+    return fecha
+
+def marca_actualizacion(cliente: dict):
+    """Última modificación del cliente: la mayor entre updated_at y deleted_at (None si no trae ninguna)."""
+    fechas = [f for f in (_fecha(cliente.get("updated_at")), _fecha(cliente.get("deleted_at"))) if f]
+    return max(fechas) if fechas else None
+
+def iterar_clientes_modificados(desde: datetime, limit=None, reintentos=None):
+    """
+    Generador de páginas con los clientes modificados (o dados de baja) desde `desde`.
+    customers_list no documenta filtro ni orden por fecha, así que se usan si están
+    configurados: ISPCUBE_DELTA_FILTER_PARAM (filtro del lado del servidor) y/o
+    ISPCUBE_DELTA_ORDER_PARAMS (orden por updated_at descendente: se corta en la primera
+    página sin novedades). Sin ninguno de los dos se recorren todas las páginas, pero
+    se devuelven igual solo los clientes nuevos. Las páginas se piden de a una: el corte
+    depende de lo que trajo la anterior.
+    """
+    url = f"{ISPCUBE_BASEURL}/customers/customers_list"
+    limit = limit or config.ISPCUBE_PAGE_SIZE
+    reintentos = config.ISPCUBE_PAGE_RETRIES if reintentos is None else reintentos
+    params = dict(parse_qsl(config.ISPCUBE_DELTA_ORDER_PARAMS))
+    if config.ISPCUBE_DELTA_FILTER_PARAM:
+        params[config.ISPCUBE_DELTA_FILTER_PARAM] = desde.strftime("%Y-%m-%d %H:%M:%S")
+    ordenado = bool(config.ISPCUBE_DELTA_ORDER_PARAMS)
+    if not params:
+        logger.warning("[ISPCube] Delta de clientes sin filtro ni orden configurado: se recorren todas las páginas.")
+
     offset = 0
-    
-    print(f"     ↳ [Paginación] Iniciando descarga de clientes...")
-    
     while True:
-        try:
-            params = {"limit": LIMIT, "offset": offset}
-            resp = _request("GET", url, params=params)
-            batch = resp.json()
-            
-            if not isinstance(batch, list) or len(batch) == 0:
-                break 
-            
-            all_customers.extend(batch)
-            sys.stdout.write(f"\r     ↳ [Paginación] Bajados: {len(all_customers)} clientes...")
-            sys.stdout.flush()
-            
-            if len(batch) < LIMIT:
-                break
-            
-            offset += LIMIT
-        except Exception as e:
-            print(f"\n❌ Error bajando bloque offset={offset}: {e}")
-            break
+        _, batch = _bajar_pagina_clientes(url, offset, limit, reintentos, telemetria.actual(), params)
+        nuevos = [c for c in batch if (marca_actualizacion(c) or datetime.min) >= desde]
+        if nuevos:
+            yield nuevos
+        if len(batch) < limit or (ordenado and not nuevos):
+            return
+        offset += limit
 
+def obtener_clientes():
+    """
+    Devuelve lista completa de clientes usando PAGINACIÓN (esto sí funciona bien).
+    El sync usa iterar_paginas_clientes_offset directamente para no juntar todo en memoria.
+    """
+    all_customers = []
+    print(f"     ↳ [Paginación] Iniciando descarga de clientes...")
+    for batch in iterar_paginas_clientes():
+        all_customers.extend(batch)
+        sys.stdout.write(f"\r     ↳ [Paginación] Bajados: {len(all_customers)} clientes...")
+        sys.stdout.flush()
     print(f" ✅ Total: {len(all_customers)}")
-    return all_customers
\ No newline at end of file
+    return all_customers
@@ -1,7 +1,10 @@
+import threading
 import time
+from contextlib import contextmanager
 from app.config import logger
 from app.utils.safe_call import safe_call
 from routeros_api import RouterOsApiPool
+from routeros_api.exceptions import RouterOsApiCommunicationError, RouterOsApiConnectionError, RouterOsApiError
 from app import config
 
 # Credenciales comunes para todos los Mikrotik
@@ -12,48 +15,253 @@ MIKROTIK_IP   = config.MK_HOST
 
 #Nota para producción: borrar =MIKROTIK_IP y pasar IP como parámetro en cada función
 
-def _connect(router_ip, port, username=MIKROTIK_USER, password=MIKROTIK_PASS):
-    try:
-        pool = RouterOsApiPool(
-            router_ip,
-            username=username, # type: ignore
-            password=password, # type: ignore
-            port=port,              
-            plaintext_login=True
-        )
-        return pool, pool.get_api()
-    except Exception as e:
-        logger.error(f"Error de conexión al router {router_ip}: {e}")
-        return {"error": str(e)}
+# Campos de /ppp/secret que usa el sync (el password no se lee)
+SECRET_PROPLIST = ("name", "profile", "service", "last-caller-id", "comment", "last-logged-out")
+# Campos de /ppp/active del diagnóstico: los mismos en vivo y en la foto de toda la flota
+ACTIVE_PROPLIST = (
+    "name", "service", "caller-id", "address", "uptime", "encoding", "session-id",
+    "limit-bytes-in", "limit-bytes-out", "radius",
+)
+
+def _connect(router_ip, port, username=MIKROTIK_USER, password=MIKROTIK_PASS,
+             connect_timeout=config.MK_CONNECT_TIMEOUT, read_timeout=config.MK_READ_TIMEOUT):
+    """Abre y autentica una conexión nueva (la usa el pool; lanza excepción si falla)."""
+    pool = RouterOsApiPool(
+        router_ip,
+        username=username, # type: ignore
+        password=password, # type: ignore
+        port=port,
+        plaintext_login=True
+    )
+    # socket_timeout se usa al abrir el socket (connect); después se pasa al de lectura
+    pool.socket_timeout = connect_timeout
+    api = pool.get_api()
+    pool.set_timeout(read_timeout)
+    return pool, api
+
+# ------------------ POOL DE SESIONES ------------------
+class _Sesion:
+    """Conexión autenticada a un router, usada por un solo thread a la vez."""
+    def __init__(self, pool, api):
+        self.pool = pool
+        self.api = api
+        self.ultimo_uso = time.monotonic()
+
+    def cerrar(self):
+        try:
+            self.pool.disconnect()
+        except Exception:
+            pass
+
+class RouterPool:
+    """
+    Sesiones RouterOS API ya logueadas contra un router (ip, puerto). Cada uso toma una
+    sesión ociosa (o abre una nueva, hasta MK_POOL_MAX_PER_ROUTER) y la devuelve al
+    terminar; la que falló por conexión se cierra y no vuelve al pool.
+    """
+    def __init__(self, router_ip: str, port: int, max_sesiones: int):
+        self.router_ip = router_ip
+        self.port = port
+        self.max_sesiones = max(1, max_sesiones)
+        self._ociosas = []
+        self._abiertas = 0
+        self._cond = threading.Condition()
+        self.logins = 0
+        self.reusos = 0
+        self.descartadas = 0
+
+    def _tomar(self, connect_timeout) -> _Sesion:
+        limite = time.monotonic() + config.MK_POOL_WAIT_SEC
+        with self._cond:
+            while True:
+                if self._ociosas:
+                    sesion = self._ociosas.pop()
+                    break
+                if self._abiertas < self.max_sesiones:
+                    self._abiertas += 1
+                    sesion = None
+                    break
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    raise TimeoutError(f"sin sesiones libres para {self.router_ip} ({self.max_sesiones} en uso)")
+                self._cond.wait(restante)
+
+        if sesion is not None and time.monotonic() - sesion.ultimo_uso > config.MK_POOL_CHECK_SEC:
+            # Ociosa hace rato: el router o un firewall pudo cerrar el socket sin avisar
+            try:
+                sesion.api.get_resource("/system/identity").get()
+            except Exception:
+                self._descartar(sesion)
+                return self._tomar(connect_timeout)
+        if sesion is not None:
+            with self._cond:
+                self.reusos += 1
+            return sesion
+
+        try:
+            pool, api = _connect(self.router_ip, self.port, connect_timeout=connect_timeout)
+        except Exception:
+            self._liberar_lugar()
+            raise
+        with self._cond:
+            self.logins += 1
+        return _Sesion(pool, api)
+
+    def _devolver(self, sesion: _Sesion):
+        sesion.ultimo_uso = time.monotonic()
+        with self._cond:
+            self._ociosas.append(sesion)
+            self._cond.notify()
+
+    def _descartar(self, sesion: _Sesion):
+        sesion.cerrar()
+        with self._cond:
+            self.descartadas += 1
+        self._liberar_lugar()
+
+    def _liberar_lugar(self):
+        with self._cond:
+            self._abiertas -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def sesion(self, read_timeout=config.MK_READ_TIMEOUT, connect_timeout=config.MK_CONNECT_TIMEOUT):
+        sesion = self._tomar(connect_timeout)
+        try:
+            sesion.pool.set_timeout(read_timeout)
+            yield sesion.api
+        except RouterOsApiCommunicationError:
+            # Error del comando (!trap): la conexión sigue sincronizada y se puede reusar
+            self._devolver(sesion)
+            raise
+        except Exception as e:
+            # Socket caído, timeout a mitad de respuesta, etc.: no se sabe en qué quedó el stream.
+            # Un error del que usa la sesión (ej. secret no encontrado) no la invalida.
+            if isinstance(e, (OSError, RouterOsApiError)) or not sesion.pool.connected:
+                self._descartar(sesion)
+            else:
+                self._devolver(sesion)
+            raise
+        except BaseException:
+            self._descartar(sesion)
+            raise
+        else:
+            self._devolver(sesion)
+
+    def cerrar_ociosas(self, mas_de: float = 0.0) -> int:
+        """Cierra las sesiones sin usar hace más de `mas_de` segundos."""
+        ahora = time.monotonic()
+        with self._cond:
+            viejas = [s for s in self._ociosas if ahora - s.ultimo_uso > mas_de]
+            self._ociosas = [s for s in self._ociosas if s not in viejas]
+            self._abiertas -= len(viejas)
+            self._cond.notify_all()
+        for s in viejas:
+            s.cerrar()
+        return len(viejas)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "abiertas": self._abiertas,
+                "ociosas": len(self._ociosas),
+                "max": self.max_sesiones,
+                "logins": self.logins,
+                "reusos": self.reusos,
+                "descartadas": self.descartadas,
+            }
+
+_pools = {}
+_pools_lock = threading.Lock()
+_limpieza = None
+
+def _pool(router_ip, port) -> RouterPool:
+    global _limpieza
+    clave = (router_ip, int(port or MIKROTIK_PORT))
+    with _pools_lock:
+        pool = _pools.get(clave)
+        if pool is None:
+            pool = RouterPool(clave[0], clave[1], config.MK_POOL_MAX_PER_ROUTER)
+            _pools[clave] = pool
+        if _limpieza is None:
+            _limpieza = threading.Thread(target=_cerrar_ociosas, name="mk-pool-idle", daemon=True)
+            _limpieza.start()
+        return pool
+
+def _cerrar_ociosas():
+    # Sesiones de routers que no se consultan hace MK_POOL_IDLE_SEC: se cierran (el router libera su API)
+    while True:
+        time.sleep(max(1.0, config.MK_POOL_IDLE_SEC / 4))
+        with _pools_lock:
+            pools = list(_pools.values())
+        for pool in pools:
+            cerradas = pool.cerrar_ociosas(config.MK_POOL_IDLE_SEC)
+            if cerradas:
+                logger.info(f"[MK] {cerradas} sesiones ociosas cerradas en {pool.router_ip}:{pool.port}")
+
+@contextmanager
+def sesion(router_ip, port, read_timeout=config.MK_READ_TIMEOUT, connect_timeout=config.MK_CONNECT_TIMEOUT):
+    """API de RouterOS autenticada, tomada del pool del router (ip, puerto) y devuelta al salir."""
+    pool = _pool(router_ip, port)
+    with pool.sesion(read_timeout, connect_timeout) as api:
+        yield api
+
+def _con_sesion(router_ip, port, fn, read_timeout=config.MK_READ_TIMEOUT, connect_timeout=config.MK_CONNECT_TIMEOUT):
+    """Corre fn(api) con una sesión del pool; ante un corte de conexión reintenta una vez (las lecturas son idempotentes)."""
+    for intento in range(2):
+        try:
+            with sesion(router_ip, port, read_timeout, connect_timeout) as api:
+                return fn(api)
+        except (RouterOsApiConnectionError, OSError) as e:
+            # Un timeout no se reintenta: el router está lento, no la sesión vieja
+            if intento == 1 or isinstance(e, TimeoutError):
+                raise
+            logger.warning(f"[MK] Sesión con {router_ip} cortada ({e}), reconectando...")
+
+def stats() -> dict:
+    with _pools_lock:
+        pools = dict(_pools)
+    return {f"{ip}:{port}": p.stats() for (ip, port), p in pools.items()}
+
+# ------------------ CONSULTAS ------------------
+def _buscar_secret(api, pppoe_user, proplist=None):
+    arguments = {".proplist": ",".join(proplist)} if proplist else {}
+    result = api.get_resource('/ppp/secret').call('print', arguments, {'name': pppoe_user})
+    if not result:
+        raise LookupError(f"Secret {pppoe_user} no encontrado")
+    return result[0]
 
 def obtener_secret(router_ip, pppoe_user, puerto): #MIKROTIK_IP, router_ip
     try:
-        pool, api = _connect(router_ip, puerto)
-        secrets = api.get_resource('/ppp/secret')
-        result = secrets.get(name=pppoe_user)
-        pool.disconnect()
-        if not result:
-            logger.error(f"Secret {pppoe_user} no encontrado en {router_ip}")
-        return result[0]
+        return _con_sesion(router_ip, puerto, lambda api: _buscar_secret(api, pppoe_user))
     except Exception as e:
         logger.error(f"Error al obtener secret {pppoe_user} en {router_ip}: {e}")
         return {"error": str(e)}
 
 # Obtener todos los secrets del router
-def get_all_secrets(router_ip, port):
+def get_all_secrets(router_ip, port, proplist=SECRET_PROPLIST,
+                    connect_timeout=config.MK_CONNECT_TIMEOUT, read_timeout=config.MK_READ_TIMEOUT):
     """
     Descarga la lista completa de secrets del router.
+    Con .proplist el router solo serializa los campos pedidos (sin passwords).
     """
+    arguments = {".proplist": ",".join(proplist)} if proplist else {}
     try:
-        pool, api = _connect(router_ip, port)
-        # Pedimos todos los secrets
-        secrets = api.get_resource('/ppp/secret').get()
-        pool.disconnect()
-        return secrets
+        return _con_sesion(router_ip, port, lambda api: api.get_resource('/ppp/secret').call('print', arguments),
+                           read_timeout=read_timeout, connect_timeout=connect_timeout)
     except Exception as e:
         logger.error(f"Error al obtener todos los secrets de {router_ip}: {e}")
         return []
 
+def get_ppp_active(router_ip, port, connect_timeout=config.MK_CONNECT_TIMEOUT, read_timeout=config.MK_READ_TIMEOUT):
+    """Sesiones PPP activas del router (campos de ACTIVE_PROPLIST); None si no respondió."""
+    try:
+        return _con_sesion(router_ip, port, lambda api: api.get_resource('/ppp/active').call('print', {'.proplist': ','.join(ACTIVE_PROPLIST)}),
+                           read_timeout=read_timeout, connect_timeout=connect_timeout)
+    except Exception as e:
+        logger.error(f"Error al obtener las sesiones activas de {router_ip}: {e}")
+        return None
+
 # def crear_secret(router_ip, datos_secret):
 #     pool, api = _connect(router_ip)
 #     secrets = api.get_resource('/ppp/secret')
@@ -113,24 +321,23 @@ def get_all_secrets(router_ip, port):
 #     return True
 
 def validar_pppoe(router_ip: str, pppoe_user: str, puerto: str) -> dict:
-    try:
-        pool, api = _connect(router_ip, puerto)
-        #pool, api = _connect(MIKROTIK_IP) #borrar para producción
-        activos = api.get_resource('/ppp/active')
-        result = activos.get(name=pppoe_user)
-        pool.disconnect()
-
+    def consultar(api):
+        result = api.get_resource('/ppp/active').call('print', {'.proplist': ','.join(ACTIVE_PROPLIST)}, {'name': pppoe_user})
         if result:
             logger.info(f"PPP user {pppoe_user} activo en {router_ip}")
             return {"active": True, **result[0]}
-        else:
-            logger.warning(f"PPP user {pppoe_user} NO activo en {router_ip}")
-            try:
-                #modificar aca
-                secret = obtener_secret(router_ip, pppoe_user, puerto)
-                return {"active": False, "secret": secret}
-            except Exception:
-                return {"active": False}
+        logger.warning(f"PPP user {pppoe_user} NO activo en {router_ip}")
+        # Misma sesión para el secret: no hace falta otro login
+        try:
+            return {"active": False, "secret": _buscar_secret(api, pppoe_user, SECRET_PROPLIST)}
+        except RouterOsApiCommunicationError as e:
+            return {"active": False, "secret": {"error": str(e)}}
+        except LookupError as e:
+            logger.error(f"{e} en {router_ip}")
+            return {"active": False, "secret": {"error": str(e)}}
+
+    try:
+        return _con_sesion(router_ip, puerto, consultar)
     except Exception as e:
         logger.error(f"Error al validar PPPoE en {router_ip}: {e}")
         return {"active": False, "error": str(e)}
@@ -156,20 +363,16 @@ def obtener_trafico_en_vivo(router_ip, pppoe_user, port):
     Usa el comando '/interface monitor-traffic' en modo 'once'.
     """
     try:
-        pool, api = _connect(router_ip, port)
-        
         # El nombre de la interfaz dinámica suele ser <pppoe-usuario>
         interface_name = f"<pppoe-{pppoe_user}>"
-        
+
         # Ejecutamos el monitor una sola vez (snapshot)
         # Esto devuelve una lista con un diccionario
-        stats = api.get_resource('/interface').call('monitor-traffic', {
+        stats = _con_sesion(router_ip, port, lambda api: api.get_resource('/interface').call('monitor-traffic', {
             'interface': interface_name,
             'once': 'true'
-        })
-        
-        pool.disconnect()
-        
+        }))
+
         if stats and len(stats) > 0:
             return {
                 "rx": stats[0].get("rx-bits-per-second", "0"), # Bajada (Download)
@@ -177,7 +380,33 @@ def obtener_trafico_en_vivo(router_ip, pppoe_user, port):
             }
         else:
             return {"error": "Interfaz no activa o no encontrada"}
-            
+
     except Exception as e:
         logger.error(f"Error tráfico en vivo {pppoe_user} ({router_ip}): {e}")
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+
+def obtener_trafico_varios(router_ip, pppoe_users, port):
+    """
+    Velocidad actual de varias interfaces <pppoe-usuario> del mismo router con un solo
+    monitor-traffic (interfaces separadas por coma): {usuario: {"rx", "tx"} o {"error"}}.
+    """
+    interfaces = {f"<pppoe-{u}>": u for u in pppoe_users}
+    try:
+        filas = _con_sesion(router_ip, port, lambda api: api.get_resource('/interface').call('monitor-traffic', {
+            'interface': ','.join(interfaces),
+            'once': 'true'
+        }))
+    except RouterOsApiCommunicationError:
+        # Una interfaz inexistente (usuario desconectado) hace fallar el comando entero: de a uno
+        return {u: obtener_trafico_en_vivo(router_ip, u, port) for u in pppoe_users}
+    except Exception as e:
+        logger.error(f"Error tráfico en vivo de {len(pppoe_users)} usuarios ({router_ip}): {e}")
+        return {u: {"error": str(e)} for u in pppoe_users}
+    # Una fila por interfaz, en el orden pedido (el router la identifica en name)
+    nombres = list(interfaces)
+    trafico = {
+        interfaces.get(fila.get("name", nombres[i] if i < len(nombres) else None)):
+            {"rx": fila.get("rx-bits-per-second", "0"), "tx": fila.get("tx-bits-per-second", "0")}
+        for i, fila in enumerate(filas)
+    }
+    return {u: trafico.get(u, {"error": "Interfaz no activa o no encontrada"}) for u in pppoe_users}
@@ -0,0 +1,433 @@
+"""
+Cliente RouterOS API nativo de asyncio (protocolo de la API sobre TCP, sin routeros_api).
+
+Mismas funciones y mismas respuestas que app/clients/mikrotik.py, pero como corrutinas:
+los endpoints de la API esperan al router sin ocupar un thread del threadpool. Por router
+hay UNA conexión autenticada y los comandos concurrentes viajan por ella con .tag, así
+miles de consultas a routers distintos corren en el mismo event loop.
+"""
+import asyncio
+import contextlib
+import hashlib
+import itertools
+import time
+from app import config
+from app.config import logger
+from app.clients import mikrotik
+from app.clients.mikrotik import ACTIVE_PROPLIST, MIKROTIK_PASS, MIKROTIK_PORT, MIKROTIK_USER, SECRET_PROPLIST
+
+
+class RouterOSTrap(Exception):
+    """!trap del router: el comando falló pero la conexión sigue sirviendo."""
+
+
+# ------------------ PROTOCOLO ------------------
+def _codificar_largo(n: int) -> bytes:
+    if n < 0x80:
+        return bytes([n])
+    if n < 0x4000:
+        return (n | 0x8000).to_bytes(2, "big")
+    if n < 0x200000:
+        return (n | 0xC00000).to_bytes(3, "big")
+    if n < 0x10000000:
+        return (n | 0xE0000000).to_bytes(4, "big")
+    return b"\xf0" + n.to_bytes(4, "big")
+
+def codificar(palabras) -> bytes:
+    """Oración de la API: cada palabra con su largo adelante y una palabra vacía al final."""
+    salida = bytearray()
+    for palabra in palabras:
+        datos = palabra.encode()
+        salida += _codificar_largo(len(datos)) + datos
+    return bytes(salida + b"\x00")
+
+async def _leer_largo(reader) -> int:
+    c = (await reader.readexactly(1))[0]
+    if c < 0x80:
+        return c
+    if c < 0xC0:
+        return ((c & 0x3F) << 8) | (await reader.readexactly(1))[0]
+    if c < 0xE0:
+        return ((c & 0x1F) << 16) | int.from_bytes(await reader.readexactly(2), "big")
+    if c < 0xF0:
+        return ((c & 0x0F) << 24) | int.from_bytes(await reader.readexactly(3), "big")
+    return int.from_bytes(await reader.readexactly(4), "big")
+
+async def leer_oracion(reader) -> list:
+    palabras = []
+    while True:
+        largo = await _leer_largo(reader)
+        if largo == 0:
+            return palabras
+        palabras.append((await reader.readexactly(largo)).decode(errors="replace"))
+
+def _atributos(palabras) -> dict:
+    """'=clave=valor' -> dict (como routeros_api: '.id' queda como 'id')."""
+    datos = {}
+    for palabra in palabras:
+        if palabra.startswith("="):
+            clave, _, valor = palabra[1:].partition("=")
+            datos[clave.lstrip(".") if clave == ".id" else clave] = valor
+    return datos
+
+
+# ------------------ CONEXIÓN ------------------
+class _Pedido:
+    def __init__(self, stream: bool):
+        self.filas = []
+        self.error = None
+        self.cola = asyncio.Queue() if stream else None
+        self.hecho = asyncio.get_running_loop().create_future()
+
+
+class Conexion:
+    """
+    Una conexión autenticada a un router. Un lector en segundo plano reparte cada
+    respuesta al comando que la pidió según su .tag; varios comandos pueden estar en
+    vuelo a la vez (hasta MK_ASYNC_MAX_PER_ROUTER).
+    """
+    def __init__(self, router_ip, port, reader, writer):
+        self.router_ip = router_ip
+        self.port = port
+        self._reader = reader
+        self._writer = writer
+        self._tags = itertools.count(1)
+        self._pedidos = {}
+        self._lugares = asyncio.Semaphore(config.MK_ASYNC_MAX_PER_ROUTER)
+        self._lector = None
+        self.loop = asyncio.get_running_loop()
+        self.ultimo_uso = time.monotonic()
+        self.cerrada = False
+
+    @classmethod
+    async def abrir(cls, router_ip, port, username=MIKROTIK_USER, password=MIKROTIK_PASS,
+                    connect_timeout=config.MK_CONNECT_TIMEOUT):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(router_ip, port), connect_timeout)
+        conexion = cls(router_ip, port, reader, writer)
+        try:
+            await asyncio.wait_for(conexion._login(username or "", password or ""), connect_timeout)
+        except BaseException:
+            conexion.cerrar()
+            raise
+        conexion._lector = asyncio.create_task(conexion._leer(), name=f"routeros-{router_ip}")
+        return conexion
+
+    async def _login(self, username, password):
+        # Antes de arrancar el lector: el login es la única conversación sin tag
+        self._writer.write(codificar(["/login", f"=name={username}", f"=password={password}"]))
+        await self._writer.drain()
+        respuesta = await self._respuesta_sin_tag()
+        reto = respuesta.get("ret")
+        if reto:
+            # RouterOS anterior a 6.43: login por desafío MD5
+            digest = hashlib.md5(b"\x00" + password.encode() + bytes.fromhex(reto)).hexdigest()
+            self._writer.write(codificar(["/login", f"=name={username}", f"=response=00{digest}"]))
+            await self._writer.drain()
+            await self._respuesta_sin_tag()
+
+    async def _respuesta_sin_tag(self) -> dict:
+        datos = {}
+        while True:
+            oracion = await leer_oracion(self._reader)
+            if not oracion:
+                continue
+            if oracion[0] in ("!trap", "!fatal"):
+                raise PermissionError(_atributos(oracion).get("message") or oracion[0])
+            datos.update(_atributos(oracion))
+            if oracion[0] == "!done":
+                return datos
+
+    async def _leer(self):
+        error = None
+        try:
+            while True:
+                oracion = await leer_oracion(self._reader)
+                if not oracion:
+                    continue
+                tipo = oracion[0]
+                tag = next((p[5:] for p in oracion if p.startswith(".tag=")), None)
+                if tipo == "!fatal":
+                    raise ConnectionError(f"!fatal del router: {_atributos(oracion).get('message', '')}")
+                pedido = self._pedidos.get(tag)
+                if pedido is None:
+                    continue
+                if tipo == "!re":
+                    fila = _atributos(oracion)
+                    if pedido.cola is not None:
+                        pedido.cola.put_nowait(fila)
+                    else:
+                        pedido.filas.append(fila)
+                elif tipo == "!trap":
+                    pedido.error = RouterOSTrap(_atributos(oracion).get("message", "error del router"))
+                elif tipo == "!done":
+                    self._pedidos.pop(tag, None)
+                    if not pedido.hecho.done():
+                        pedido.hecho.set_result(None)
+                    if pedido.cola is not None:
+                        pedido.cola.put_nowait(None)
+        except asyncio.CancelledError:
+            error = ConnectionError("conexión cerrada")
+            raise
+        except (asyncio.IncompleteReadError, OSError, ConnectionError) as e:
+            error = e if isinstance(e, ConnectionError) else ConnectionError(f"conexión con {self.router_ip} perdida: {e}")
+        finally:
+            self.cerrada = True
+            self._writer.close()
+            for pedido in self._pedidos.values():
+                pedido.error = pedido.error or error
+                if not pedido.hecho.done():
+                    pedido.hecho.set_result(None)
+                if pedido.cola is not None:
+                    pedido.cola.put_nowait(None)
+            self._pedidos.clear()
+
+    async def _enviar(self, palabras, stream=False):
+        if self.cerrada:
+            raise ConnectionError(f"conexión con {self.router_ip} cerrada")
+        tag = str(next(self._tags))
+        pedido = _Pedido(stream)
+        self._pedidos[tag] = pedido
+        self._writer.write(codificar([*palabras, f".tag={tag}"]))
+        await self._writer.drain()
+        self.ultimo_uso = time.monotonic()
+        return tag, pedido
+
+    async def _cancelar(self, tag):
+        # El router contesta !trap "interrupted" + !done al comando cancelado
+        if not self.cerrada and tag in self._pedidos:
+            try:
+                self._writer.write(codificar(["/cancel", f"=tag={tag}"]))
+                await self._writer.drain()
+            except OSError:
+                pass
+
+    async def comando(self, palabras, timeout=config.MK_READ_TIMEOUT) -> list:
+        """Corre un comando y devuelve sus filas (!re). !trap -> RouterOSTrap; conexión caída -> ConnectionError."""
+        async with self._lugares:
+            tag, pedido = await self._enviar(palabras)
+            try:
+                await asyncio.wait_for(asyncio.shield(pedido.hecho), timeout)
+            except asyncio.TimeoutError:
+                # Puede ser un socket medio abierto: no se sigue usando esta conexión (los
+                # demás comandos en vuelo reciben ConnectionError y se reintentan en una nueva)
+                self.cerrar()
+                _descartar(self)
+                raise TimeoutError(f"{self.router_ip} no respondió {palabras[0]} en {timeout}s")
+            except asyncio.CancelledError:
+                await self._cancelar(tag)
+                raise
+            self.ultimo_uso = time.monotonic()
+            if pedido.error:
+                raise pedido.error
+            return pedido.filas
+
+    async def stream(self, palabras):
+        """
+        Comando continuo (ej. monitor-traffic sin once): genera cada fila a medida que llega.
+        Al cerrarlo se cancela en el router: usarlo con contextlib.aclosing, porque un
+        `break` solo no cierra el generador hasta que lo junta el recolector.
+        """
+        tag, pedido = await self._enviar(palabras, stream=True)
+        try:
+            while True:
+                fila = await pedido.cola.get()
+                if fila is None:
+                    # Mientras se lee, un !trap es del router (ej. la interfaz desapareció), no de /cancel
+                    if pedido.error:
+                        raise pedido.error
+                    return
+                self.ultimo_uso = time.monotonic()
+                yield fila
+        finally:
+            await self._cancelar(tag)
+
+    def cerrar(self):
+        self.cerrada = True
+        if self._lector is not None:
+            self._lector.cancel()
+        else:
+            self._writer.close()
+
+
+# ------------------ CONEXIONES POR ROUTER ------------------
+_conexiones = {}
+_aperturas = {}
+_conocidos = set()
+_stats = {"logins": 0, "reconexiones": 0}
+
+def _descartar(c: Conexion):
+    """Saca la conexión del pool (si sigue siendo la vigente de su router): el próximo pedido abre otra."""
+    clave = (c.router_ip, int(c.port or MIKROTIK_PORT))
+    if _conexiones.get(clave) is c:
+        del _conexiones[clave]
+
+def _cerrar_ociosas():
+    ahora = time.monotonic()
+    for clave, conexion in list(_conexiones.items()):
+        if conexion.cerrada or ahora - conexion.ultimo_uso > config.MK_POOL_IDLE_SEC:
+            if not conexion._pedidos:
+                conexion.cerrar()
+                del _conexiones[clave]
+
+async def conexion(router_ip, port, connect_timeout=config.MK_CONNECT_TIMEOUT) -> Conexion:
+    """Conexión compartida del router (ip, puerto) en este event loop; se abre o reabre si hace falta."""
+    clave = (router_ip, int(port or MIKROTIK_PORT))
+    _cerrar_ociosas()
+    actual = _conexiones.get(clave)
+    if actual is not None and not actual.cerrada and actual.loop is asyncio.get_running_loop():
+        return actual
+    # Un solo login por router aunque lleguen muchos pedidos juntos
+    apertura = _aperturas.get(clave)
+    if apertura is None or apertura.get_loop() is not asyncio.get_running_loop():
+        apertura = asyncio.ensure_future(Conexion.abrir(clave[0], clave[1], connect_timeout=connect_timeout))
+        _aperturas[clave] = apertura
+        apertura.add_done_callback(lambda f: _aperturas.pop(clave, None) if _aperturas.get(clave) is f else None)
+        _stats["logins"] += 1
+        if clave in _conocidos:
+            _stats["reconexiones"] += 1
+        _conocidos.add(clave)
+    nueva = await asyncio.shield(apertura)
+    _conexiones[clave] = nueva
+    return nueva
+
+async def _con_conexion(router_ip, port, palabras, read_timeout=config.MK_READ_TIMEOUT,
+                        connect_timeout=config.MK_CONNECT_TIMEOUT) -> list:
+    """Comando de lectura; si la conexión compartida estaba caída, se reintenta una vez con una nueva."""
+    for intento in range(2):
+        c = await conexion(router_ip, port, connect_timeout)
+        try:
+            return await c.comando(palabras, read_timeout)
+        except ConnectionError as e:
+            if intento == 1:
+                raise
+            logger.warning(f"[MK] Conexión con {router_ip} cortada ({e}), reconectando...")
+
+def stats() -> dict:
+    ahora = time.monotonic()
+    return {
+        **_stats,
+        "conexiones": {
+            f"{ip}:{port}": {"en_vuelo": len(c._pedidos), "ociosa_seg": round(ahora - c.ultimo_uso, 1), "cerrada": c.cerrada}
+            for (ip, port), c in _conexiones.items()
+        },
+    }
+
+
+# ------------------ CONSULTAS (mismas que mikrotik.py) ------------------
+async def _buscar_secret(router_ip, puerto, pppoe_user, proplist=None):
+    palabras = ["/ppp/secret/print", f"?name={pppoe_user}"] + ([f"=.proplist={','.join(proplist)}"] if proplist else [])
+    result = await _con_conexion(router_ip, puerto, palabras)
+    if not result:
+        raise LookupError(f"Secret {pppoe_user} no encontrado")
+    return result[0]
+
+async def obtener_secret(router_ip, pppoe_user, puerto):
+    try:
+        return await _buscar_secret(router_ip, puerto, pppoe_user)
+    except Exception as e:
+        logger.error(f"Error al obtener secret {pppoe_user} en {router_ip}: {e}")
+        return {"error": str(e)}
+
+async def get_all_secrets(router_ip, port, proplist=SECRET_PROPLIST,
+                          connect_timeout=config.MK_CONNECT_TIMEOUT, read_timeout=config.MK_READ_TIMEOUT):
+    """Lista completa de secrets del router (solo los campos de proplist, sin passwords)."""
+    palabras = ["/ppp/secret/print"] + ([f"=.proplist={','.join(proplist)}"] if proplist else [])
+    try:
+        return await _con_conexion(router_ip, port, palabras, read_timeout, connect_timeout)
+    except Exception as e:
+        logger.error(f"Error al obtener todos los secrets de {router_ip}: {e}")
+        return []
+
+async def get_ppp_active(router_ip, port, connect_timeout=config.MK_CONNECT_TIMEOUT, read_timeout=config.MK_READ_TIMEOUT):
+    """Sesiones PPP activas del router (campos de ACTIVE_PROPLIST); None si no respondió."""
+    palabras = ["/ppp/active/print", f"=.proplist={','.join(ACTIVE_PROPLIST)}"]
+    try:
+        return await _con_conexion(router_ip, port, palabras, read_timeout, connect_timeout)
+    except Exception as e:
+        logger.error(f"Error al obtener las sesiones activas de {router_ip}: {e}")
+        return None
+
+async def validar_pppoe(router_ip: str, pppoe_user: str, puerto: str) -> dict:
+    try:
+        result = await _con_conexion(router_ip, puerto, [
+            "/ppp/active/print", f"=.proplist={','.join(ACTIVE_PROPLIST)}", f"?name={pppoe_user}",
+        ])
+        if result:
+            logger.info(f"PPP user {pppoe_user} activo en {router_ip}")
+            return {"active": True, **result[0]}
+        logger.warning(f"PPP user {pppoe_user} NO activo en {router_ip}")
+        # Misma conexión para el secret
+        try:
+            return {"active": False, "secret": await _buscar_secret(router_ip, puerto, pppoe_user, SECRET_PROPLIST)}
+        except (RouterOSTrap, LookupError) as e:
+            logger.error(f"{e} en {router_ip}")
+            return {"active": False, "secret": {"error": str(e)}}
+    except Exception as e:
+        logger.error(f"Error al validar PPPoE en {router_ip}: {e}")
+        return {"active": False, "error": str(e)}
+
+async def obtener_trafico_en_vivo(router_ip, pppoe_user, port):
+    """Velocidad actual de la interfaz <pppoe-usuario> ('/interface monitor-traffic' con once)."""
+    try:
+        stats = await _con_conexion(router_ip, port, [
+            "/interface/monitor-traffic", f"=interface=<pppoe-{pppoe_user}>", "=once=",
+        ])
+        if stats:
+            return {
+                "rx": stats[0].get("rx-bits-per-second", "0"), # Bajada (Download)
+                "tx": stats[0].get("tx-bits-per-second", "0")  # Subida (Upload)
+            }
+        return {"error": "Interfaz no activa o no encontrada"}
+    except Exception as e:
+        logger.error(f"Error tráfico en vivo {pppoe_user} ({router_ip}): {e}")
+        return {"error": str(e)}
+
+async def monitorear_trafico(router_ip, pppoe_user, port, intervalo: float):
+    """
+    monitor-traffic continuo de <pppoe-usuario>: genera {"rx", "tx"} cada `intervalo`
+    segundos. Al cerrar el generador (contextlib.aclosing) se cancela en el router.
+    """
+    c = await conexion(router_ip, port)
+    async with contextlib.aclosing(c.stream([
+        "/interface/monitor-traffic", f"=interface=<pppoe-{pppoe_user}>", f"=interval={intervalo:g}",
+    ])) as filas:
+        async for fila in filas:
+            yield {"rx": fila.get("rx-bits-per-second", "0"), "tx": fila.get("tx-bits-per-second", "0")}
+
+async def obtener_trafico_varios(router_ip, pppoe_users, port) -> dict:
+    """
+    Velocidad actual de varias interfaces <pppoe-usuario> del mismo router con un solo
+    monitor-traffic (interfaces separadas por coma): {usuario: {"rx", "tx"} o {"error"}}.
+    """
+    interfaces = {f"<pppoe-{u}>": u for u in pppoe_users}
+    try:
+        filas = await _con_conexion(router_ip, port, [
+            "/interface/monitor-traffic", f"=interface={','.join(interfaces)}", "=once=",
+        ])
+    except RouterOSTrap:
+        # Una interfaz inexistente (usuario desconectado) hace fallar el comando entero:
+        # se pregunta de a uno, en paralelo por la misma conexión
+        sueltos = await asyncio.gather(*(obtener_trafico_en_vivo(router_ip, u, port) for u in pppoe_users))
+        return dict(zip(pppoe_users, sueltos))
+    except Exception as e:
+        logger.error(f"Error tráfico en vivo de {len(pppoe_users)} usuarios ({router_ip}): {e}")
+        return {u: {"error": str(e)} for u in pppoe_users}
+    # Una fila por interfaz, en el orden pedido (el router la identifica en =name=)
+    nombres = list(interfaces)
+    trafico = {
+        interfaces.get(fila.get("name", nombres[i] if i < len(nombres) else None)):
+            {"rx": fila.get("rx-bits-per-second", "0"), "tx": fila.get("tx-bits-per-second", "0")}
+        for i, fila in enumerate(filas)
+    }
+    return {u: trafico.get(u, {"error": "Interfaz no activa o no encontrada"}) for u in pppoe_users}
+
+
+# ------------------ DESPACHO ------------------
+async def mikrotik_api(funcion: str, *args):
+    """
+    Llama a la función de Mikrotik con este cliente (MK_API_ASYNC) o con el bloqueante
+    en un thread: mismas funciones y mismas respuestas en los dos.
+    """
+    if config.MK_API_ASYNC:
+        return await globals()[funcion](*args)
+    return await asyncio.to_thread(getattr(mikrotik, funcion), *args)
@@ -1,10 +1,13 @@
-import requests
 from app import config
 from app.config import logger
+from app.clients.http import get_session
 from app.utils.safe_call import safe_call 
+from app.utils.json_stream import iter_json_array
+from app.utils import telemetria
 
 SMARTOLT_BASEURL = config.SMARTOLT_BASEURL
 SMARTOLT_TOKEN = config.SMARTOLT_TOKEN
+_http = get_session("smartolt")
 
 
 def _error_payload(detail: str, status_code=None):
@@ -27,7 +30,7 @@ def _request(method, endpoint, **kwargs):
         headers = kwargs.pop("headers", {})
         headers["X-Token"] = SMARTOLT_TOKEN
         url = f"{SMARTOLT_BASEURL}{endpoint}"
-        resp = requests.request(method, url, headers=headers, **kwargs)
+        resp = _http.request(method, url, headers=headers, **kwargs)
         resp.raise_for_status()
         return resp
     except Exception as e:
@@ -35,6 +38,33 @@ def _request(method, endpoint, **kwargs):
         return _error_payload(str(e))
 
 
+def _contar_bytes(chunks):
+    for chunk in chunks:
+        telemetria.sumar(bytes=len(chunk))
+        yield chunk
+
+def iterar_onus(meta: dict = None):
+    """
+    Devuelve las ONUs de /onu/get_all_onus_details de a una, parseando el array "onus"
+    a medida que llega la respuesta (stream): la memoria no depende de la cantidad de ONUs.
+    Lanza excepción si la API falla o no devuelve status OK, para que el sync descarte la carga.
+    """
+    resp = _request("GET", "/onu/get_all_onus_details", stream=True, timeout=config.SMARTOLT_TIMEOUT)
+    if not hasattr(resp, "iter_content"):
+        raise RuntimeError(resp.get("detalle", "error en request a SmartOLT"))
+
+    meta = {} if meta is None else meta
+    try:
+        for onu in iter_json_array(_contar_bytes(resp.iter_content(chunk_size=config.SMARTOLT_STREAM_CHUNK)), "onus", meta):
+            # Si "status" vino antes que "onus" y es falso, no seguimos leyendo
+            if "status" in meta and not meta["status"]:
+                raise RuntimeError("SmartOLT no devolvió estado OK")
+            yield onu
+    finally:
+        resp.close()
+    if not meta.get("status"):
+        raise RuntimeError("SmartOLT no devolvió estado OK")
+
 def get_all_onus():
     try:
         """Devuelve el lote completo de ONUs desde SmartOLT."""
@@ -27,16 +27,49 @@ def _parse_mapping_env(raw_value: str | None) -> dict[str, str]:
 API_KEY = os.getenv("API_KEY")
 SMARTOLT_BASEURL = os.getenv("SMARTOLT_BASEURL")
 SMARTOLT_TOKEN = os.getenv("SMARTOLT_TOKEN")
+SMARTOLT_TIMEOUT = int(os.getenv("SMARTOLT_TIMEOUT", "300"))
+SMARTOLT_STREAM_CHUNK = int(os.getenv("SMARTOLT_STREAM_CHUNK", str(64 * 1024)))
+SMARTOLT_API_TIMEOUT = int(os.getenv("SMARTOLT_API_TIMEOUT", "20"))
+SMARTOLT_POOL_SIZE = int(os.getenv("SMARTOLT_POOL_SIZE", "10"))
 MK_HOST = os.getenv("MK_HOST")
 MK_USER = os.getenv("MK_USER")
 MK_PASS = os.getenv("MK_PASS")
 MK_PORT = int(os.getenv("MK_PORT", 8799))
+MK_CONNECT_TIMEOUT = float(os.getenv("MK_CONNECT_TIMEOUT", "5"))
+MK_READ_TIMEOUT = float(os.getenv("MK_READ_TIMEOUT", "30"))
+MK_POOL_MAX_PER_ROUTER = int(os.getenv("MK_POOL_MAX_PER_ROUTER", "4"))
+MK_POOL_IDLE_SEC = float(os.getenv("MK_POOL_IDLE_SEC", "300"))
+MK_POOL_CHECK_SEC = float(os.getenv("MK_POOL_CHECK_SEC", "30"))
+MK_POOL_WAIT_SEC = float(os.getenv("MK_POOL_WAIT_SEC", "10"))
+MK_API_ASYNC = os.getenv("MK_API_ASYNC", "1").lower() in ("1", "true", "yes")
+MK_ASYNC_MAX_PER_ROUTER = int(os.getenv("MK_ASYNC_MAX_PER_ROUTER", "16"))
+LIVE_BATCH_MAX = int(os.getenv("LIVE_BATCH_MAX", "200"))
+LIVE_STREAM_INTERVAL_SEC = float(os.getenv("LIVE_STREAM_INTERVAL_SEC", "2"))
+LIVE_STREAM_RETRY_SEC = float(os.getenv("LIVE_STREAM_RETRY_SEC", "5"))
+PPP_ACTIVE_POLL_SEC = float(os.getenv("PPP_ACTIVE_POLL_SEC", "30"))
+PPP_ACTIVE_STALE_SEC = float(os.getenv("PPP_ACTIVE_STALE_SEC", "90"))
+PPP_ACTIVE_IN_SERVICE = os.getenv("PPP_ACTIVE_IN_SERVICE", "0").lower() in ("1", "true", "yes")
+SYNC_MK_WORKERS = int(os.getenv("SYNC_MK_WORKERS", "8"))
+SECRETS_REFRESH_MIN_SEC = float(os.getenv("SECRETS_REFRESH_MIN_SEC", "120"))
+SECRETS_REFRESH_MAX_SEC = float(os.getenv("SECRETS_REFRESH_MAX_SEC", "1800"))
+SECRETS_REFRESH_BACKOFF = float(os.getenv("SECRETS_REFRESH_BACKOFF", "1.5"))
+SECRETS_REFRESH_JITTER = float(os.getenv("SECRETS_REFRESH_JITTER", "0.2"))
+SECRETS_REFRESH_SNAPSHOT_SEC = float(os.getenv("SECRETS_REFRESH_SNAPSHOT_SEC", "300"))
+SECRETS_REFRESH_IN_SERVICE = os.getenv("SECRETS_REFRESH_IN_SERVICE", "0").lower() in ("1", "true", "yes")
 GENIEACS_URL = os.getenv("GENIEACS_URL")
 ISPCUBE_BASEURL=os.getenv("ISPCUBE_BASEURL")
 ISPCUBE_APIKEY=os.getenv("ISPCUBE_APIKEY")
 ISPCUBE_USER=os.getenv("ISPCUBE_USER")
 ISPCUBE_PASSWORD=os.getenv("ISPCUBE_PASSWORD")
 ISPCUBE_CLIENTID=os.getenv("ISPCUBE_CLIENTID")
+ISPCUBE_TIMEOUT = int(os.getenv("ISPCUBE_TIMEOUT", "60"))
+ISPCUBE_PAGE_SIZE = int(os.getenv("ISPCUBE_PAGE_SIZE", "500"))
+ISPCUBE_MAX_IN_FLIGHT = int(os.getenv("ISPCUBE_MAX_IN_FLIGHT", "4"))
+ISPCUBE_PAGE_RETRIES = int(os.getenv("ISPCUBE_PAGE_RETRIES", "3"))
+ISPCUBE_POOL_SIZE = int(os.getenv("ISPCUBE_POOL_SIZE", "10"))
+ISPCUBE_DELTA_FILTER_PARAM = os.getenv("ISPCUBE_DELTA_FILTER_PARAM", "")
+ISPCUBE_DELTA_ORDER_PARAMS = os.getenv("ISPCUBE_DELTA_ORDER_PARAMS", "")
+ISPCUBE_DELTA_OVERLAP_SEC = int(os.getenv("ISPCUBE_DELTA_OVERLAP_SEC", "300"))
 
 # Oráculo - InfluxDB
 ORACULO_INFLUX_URL = os.getenv("ORACULO_INFLUX_URL") or os.getenv("INFLUXDB_URL")
@@ -79,12 +112,33 @@ if ORACULO_GRAYLOG_USER and not ORACULO_GRAYLOG_PASSWORD:
     # Graylog token auth commonly uses username=<token> and password='token'.
     ORACULO_GRAYLOG_PASSWORD = "token"
 ORACULO_GRAYLOG_TIMEOUT_SEC = int(os.getenv("ORACULO_GRAYLOG_TIMEOUT_SEC", "15"))
+ORACULO_GRAYLOG_POOL_SIZE = int(os.getenv("ORACULO_GRAYLOG_POOL_SIZE", "10"))
 ORACULO_GRAYLOG_RANGE_SEC = int(os.getenv("ORACULO_GRAYLOG_RANGE_SEC", str(30 * 24 * 60 * 60)))
 ORACULO_GRAYLOG_SESSION_CACHE_TTL_SEC = int(os.getenv("ORACULO_GRAYLOG_SESSION_CACHE_TTL_SEC", "60"))
 ORACULO_GRAYLOG_SORT = os.getenv("ORACULO_GRAYLOG_SORT", "timestamp:asc")
 ORACULO_GRAYLOG_FIELDS = os.getenv("ORACULO_GRAYLOG_FIELDS", "message,source,timestamp")
 
+# HTTP: timeout de conexión común a todos los upstreams (el de lectura es por upstream)
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+
 DB_PATH = os.path.abspath(os.getenv("DB_PATH", "data/diag.db"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "65536"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "5000"))
+SYNC_CACHE_SIZE_KB = int(os.getenv("SYNC_CACHE_SIZE_KB", "262144"))
+SYNC_STAGE_WORKERS = int(os.getenv("SYNC_STAGE_WORKERS", "6"))
+SYNC_TELEMETRY_KEEP = int(os.getenv("SYNC_TELEMETRY_KEEP", "180"))
+SYNC_CHANGELOG_DAYS = int(os.getenv("SYNC_CHANGELOG_DAYS", "30"))
+SYNC_RESUME_MAX_AGE_MIN = int(os.getenv("SYNC_RESUME_MAX_AGE_MIN", "360"))
+SYNC_LEASE_SEC = float(os.getenv("SYNC_LEASE_SEC", "600"))
+DIAG_CACHE_SIZE = int(os.getenv("DIAG_CACHE_SIZE", "5000"))
+SEARCH_MAX_HITS = int(os.getenv("SEARCH_MAX_HITS", "2000"))
+# Modo snapshot: el sync publica una copia cerrada de la base y la API la abre inmutable
+DB_SNAPSHOT_MODE = os.getenv("DB_SNAPSHOT_MODE", "0").lower() in ("1", "true", "yes")
+DB_SNAPSHOT_DIR = os.path.abspath(os.getenv("DB_SNAPSHOT_DIR", os.path.join(os.path.dirname(DB_PATH), "snapshots")))
+DB_SNAPSHOT_KEEP = int(os.getenv("DB_SNAPSHOT_KEEP", "2"))
+DB_SNAPSHOT_MMAP_SIZE = int(os.getenv("DB_SNAPSHOT_MMAP_SIZE", str(1024 * 1024 * 1024)))
 
 # Crear carpeta data/ si no existe
 db_dir = os.path.dirname(DB_PATH)
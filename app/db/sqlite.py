@@ -1,125 +1,826 @@
+import base64
+import hashlib
+import json
+import os
+import socket
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
 from app import config
-from datetime import datetime
+from datetime import datetime, timedelta
+
+def _configure_connection(conn):
+    # PRAGMAs por conexión (journal_mode=WAL es persistente y se fija en init_db)
+    conn.execute(f"PRAGMA busy_timeout = {config.DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size = -{config.DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {config.DB_MMAP_SIZE}")
+    conn.execute("PRAGMA synchronous = NORMAL")
 
 class Database:
-    def __init__(self, path=config.DB_PATH):
-        self.conn = sqlite3.connect(path)
+    def __init__(self, path=config.DB_PATH, readonly=False, immutable=False):
+        self.path = path
+        if immutable:
+            # Snapshot publicado: nadie lo modifica, SQLite no toma locks ni mira el WAL
+            self.conn = sqlite3.connect(f"{Path(path).as_uri()}?mode=ro&immutable=1", uri=True)
+        elif readonly:
+            self.conn = sqlite3.connect(f"{Path(path).as_uri()}?mode=ro", uri=True)
+        else:
+            self.conn = sqlite3.connect(path)
         self.conn.row_factory = sqlite3.Row
+        _configure_connection(self.conn)
+        if immutable:
+            self.conn.execute(f"PRAGMA mmap_size = {config.DB_SNAPSHOT_MMAP_SIZE}")
+        self.conn.create_function("row_hash", -1, _row_hash, deterministic=True)
         self.cursor = self.conn.cursor()
 
     # ------------------ INSERTS ------------------
-    def insert_subscriber(self, unique_external_id, sn, olt_name, olt_id, board, port, onu, onu_type_id, name, mode):
-        self.cursor.execute("INSERT OR REPLACE INTO subscribers (unique_external_id, sn, olt_name, olt_id, board, port, onu, onu_type_id, pppoe_username, mode) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (unique_external_id, sn, olt_name, olt_id, board, port, onu, onu_type_id, name, mode))
+    def insert_subscriber(self, unique_external_id, sn, olt_name, olt_id, board, port, onu, onu_type_id, name, mode, table="subscribers"):
+        self.cursor.execute(_insert_sql(table), (unique_external_id, sn, olt_name, olt_id, board, port, onu, onu_type_id, name, mode))
     
-    def insert_node(self, node_id, name, ip_address, puerto):
-        self.cursor.execute("INSERT OR REPLACE INTO nodes (node_id, name, ip_address, puerto) VALUES (?, ?, ?, ?)", (node_id, name, ip_address, puerto))
+    def insert_node(self, node_id, name, ip_address, puerto, table="nodes"):
+        self.cursor.execute(_insert_sql(table), (node_id, name, ip_address, puerto))
     
-    def insert_plan(self, plan_id, name, speed, description):
-        self.cursor.execute("INSERT OR REPLACE INTO plans (plan_id, name, speed, description) VALUES (?, ?, ?, ?)", (plan_id, name, speed, description))
+    def insert_plan(self, plan_id, name, speed, description, table="plans"):
+        self.cursor.execute(_insert_sql(table), (plan_id, name, speed, description))
     
-    def insert_connection(self, connection_id, pppoe_username, customer_id, node_id, plan_id, direccion=None):
-        self.cursor.execute("INSERT OR REPLACE INTO connections (connection_id, pppoe_username, customer_id, node_id, plan_id, direccion) VALUES (?, ?, ?, ?, ?, ?)", (connection_id, pppoe_username, customer_id, node_id, plan_id, direccion))
+    def insert_connection(self, connection_id, pppoe_username, customer_id, node_id, plan_id, direccion=None, table="connections"):
+        self.cursor.execute(_insert_sql(table), (connection_id, pppoe_username, customer_id, node_id, plan_id, direccion))
     
-    def insert_cliente(self, cliente_data: dict):
-        columns = ', '.join(cliente_data.keys())
-        placeholders = ', '.join('?' for _ in cliente_data)
-        values = tuple(cliente_data.values())
-        self.cursor.execute(f"INSERT OR REPLACE INTO clientes ({columns}) VALUES ({placeholders})", values)
+    def insert_cliente(self, cliente_data: dict, table="clientes"):
+        self.cursor.execute(_insert_sql(table), tuple(cliente_data.get(col) for col in COLUMNS["clientes"]))
     
-    def insert_cliente_email(self, customer_id: int, email: str):
-        self.cursor.execute("INSERT INTO clientes_emails (customer_id, email) VALUES (?, ?)", (customer_id, email))
+    def insert_cliente_email(self, customer_id: int, email: str, table="clientes_emails"):
+        self.cursor.execute(_insert_sql(table), (customer_id, email))
     
-    def insert_cliente_telefono(self, customer_id: int, number: str):
-        self.cursor.execute("INSERT INTO clientes_telefonos (customer_id, number) VALUES (?, ?)", (customer_id, number))
+    def insert_cliente_telefono(self, customer_id: int, number: str, table="clientes_telefonos"):
+        self.cursor.execute(_insert_sql(table), (customer_id, number))
 
-    def insert_secret(self, secret_data: dict, router_ip: str):
+    def insert_secret(self, secret_data: dict, router_ip: str, table="ppp_secrets"):
         # PK COMPUESTA: (name, router_ip) vital para que no se pisen usuarios en distintos nodos
+        self.cursor.execute(_insert_sql(table), secret_row(secret_data, router_ip))
+
+    # ------------------ CARGA MASIVA ------------------
+    def bulk_insert(self, table: str, rows, chunk_size: int = None) -> int:
+        """
+        Inserta un iterable/generador de tuplas (en el orden de COLUMNS) con executemany,
+        en bloques de chunk_size para no materializar todo en memoria.
+        No hace commit: la carga queda en la transacción abierta (la cierra swap_staging).
+        """
+        chunk_size = chunk_size or config.SYNC_BATCH_SIZE
+        rows = iter(rows)
+        total = 0
+        t0 = time.perf_counter()
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            total += self.insert_rows(table, chunk)
+
+        elapsed = time.perf_counter() - t0
+        rate = total / elapsed if elapsed > 0 else 0
+        config.logger.info(f"[DB] {table}: {total} filas en {elapsed:.3f}s ({rate:,.0f} filas/s)")
+        return total
+
+    def insert_rows(self, table: str, rows: list) -> int:
+        """Un lote ya armado, sin log (lo usan bulk_insert y el writer del scheduler de sync)."""
+        self.cursor.executemany(_insert_sql(table), rows)
+        return len(rows)
+
+    @contextmanager
+    def sync_pragmas(self):
+        """
+        PRAGMAs para la ventana de sync: caché grande, temporales en memoria y sin
+        checkpoints automáticos mientras se carga. Al salir se restauran y se hace
+        un checkpoint para que el WAL no quede crecido.
+        """
+        self.commit()
+        self.conn.execute(f"PRAGMA cache_size = -{config.SYNC_CACHE_SIZE_KB}")
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+        self.conn.execute("PRAGMA wal_autocheckpoint = 0")
+        try:
+            yield self
+        finally:
+            self.commit()
+            self.conn.execute(f"PRAGMA cache_size = -{config.DB_CACHE_SIZE_KB}")
+            self.conn.execute("PRAGMA temp_store = DEFAULT")
+            self.conn.execute("PRAGMA wal_autocheckpoint = 1000")
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def publish_snapshot(self, directory=config.DB_SNAPSHOT_DIR, keep=config.DB_SNAPSHOT_KEEP) -> str:
+        """
+        Copia la base (backup online, consistente) a un archivo nuevo en modo DELETE,
+        lo renombra a su nombre final y recién ahí mueve el puntero CURRENT.
+        Los lectores toman el snapshot nuevo en su próxima consulta; el anterior se
+        conserva (keep) para los que todavía lo tienen abierto.
+        """
+        self.commit()
+        os.makedirs(directory, exist_ok=True)
+        nombre = f"diag-{datetime.now():%Y%m%d-%H%M%S}.db"
+        destino = os.path.join(directory, nombre)
+        tmp = f"{destino}.tmp"
+        dst = sqlite3.connect(tmp)
+        try:
+            self.conn.backup(dst)
+            # immutable=1 no lee el WAL: el snapshot tiene que quedar con journal clásico
+            dst.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            dst.close()
+        os.replace(tmp, destino)
+
+        puntero_tmp = os.path.join(directory, f"{_SNAPSHOT_POINTER}.tmp")
+        with open(puntero_tmp, "w") as f:
+            f.write(nombre)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(puntero_tmp, os.path.join(directory, _SNAPSHOT_POINTER))
+
+        viejos = sorted(f for f in os.listdir(directory) if f.startswith("diag-") and f.endswith(".db"))
+        for f in viejos[:-keep] if keep > 0 else []:
+            if f != nombre:
+                os.remove(os.path.join(directory, f))
+        return destino
+
+    # ------------------ STAGING / SWAP ATÓMICO ------------------
+    def begin_staging(self, *tables, reanudable: bool = False):
+        """
+        Crea tablas staging vacías (mismo esquema que las vivas) para cargar la próxima generación.
+        Las de tablas que se publican por diferencia van en el esquema temp: no se renombran,
+        así que la carga completa no pasa por el WAL (solo los cambios que se aplican).
+        Con `reanudable` van en la base, para que sobrevivan a un corte y la corrida
+        siguiente las retome (ver begin_resumable_staging).
+        Una staging temp solo reemplaza a la temp: las de la base pueden ser de un nightly
+        que está corriendo en otro proceso (el refresco intradía y el delta usan temp).
+        """
+        for table in tables:
+            temporal = table in _DIFF_KEYS and not reanudable
+            self.cursor.execute(f"DROP TABLE IF EXISTS temp.{staging(table)}")
+            if not temporal:
+                self.cursor.execute(f"DROP TABLE IF EXISTS main.{staging(table)}")
+            esquema = "temp." if temporal else ""
+            self.cursor.execute(_SCHEMAS[table].format(table=f"{esquema}{staging(table)}"))
+        self.commit()
+
+    def _drop_staging(self, table: str):
+        # Sin esquema, SQLite resuelve primero temp: se borra la staging que esta conexión está usando
+        self.cursor.execute(f"DROP TABLE IF EXISTS {staging(table)}")
+
+    # ------------------ CHECKPOINTS (SYNC REANUDABLE) ------------------
+    def get_checkpoint(self, etapa: str):
+        valor = self.get_state(f"{_CHECKPOINT_PREFIX}{etapa}")
+        return json.loads(valor) if valor else None
+
+    def set_checkpoint(self, etapa: str, datos: dict):
+        self.set_state(f"{_CHECKPOINT_PREFIX}{etapa}", json.dumps(datos))
+        self.commit()
+
+    def clear_checkpoints(self, *etapas):
+        """Borra los checkpoints de esas etapas (sin etapas: todos, ej. al terminar la corrida)."""
+        if etapas:
+            self.cursor.executemany("DELETE FROM sync_state WHERE clave = ?", ((f"{_CHECKPOINT_PREFIX}{e}",) for e in etapas))
+        else:
+            self.cursor.execute("DELETE FROM sync_state WHERE clave LIKE ?", (f"{_CHECKPOINT_PREFIX}%",))
+        self.commit()
+
+    def checkpoint_stage_done(self, etapa: str):
+        """Registra en el checkpoint de la corrida una etapa terminada."""
+        corrida = self.get_checkpoint("corrida")
+        if corrida is not None and etapa not in corrida["etapas"]:
+            corrida["etapas"].append(etapa)
+            self.set_checkpoint("corrida", corrida)
+
+    def begin_resumable_staging(self, etapa: str, *tables):
+        """
+        Staging de una etapa larga que se puede retomar. Si quedó un checkpoint de una
+        corrida cortada y sus staging siguen en la base, se conservan y se devuelve el
+        checkpoint (lo ya bajado no se vuelve a pedir); si no, staging nuevas y None.
+        """
+        checkpoint = self.get_checkpoint(etapa)
+        if checkpoint is not None:
+            self.cursor.execute(
+                f"SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ({', '.join('?' for _ in tables)})",
+                [staging(t) for t in tables]
+            )
+            if self.cursor.fetchone()[0] == len(tables):
+                return checkpoint
+        self.clear_checkpoints(etapa)
+        self.begin_staging(*tables, reanudable=True)
+        return None
+
+    def stage_with_checkpoint(self, etapa: str, checkpoint: dict, filas: dict = None, carry_over: tuple = None) -> int:
+        """
+        Escribe en staging un tramo ya bajado ({tabla: filas}, y/o un carry_over (tabla, where, params))
+        junto con el checkpoint que lo registra, en un solo commit: tras un corte, o está
+        el tramo y su checkpoint o no está ninguno de los dos.
+        """
+        total = 0
+        for table, rows in (filas or {}).items():
+            total += self.insert_rows(staging(table), list(rows))
+        if carry_over:
+            total += self.carry_over(*carry_over)
+        self.set_checkpoint(etapa, checkpoint)
+        return total
+
+    # ------------------ LEASE ENTRE PROCESOS ------------------
+    def get_lease(self, nombre: str):
+        """Lease vigente ({"dueno", "hasta"}) o None si no hay, ya venció o su proceso murió."""
+        valor = self.get_state(f"{_LEASE_PREFIX}{nombre}")
+        lease = json.loads(valor) if valor else None
+        if lease and lease["hasta"] > time.time() and _dueno_vivo(lease["dueno"]):
+            return lease
+        return None
+
+    def acquire_lease(self, nombre: str, segundos: float) -> bool:
+        """
+        Toma (o renueva) el lease si está libre, vencido o ya es de este proceso. Es la
+        marca de que el nightly está corriendo: los jobs intradía no escriben mientras tanto.
+        """
+        self.commit()
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            lease = self.get_lease(nombre)
+            if lease is not None and lease["dueno"] != _dueno_lease():
+                self.conn.rollback()
+                return False
+            self.set_state(f"{_LEASE_PREFIX}{nombre}", json.dumps({"dueno": _dueno_lease(), "hasta": time.time() + segundos}))
+            self.commit()
+            return True
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def release_lease(self, nombre: str):
+        self.cursor.execute(
+            "DELETE FROM sync_state WHERE clave = ? AND json_extract(valor, '$.dueno') = ?",
+            (f"{_LEASE_PREFIX}{nombre}", _dueno_lease())
+        )
+        self.commit()
+
+    def discard_staging(self, *tables):
+        """Descarta la carga en curso: la generación anterior sigue publicada."""
+        # Commit y no rollback: con etapas en paralelo la transacción abierta puede tener
+        # filas de otras staging; las de estas tablas se van con el DROP.
+        self.commit()
+        for table in tables:
+            self._drop_staging(table)
+        self.commit()
+
+    def carry_over(self, table: str, where: str, params: tuple = ()) -> int:
+        """Copia filas de la generación vigente a staging (ej. secrets de un router que no respondió)."""
+        self.cursor.execute(f"INSERT OR IGNORE INTO {staging(table)} SELECT * FROM {table} WHERE {where}", params)
+        return self.cursor.rowcount
+
+    def swap_staging(self, *tables) -> dict:
+        """
+        Publica las tablas staging reemplazando a las vivas en UNA transacción:
+        los lectores ven la generación anterior completa o la nueva completa, nunca tablas vacías.
+        Las tablas de _DIFF_KEYS no se reemplazan: se aplican solo las altas, bajas y
+        modificaciones (ver _apply_diff). Devuelve {tabla: filas} de la generación publicada.
+        """
+        self.commit()
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            counts = {}
+            for table in tables:
+                if table in _DIFF_KEYS:
+                    counts[table] = self._apply_diff(table)[0]
+                    continue
+                self.cursor.execute(f"SELECT COUNT(*) FROM {staging(table)}")
+                counts[table] = self.cursor.fetchone()[0]
+                self.cursor.execute(f"DROP TABLE IF EXISTS {table}")
+                self.cursor.execute(f"ALTER TABLE {staging(table)} RENAME TO {table}")
+                _create_indexes(self.cursor, table)
+                self._bump_generation(table, counts[table])
+            for table in tables:
+                self._drop_staging(table)
+            self.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return counts
+
+    def merge_staging(self, *tables, bajas: dict = None) -> dict:
+        """
+        Aplica una carga parcial (ej. delta de clientes) sobre las vivas, en una transacción:
+        altas y modificaciones de lo que vino, sin dar de baja lo que no vino. `bajas` =
+        {tabla: condición sobre `l`} para las tablas donde sí hay que borrar lo que falta,
+        dentro de ese alcance (ej. los emails de los clientes que llegaron en el delta).
+        Devuelve {tabla: {"altas", "modificaciones", "bajas"}}.
+        """
+        bajas = bajas or {}
+        self.commit()
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cambios = {table: self._apply_diff(table, bajas.get(table))[1] for table in tables}
+            for table in tables:
+                self._drop_staging(table)
+            self.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return cambios
+
+    def _apply_diff(self, table: str, bajas: str = "1") -> tuple:
+        """
+        Aplica staging sobre la tabla viva por diferencia: compara el hash de contenido
+        (row_hash) fila a fila por clave y escribe solo bajas, modificaciones y altas.
+        Cada cambio queda en sync_changelog. La generación solo avanza si hubo cambios, así
+        match, identidad, índice de búsqueda y cachés no se rehacen por una noche sin novedades.
+        Las filas que no cambian conservan su rowid (y las columnas que calcula el sync, ej. node_id).
+        `bajas` limita qué filas vivas que faltan en staging se borran (None = ninguna).
+        Devuelve (filas de la tabla viva, {"altas", "modificaciones", "bajas"}).
+        """
+        stg = staging(table)
+        columnas = COLUMNS[table]
+        claves = _DIFF_KEYS[table]
+        on = " AND ".join(f"l.{k} IS s.{k}" for k in claves)
+
+        datos = [c for c in columnas if c not in claves]
+        if datos:
+            self.cursor.execute(f"UPDATE {stg} SET row_hash = row_hash({', '.join(columnas)})")
+        self.cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+        carga_inicial = not self.cursor.fetchone()[0]
+
+        generacion = self.get_generation(table) + 1
+        if not carga_inicial:
+            # La primera carga no se registra: serían todas altas
+            self._log_changes(table, generacion, on, bajas)
+
+        borradas = 0
+        if bajas is not None:
+            self.cursor.execute(f"DELETE FROM {table} AS l WHERE NOT EXISTS (SELECT 1 FROM {stg} s WHERE {on}) AND ({bajas})")
+            borradas = self.cursor.rowcount
+        modificaciones = 0
+        if datos:
+            asignaciones = ", ".join(f"{c} = s.{c}" for c in datos)
+            self.cursor.execute(f"""
+                UPDATE {table} AS l SET {asignaciones}, row_hash = s.row_hash
+                FROM {stg} s WHERE {on} AND l.row_hash IS NOT s.row_hash
+            """)
+            modificaciones = self.cursor.rowcount
+        insertadas = list(columnas) + (["row_hash"] if datos else [])
+        self.cursor.execute(f"""
+            INSERT INTO {table} ({', '.join(insertadas)})
+            SELECT {', '.join(insertadas)} FROM {stg} s
+            WHERE NOT EXISTS (SELECT 1 FROM {table} l WHERE {on})
+            ORDER BY s.rowid
+        """)
+        altas = self.cursor.rowcount
+        self.cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        filas = self.cursor.fetchone()[0]
+
+        if altas or borradas or modificaciones:
+            self._bump_generation(table, filas)
+        else:
+            generacion -= 1
+        config.logger.info(
+            f"[SYNC] {table}: {altas} altas, {modificaciones} modificaciones, {borradas} bajas "
+            f"({filas} filas, generación {generacion})."
+        )
+        return filas, {"altas": altas, "modificaciones": modificaciones, "bajas": borradas}
+
+    def _log_changes(self, table: str, generacion: int, on: str, bajas: str = "1"):
+        """Registra en sync_changelog lo que _apply_diff va a escribir (antes de aplicarlo)."""
+        stg = staging(table)
+        claves = _DIFF_KEYS[table]
+        pppoe = _CHANGELOG_PPPOE.get(table)
+
+        def clave(alias):
+            if len(claves) == 1:
+                return f"CAST({alias}.{claves[0]} AS TEXT)"
+            return " || '@' || ".join(f"{alias}.{k}" for k in claves)
+
+        def pppoe_key(alias):
+            return f"LOWER(TRIM({alias}.{pppoe}))" if pppoe else "NULL"
+
+        datos = [c for c in COLUMNS[table] if c not in claves]
+        insert = "INSERT INTO sync_changelog (fecha, tabla, generacion, op, clave, pppoe_key, columnas)"
+        params = (datetime.now().isoformat(timespec="seconds"), table, generacion)
+
+        if bajas is not None:
+            self.cursor.execute(f"""
+                {insert} SELECT ?, ?, ?, 'baja', {clave('l')}, {pppoe_key('l')}, NULL
+                FROM {table} l WHERE NOT EXISTS (SELECT 1 FROM {stg} s WHERE {on}) AND ({bajas})
+            """, params)
+        if datos:
+            # Solo los nombres de las columnas que cambiaron, separados por coma
+            cambiadas = "substr(" + " || ".join(f"CASE WHEN l.{c} IS NOT s.{c} THEN ',{c}' ELSE '' END" for c in datos) + ", 2)"
+            self.cursor.execute(f"""
+                {insert} SELECT ?, ?, ?, 'modificacion', {clave('s')}, {pppoe_key('s')}, {cambiadas}
+                FROM {stg} s JOIN {table} l ON {on} WHERE l.row_hash IS NOT s.row_hash
+            """, params)
+        self.cursor.execute(f"""
+            {insert} SELECT ?, ?, ?, 'alta', {clave('s')}, {pppoe_key('s')}, NULL
+            FROM {stg} s WHERE NOT EXISTS (SELECT 1 FROM {table} l WHERE {on})
+        """, params)
+
+    def prune_changelog(self, days: int = None) -> int:
+        days = config.SYNC_CHANGELOG_DAYS if days is None else days
+        if days <= 0:
+            return 0
+        limite = (datetime.now() - timedelta(days=days)).isoformat(timespec="seconds")
+        self.cursor.execute("DELETE FROM sync_changelog WHERE fecha < ?", (limite,))
+        borradas = self.cursor.rowcount
+        self.commit()
+        return borradas
+
+    def get_changes(self, pppoe_user: str, desde: datetime, limit: int = 200) -> list:
+        """
+        Cambios que afectan a un PPPoE desde `desde`: los de sus filas propias (conexión,
+        ONU, secrets) y los de su cliente, nodo y plan en ISPCube. Del más nuevo al más viejo.
+        """
+        self.cursor.execute("""
+            WITH con AS (
+                SELECT customer_id, node_id, plan_id FROM connections WHERE pppoe_username = :pppoe
+            )
+            SELECT id, fecha, tabla, generacion, op, clave, columnas FROM sync_changelog
+            WHERE pppoe_key = LOWER(TRIM(:pppoe)) AND fecha >= :desde
+            UNION ALL
+            SELECT id, fecha, tabla, generacion, op, clave, columnas FROM sync_changelog
+            WHERE fecha >= :desde AND (
+                (tabla = 'clientes' AND clave IN (SELECT CAST(customer_id AS TEXT) FROM con))
+                OR (tabla IN ('clientes_emails', 'clientes_telefonos') AND EXISTS (
+                    -- clave "<cliente>@<dato>": rango por prefijo para usar idx_changelog_clave
+                    SELECT 1 FROM con WHERE clave >= customer_id || '@' AND clave < customer_id || 'A'
+                ))
+                OR (tabla = 'nodes' AND clave IN (SELECT CAST(node_id AS TEXT) FROM con))
+                OR (tabla = 'plans' AND clave IN (SELECT CAST(plan_id AS TEXT) FROM con))
+            )
+            ORDER BY id DESC
+            LIMIT :limit
+        """, {"pppoe": pppoe_user, "desde": desde.isoformat(timespec="seconds"), "limit": limit})
+        return [dict(r) for r in self.cursor.fetchall()]
+
+    def get_changelog(self, after_id: int = 0, limit: int = 1000) -> list:
+        """Cambios con id > after_id, en orden (para que cachés y UI sigan el log de a tramos)."""
         self.cursor.execute("""
-            INSERT OR REPLACE INTO ppp_secrets (name, password, profile, service, last_caller_id, comment, router_ip, last_logged_out)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            secret_data.get("name"), secret_data.get("password"), secret_data.get("profile"), secret_data.get("service"),
-            secret_data.get("last-caller-id"), secret_data.get("comment"), router_ip, secret_data.get("last-logged-out")
-        ))
+            SELECT id, fecha, tabla, generacion, op, clave, pppoe_key, columnas FROM sync_changelog
+            WHERE id > ? ORDER BY id LIMIT ?
+        """, (after_id, limit))
+        return [dict(r) for r in self.cursor.fetchall()]
+
+    def _bump_generation(self, table: str, rows: int):
+        self.cursor.execute("""
+            INSERT INTO sync_generations (tabla, generacion, filas, actualizado) VALUES (?, 1, ?, ?)
+            ON CONFLICT(tabla) DO UPDATE SET generacion = generacion + 1, filas = excluded.filas, actualizado = excluded.actualizado
+        """, (table, rows, datetime.now()))
+
+    def _source_generations(self, *tables) -> str:
+        """Generaciones de las tablas de origen de una tabla derivada (para saber si hay que rehacerla)."""
+        return ":".join(str(self.get_generation(t)) for t in tables)
+
+    def get_generation(self, table: str) -> int:
+        self.cursor.execute("SELECT generacion FROM sync_generations WHERE tabla = ?", (table,))
+        row = self.cursor.fetchone()
+        return row[0] if row else 0
 
     # ------------------ UTILIDADES ------------------
     def get_nodes_for_sync(self) -> list:
         self.cursor.execute("SELECT ip_address, puerto, name FROM nodes WHERE ip_address IS NOT NULL AND ip_address != ''")
         return [{"ip": r[0], "port": int(r[1]) if r[1] and r[1].isdigit() else None, "name": r[2]} for r in self.cursor.fetchall()]
 
-    def match_connections(self):
-        self.cursor.execute("UPDATE subscribers SET node_id = (SELECT node_id FROM connections WHERE connections.pppoe_username = subscribers.pppoe_username), connection_id = (SELECT connection_id FROM connections WHERE connections.pppoe_username = subscribers.pppoe_username)")
+    def match_connections(self) -> int:
+        """
+        Vincula cada ONU (subscribers) con su conexión de ISPCube por usuario PPPoE.
+        Set-based (UPDATE ... FROM) y solo escribe las filas cuyo vínculo cambió; si ni
+        subscribers ni connections cambiaron de generación desde el último cruce, no hace nada.
+        """
+        t0 = time.perf_counter()
+        generaciones = f"{self.get_generation('subscribers')}:{self.get_generation('connections')}"
+        previas = self.get_state("match_connections")
+        if previas == generaciones:
+            config.logger.info(f"[SYNC] match_connections: sin cambios desde la generación {generaciones}.")
+            return 0
+
+        # Primera conexión (orden de carga) por PPPoE, igual que la subconsulta original.
+        # Con MIN(rowid) las columnas sueltas salen de esa fila; el GROUP BY recorre idx_connections_pppoe.
+        self.cursor.execute("""
+            UPDATE subscribers
+            SET node_id = m.node_id, connection_id = m.connection_id
+            FROM (
+                SELECT pppoe_username, node_id, connection_id, MIN(rowid)
+                FROM connections
+                WHERE pppoe_username IS NOT NULL
+                GROUP BY pppoe_username
+            ) AS m
+            WHERE m.pppoe_username = subscribers.pppoe_username
+              AND (subscribers.node_id IS NOT m.node_id OR subscribers.connection_id IS NOT m.connection_id)
+        """)
+        vinculadas = self.cursor.rowcount
+
+        # ONUs que perdieron su conexión. Solo puede pasarle a una ONU cuya conexión se dio
+        # de baja o cambió, o a la que le cambió el PPPoE: con el cruce anterior a mano, se
+        # miran solo esas (claves de sync_changelog de las generaciones nuevas), no todas.
+        alcance, params = "", {}
+        if previas:
+            params["gen_s"], params["gen_c"] = (int(g) for g in previas.split(":"))
+            alcance = """
+              AND rowid IN (
+                  SELECT rowid FROM subscribers WHERE connection_id IN (
+                      SELECT clave FROM sync_changelog WHERE tabla = 'connections' AND generacion > :gen_c AND op != 'alta'
+                  )
+                  UNION
+                  SELECT rowid FROM subscribers WHERE unique_external_id IN (
+                      SELECT clave FROM sync_changelog WHERE tabla = 'subscribers' AND generacion > :gen_s AND op = 'modificacion'
+                  )
+              )"""
+        self.cursor.execute(f"""
+            UPDATE subscribers SET node_id = NULL, connection_id = NULL
+            WHERE (node_id IS NOT NULL OR connection_id IS NOT NULL)
+              AND NOT EXISTS (SELECT 1 FROM connections c WHERE c.pppoe_username = subscribers.pppoe_username)
+              {alcance}
+        """, params)
+        desvinculadas = self.cursor.rowcount
+
+        self.set_state("match_connections", generaciones)
         self.commit()
+        config.logger.info(
+            f"[SYNC] match_connections: {vinculadas} vinculadas, {desvinculadas} desvinculadas "
+            f"en {time.perf_counter() - t0:.3f}s (generación {generaciones})."
+        )
+        return vinculadas + desvinculadas
+
+    def get_state(self, clave: str):
+        self.cursor.execute("SELECT valor FROM sync_state WHERE clave = ?", (clave,))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def set_state(self, clave: str, valor):
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO sync_state (clave, valor, actualizado) VALUES (?, ?, ?)",
+            (clave, valor, datetime.now())
+        )
     
     def log_sync_status(self, fuente: str, estado: str, detalle: str = ""):
         self.cursor.execute("INSERT INTO sync_status (fuente, ultima_actualizacion, estado, detalle) VALUES (?, ?, ?, ?)", (fuente, datetime.now(), estado, detalle))
         self.commit()
 
-    # ------------------ BÚSQUEDA (CON FILTRO DE DUPLICADOS) ------------------
-    def search_client(self, query_str: str) -> list:
-        term = f"%{query_str}%"
-        
-        # 1. ISPCube (La fuente de verdad) - Usamos c.direccion (instalación)
-        sql_isp = """
-        SELECT 
-            c.pppoe_username as pppoe, 
-            cl.name as nombre, 
-            c.direccion as direccion, 
-            cl.id as id, 
-            'ispcube' as origen
-        FROM clientes cl
-        JOIN connections c ON cl.id = c.customer_id
-        WHERE cl.name LIKE ? OR c.direccion LIKE ? OR c.pppoe_username LIKE ? OR cl.doc_number LIKE ?
+    # ------------------ TELEMETRÍA DEL SYNC ------------------
+    def log_sync_run(self, inicio: datetime, segundos: float, etapas: list, keep: int = None) -> int:
         """
-        
-        # 2. Mikrotik (Datos técnicos crudos)
-        sql_mk = """
-        SELECT 
-            name as pppoe, 
-            'No Vinculado' as nombre, 
-            CASE WHEN comment IS NOT NULL AND comment != '' THEN 'MK: ' || comment ELSE 'Sin Datos' END as direccion,
-            0 as id, 
-            'mikrotik' as origen
-        FROM ppp_secrets
-        WHERE name LIKE ? OR last_caller_id LIKE ?
+        Guarda una corrida del sync con una fila por etapa (dicts con las columnas de
+        sync_run_stages) y poda las corridas más viejas que las últimas `keep`.
+        """
+        keep = config.SYNC_TELEMETRY_KEEP if keep is None else keep
+        resultados = {e["resultado"] for e in etapas}
+        resultado = "ok" if resultados <= {"ok", "sin_datos"} else ("error" if resultados == {"error"} else "parcial")
+        self.cursor.execute(
+            "INSERT INTO sync_runs (inicio, fin, segundos, resultado) VALUES (?, ?, ?, ?)",
+            (inicio.isoformat(timespec="seconds"), datetime.now().isoformat(timespec="seconds"), round(segundos, 3), resultado)
+        )
+        run_id = self.cursor.lastrowid
+        self.cursor.executemany(
+            f"INSERT INTO sync_run_stages (run_id, {', '.join(_STAGE_COLUMNS)}) VALUES (?, {', '.join('?' for _ in _STAGE_COLUMNS)})",
+            [(run_id, *(e.get(col) for col in _STAGE_COLUMNS)) for e in etapas]
+        )
+        if keep:
+            self.cursor.execute("DELETE FROM sync_run_stages WHERE run_id <= ?", (run_id - keep,))
+            self.cursor.execute("DELETE FROM sync_runs WHERE id <= ?", (run_id - keep,))
+        self.commit()
+        return run_id
+
+    def get_sync_runs(self, limit: int = 10) -> list:
+        """Últimas `limit` corridas (de la más nueva a la más vieja), cada una con sus etapas."""
+        self.cursor.execute("SELECT * FROM sync_runs ORDER BY id DESC LIMIT ?", (limit,))
+        corridas = [dict(r) for r in self.cursor.fetchall()]
+        if not corridas:
+            return []
+        por_id = {c["id"]: {**c, "etapas": []} for c in corridas}
+        self.cursor.execute(
+            "SELECT * FROM sync_run_stages WHERE run_id BETWEEN ? AND ? ORDER BY run_id, rowid",
+            (corridas[-1]["id"], corridas[0]["id"])
+        )
+        for fila in self.cursor.fetchall():
+            etapa = dict(fila)
+            por_id[etapa.pop("run_id")]["etapas"].append(etapa)
+        return list(por_id.values())
+
+    # ------------------ BÚSQUEDA (ÍNDICE FTS5) ------------------
+    def rebuild_search_index(self) -> int:
+        """
+        Reconstruye el índice de búsqueda (FTS5 trigram) desde las tablas sincronizadas.
+        Se llama al final del nightly_sync; DELETE + INSERT van en una sola transacción,
+        así que las búsquedas ven el índice viejo hasta el commit.
+        Queda una fila por PPPoE (deduplicado acá, no en cada búsqueda).
+        Si ninguna tabla de origen cambió de generación desde la última vez, no hace nada (devuelve 0).
+        """
+        generaciones = self._source_generations(*_SEARCH_SOURCES)
+        if self.get_state("search_index") == generaciones:
+            config.logger.info(f"[SYNC] Índice de búsqueda: sin cambios desde la generación {generaciones}.")
+            return 0
+
+        self.cursor.execute("DELETE FROM search_index")
+        for parte in _SEARCH_INSERTS:
+            self.cursor.execute(parte.format(**_filtros(parcial=False)))
+        self.cursor.execute("DELETE FROM search_keys")
+        self.cursor.execute(_SEARCH_KEYS_SQL.format(filtro=""))
+
+        self.cursor.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+        self.cursor.execute("SELECT COUNT(*) FROM search_index")
+        total = self.cursor.fetchone()[0]
+        self._bump_generation("search_index", total)
+        self.set_state("search_index", generaciones)
+        self.commit()
+        return total
+
+    def search_client(self, query_str: str, limit: int = 50, offset: int = 0) -> list:
+        """Búsqueda paginada por offset (compatibilidad). Para paginar conviene search_page."""
+        return self._search(query_str, limit, offset=offset)[0]
+
+    def search_page(self, query_str: str, limit: int = 50, cursor: str = None) -> tuple:
+        """
+        Devuelve (resultados, cursor_siguiente); el cursor es None en la última página.
+        Orden: PPPoE o DNI exacto, después prefijo (PPPoE, DNI o nombre), después relevancia.
+        El cursor guarda la clave de orden de la última fila (keyset), así la página N
+        cuesta lo mismo que la primera. Lanza ValueError si el cursor es inválido o vencido.
         """
+        return self._search(query_str, limit, cursor=_decode_cursor(cursor) if cursor else None)
+
+    def _search(self, query_str: str, limit: int, offset: int = 0, cursor: dict = None) -> tuple:
+        try:
+            self.cursor.execute("SELECT 1 FROM search_index LIMIT 1")
+            sin_indice = self.cursor.fetchone() is None  # todavía no corrió el sync
+        except sqlite3.OperationalError:
+            sin_indice = True  # SQLite sin FTS5/trigram
+        if sin_indice or (cursor and "o" in cursor):
+            return self._search_like_page(query_str, limit, cursor.get("o", 0) if cursor else offset)
+
+        generacion = self.get_generation("search_index")
+        despues = (-1, 0.0, -1)  # nivel -1: antes de cualquier fila
+        if cursor:
+            if cursor.get("g") != generacion:
+                raise ValueError("Cursor vencido: el índice de búsqueda se reconstruyó, repetir la búsqueda.")
+            despues = tuple(cursor["k"])
+
+        # Minúsculas como LOWER() de SQLite (solo ASCII), que es con lo que se arman las claves de search_keys
+        q = "".join(c.lower() if c.isascii() else c for c in query_str.strip())
+        frase = '"' + query_str.replace('"', '""') + '"'
+        params = {
+            # Frase entre comillas: el tokenizer trigram la resuelve como búsqueda por substring
+            "match": frase,
+            "q": q,
+            # Cota superior del rango de claves que empiezan con q (U+10FFFF es el mayor carácter)
+            "q_fin": q + "\U0010ffff",
+            "nivel": despues[0], "score": despues[1], "rid": despues[2],
+            "limit": limit + 1, "offset": offset, "max_hits": config.SEARCH_MAX_HITS,
+        }
+        try:
+            self.cursor.execute(_SEARCH_SQL, params)
+        except sqlite3.OperationalError:
+            return self._search_like_page(query_str, limit, offset)
+        filas = self.cursor.fetchall()
+
+        siguiente = None
+        if len(filas) > limit:
+            ultima = filas[limit - 1]
+            siguiente = _encode_cursor({"g": generacion, "k": [ultima["nivel"], ultima["score"], ultima["rid"]]})
+        return [{k: r[k] for k in ("pppoe", "nombre", "direccion", "id", "origen")} for r in filas[:limit]], siguiente
 
-        # 3. SmartOLT
-        sql_olt = """
-        SELECT 
-            pppoe_username as pppoe, 
-            'No Vinculado' as nombre, 
-            'OLT SN: ' || sn as direccion,
-            0 as id, 
-            'smartolt' as origen
+    def _search_like_page(self, query_str: str, limit: int, offset: int) -> tuple:
+        rows = self._search_client_like(query_str, limit + 1, offset)
+        siguiente = _encode_cursor({"o": offset + limit}) if len(rows) > limit else None
+        return rows[:limit], siguiente
+
+    # Búsqueda clásica con LIKE (fallback si no hay índice FTS5)
+    def _search_client_like(self, query_str: str, limit: int = 50, offset: int = 0) -> list:
+        # ISPCube primero (la fuente de verdad, con c.direccion de instalación); Mikrotik y
+        # SmartOLT solo si el PPPoE no salió ya de ISPCube. El filtrado y el corte van en SQL.
+        sql = """
+        WITH isp AS (
+            SELECT c.pppoe_username AS pppoe, cl.name AS nombre, c.direccion AS direccion, cl.id AS id, 'ispcube' AS origen
+            FROM clientes cl
+            JOIN connections c ON cl.id = c.customer_id
+            WHERE cl.name LIKE :t OR c.direccion LIKE :t OR c.pppoe_username LIKE :t OR cl.doc_number LIKE :t
+        )
+        SELECT * FROM isp
+        UNION ALL
+        SELECT
+            name, 'No Vinculado',
+            CASE WHEN MAX(comment) IS NOT NULL AND MAX(comment) != '' THEN 'MK: ' || MAX(comment) ELSE 'Sin Datos' END,
+            0, 'mikrotik'
+        FROM ppp_secrets
+        WHERE (name LIKE :t OR last_caller_id LIKE :t)
+          AND name NOT IN (SELECT pppoe FROM isp WHERE pppoe IS NOT NULL)
+        GROUP BY name
+        UNION ALL
+        SELECT pppoe_username, 'No Vinculado', 'OLT SN: ' || sn, 0, 'smartolt'
         FROM subscribers
-        WHERE pppoe_username LIKE ? OR sn LIKE ?
-        LIMIT 50
+        WHERE (pppoe_username LIKE :t OR sn LIKE :t)
+          AND (pppoe_username IS NULL OR pppoe_username NOT IN (SELECT pppoe FROM isp WHERE pppoe IS NOT NULL))
+        LIMIT :limit OFFSET :offset
         """
-        
-        # Ejecución y Filtrado
-        self.cursor.execute(sql_isp, (term, term, term, term))
-        rows_isp = [dict(r) for r in self.cursor.fetchall()]
-        
-        # Guardamos los PPPoEs que ya encontramos en ISPCube para no repetirlos
-        pppoes_encontrados = set(r['pppoe'] for r in rows_isp)
-        
-        self.cursor.execute(sql_mk, (term, term))
-        rows_mk = [dict(r) for r in self.cursor.fetchall()]
-        
-        # Solo agregamos el de Mikrotik si NO está ya en la lista de ISPCube
-        clean_mk = [r for r in rows_mk if r['pppoe'] not in pppoes_encontrados]
+        self.cursor.execute(sql, {"t": f"%{query_str}%", "limit": limit, "offset": offset})
+        return [dict(r) for r in self.cursor.fetchall()]
 
-        self.cursor.execute(sql_olt, (term, term))
-        rows_olt = [dict(r) for r in self.cursor.fetchall()]
-        
-        # Lo mismo para SmartOLT
-        clean_olt = [r for r in rows_olt if r['pppoe'] not in pppoes_encontrados]
+    # ------------------ IDENTIDAD PPPoE (TABLA MATERIALIZADA) ------------------
+    def rebuild_pppoe_identity(self) -> int:
+        """
+        Construye pppoe_identity: una fila por usuario PPPoE (clave normalizada) con todo
+        lo que necesita el diagnóstico ya resuelto (cliente, plan, ONU, secret elegido y
+        nodo real). Se carga en staging y se publica con swap, como las tablas del sync.
+        Si ninguna tabla de origen cambió de generación, no se rehace (devuelve 0) y la
+        caché de diagnóstico sigue válida.
+        """
+        generaciones = self._source_generations(*_IDENTITY_SOURCES)
+        if self.get_state("pppoe_identity") == generaciones and self.get_generation("pppoe_identity"):
+            config.logger.info(f"[SYNC] pppoe_identity: sin cambios desde la generación {generaciones}.")
+            return 0
+        self.begin_staging("pppoe_identity")
+        self.cursor.execute(_IDENTITY_SQL.format(table=staging("pppoe_identity"), **_filtros(parcial=False)))
+        total = self.swap_staging("pppoe_identity")["pppoe_identity"]
+        self.set_state("pppoe_identity", generaciones)
+        self.commit()
+        return total
+
+    def derived_generations(self) -> dict:
+        """Generaciones de origen de cada tabla derivada (se pasan a refresh_derived como `previas`)."""
+        return {
+            "pppoe_identity": self._source_generations(*_IDENTITY_SOURCES),
+            "search_index": self._source_generations(*_SEARCH_SOURCES),
+        }
+
+    def refresh_derived(self, pppoes, previas: dict = None) -> dict:
+        """
+        Rehace pppoe_identity y el índice de búsqueda solo para los PPPoE dados (cambios
+        intradía), en una transacción. Con `previas` (derived_generations() de antes de
+        aplicar el cambio): la derivada que estaba al día con ellas queda marcada al día con
+        las actuales, así el próximo nightly no la reconstruye entera por este cambio.
+        """
+        claves = {p.strip().lower() for p in pppoes if p and p.strip()}
+        if not claves:
+            return {"pppoe_identity": 0, "search_index": 0}
+        self.commit()
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS refresh_keys (k TEXT PRIMARY KEY)")
+            self.cursor.execute("DELETE FROM temp.refresh_keys")
+            self.cursor.executemany("INSERT INTO temp.refresh_keys (k) VALUES (?)", ((k,) for k in claves))
+
+            self.cursor.execute("DELETE FROM pppoe_identity WHERE pppoe_key IN (SELECT k FROM temp.refresh_keys)")
+            self.cursor.execute(_IDENTITY_SQL.format(table="pppoe_identity", **_filtros(parcial=True)))
+            identidad = self.cursor.rowcount
+
+            refrescadas = "WHERE LOWER(TRIM(pppoe)) IN (SELECT k FROM temp.refresh_keys)"
+            self.cursor.execute(f"DELETE FROM search_keys WHERE rid IN (SELECT rowid FROM search_index {refrescadas})")
+            self.cursor.execute(f"DELETE FROM search_index {refrescadas}")
+            busqueda = 0
+            for parte in _SEARCH_INSERTS:
+                self.cursor.execute(parte.format(**_filtros(parcial=True)))
+                busqueda += self.cursor.rowcount
+            self.cursor.execute(_SEARCH_KEYS_SQL.format(filtro=refrescadas.replace("pppoe", "s.pppoe")))
+
+            actuales = self.derived_generations()
+            for tabla in ("pppoe_identity", "search_index"):
+                self.cursor.execute(f"SELECT COUNT(*) FROM {tabla}")
+                self._bump_generation(tabla, self.cursor.fetchone()[0])
+                if previas and self.get_state(tabla) == previas[tabla]:
+                    self.set_state(tabla, actuales[tabla])
+            self.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        config.logger.info(f"[SYNC] Derivadas refrescadas para {len(claves)} PPPoE ({identidad} identidades, {busqueda} filas de búsqueda).")
+        return {"pppoe_identity": identidad, "search_index": busqueda}
+
+    def replace_router_secrets(self, router_ip: str, secrets: list) -> dict:
+        """
+        Refresco intradía de un router: sus secrets se reemplazan por `secrets` (tal como
+        los devuelve RouterOS) en una transacción, por diferencia; los de otros routers no
+        se tocan. Con `secrets` vacío no se borra nada (como en el nightly, un router sin
+        secrets cuenta como sin respuesta).
+        Devuelve {"altas", "modificaciones", "bajas", "pppoes"} con los PPPoE que cambiaron.
+        """
+        self.begin_staging("ppp_secrets")
+        self.bulk_insert(staging("ppp_secrets"), (secret_row(s, router_ip) for s in secrets))
+        # Los secrets cargados son todos de router_ip: las bajas se limitan a ese router
+        alcance = f"l.router_ip IN (SELECT router_ip FROM {staging('ppp_secrets')})"
+        cambios = self.merge_staging("ppp_secrets", bajas={"ppp_secrets": alcance})["ppp_secrets"]
+        cambios["pppoes"] = []
+        if cambios["altas"] or cambios["modificaciones"] or cambios["bajas"]:
+            self.cursor.execute(
+                "SELECT DISTINCT pppoe_key FROM sync_changelog WHERE tabla = 'ppp_secrets' AND generacion = ? AND pppoe_key IS NOT NULL",
+                (self.get_generation("ppp_secrets"),)
+            )
+            cambios["pppoes"] = [row[0] for row in self.cursor.fetchall()]
+        return cambios
+
+    def get_staged_customer_ids(self) -> list:
+        """Ids de los clientes cargados en staging (antes de publicarlos)."""
+        self.cursor.execute(f"SELECT id FROM {staging('clientes')}")
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def get_pppoes_for_customers(self, customer_ids) -> list:
+        """PPPoE de las conexiones de esos clientes (para refrescar sus derivadas tras un delta)."""
+        self.cursor.execute(
+            "SELECT DISTINCT pppoe_username FROM connections WHERE customer_id IN (SELECT value FROM json_each(?)) AND pppoe_username IS NOT NULL",
+            (json.dumps(list(customer_ids)),)
+        )
+        return [row[0] for row in self.cursor.fetchall()]
 
-        return rows_isp + clean_mk + clean_olt
-    #Consultar nodo por pppoe
-    # 
     def get_router_for_pppoe(self, pppoe_user: str):
         """
         Busca la IP del router basándose en los Secrets sincronizados de Mikrotik.
@@ -127,15 +828,11 @@ class Database:
         Ventaja: Encuentra el router incluso si el cliente figura como "No Vinculado"
         o "Desconocido" en el sistema de gestión, siempre que exista técnicamente.
         """
-        query = """
-        SELECT s.router_ip, n.puerto
-        FROM ppp_secrets s
-        LEFT JOIN nodes n ON s.router_ip = n.ip_address
-        WHERE LOWER(TRIM(s.name)) = LOWER(TRIM(?))
-        LIMIT 1
-        """
-        # Agregamos LOWER/TRIM por seguridad, para hacer la búsqueda insensible a mayúsculas
-        self.cursor.execute(query, (pppoe_user,))
+        # LOWER/TRIM sobre el parámetro: la búsqueda es insensible a mayúsculas y usa la PK
+        self.cursor.execute(
+            "SELECT router_ip, router_puerto FROM pppoe_identity WHERE pppoe_key = LOWER(TRIM(?)) AND router_ip IS NOT NULL",
+            (pppoe_user,)
+        )
         row = self.cursor.fetchone()
         
         if row:
@@ -143,99 +840,178 @@ class Database:
             # row[1] = puerto (desde nodes, o None si no macheó)
             return row[0], row[1]
         return None
-    
+
+    def get_secret(self, pppoe_user: str, router_ip: str = None):
+        """
+        Secret sincronizado del usuario (el de router_ip si está en varios) con la misma
+        forma que lo devuelve el router: claves de RouterOS y sin los campos vacíos.
+        """
+        self.cursor.execute(
+            """
+            SELECT name, profile, service, last_caller_id, comment, last_logged_out
+            FROM ppp_secrets WHERE name = ?
+            ORDER BY router_ip = ? DESC LIMIT 1
+            """,
+            (pppoe_user, router_ip)
+        )
+        row = self.cursor.fetchone()
+        if not row:
+            return None
+        claves = ("name", "profile", "service", "last-caller-id", "comment", "last-logged-out")
+        return {clave: valor for clave, valor in zip(claves, row) if valor is not None}
+
+    def get_routers_for_pppoes(self, pppoe_users) -> dict:
+        """
+        Lo mismo que get_router_for_pppoe para muchos usuarios en una sola consulta:
+        {usuario pedido: (router_ip, puerto)}. Los que no están quedan afuera.
+        """
+        self.cursor.execute(
+            """
+            SELECT j.value, p.router_ip, p.router_puerto
+            FROM json_each(?) j
+            JOIN pppoe_identity p ON p.pppoe_key = LOWER(TRIM(j.value))
+            WHERE p.router_ip IS NOT NULL
+            """,
+            (json.dumps(list(pppoe_users)),)
+        )
+        return {row[0]: (row[1], row[2]) for row in self.cursor.fetchall()}
+
     # ------------------ DIAGNÓSTICO ------------------
     def get_diagnosis(self, pppoe_user: str) -> dict:
-        # 1. Datos ISPCube
-        sql_admin = """
-        SELECT s.unique_external_id, s.pppoe_username, s.sn AS onu_sn, s.mode as Modo, s.olt_name AS OLT,
-                n.name AS nodo_nombre, n.ip_address AS nodo_ip, n.puerto AS puerto, p.name AS plan,
-                c.direccion AS direccion, l.name AS cliente_nombre
-        FROM connections c
-        JOIN clientes l ON c.customer_id = l.id
-        LEFT JOIN subscribers s ON c.pppoe_username = s.pppoe_username
-        LEFT JOIN nodes n ON c.node_id = n.node_id
-        LEFT JOIN plans p ON c.plan_id = p.plan_id
-        WHERE c.pppoe_username = ?
-        """
-        self.cursor.execute(sql_admin, (pppoe_user,))
-        row_admin = self.cursor.fetchone()
-
-        # 2. Datos Técnicos
-        self.cursor.execute("SELECT router_ip, last_caller_id, comment FROM ppp_secrets WHERE name = ?", (pppoe_user,))
-        secrets = self.cursor.fetchall()
-
-        selected_secret = None
-        if row_admin and row_admin['nodo_ip']:
-            target_ip = row_admin['nodo_ip']
-            for sec in secrets:
-                if sec['router_ip'] == target_ip:
-                    selected_secret = sec
-                    break
-        
-        if not selected_secret and secrets:
-            selected_secret = secrets[0]
-
-        diagnosis = {}
-        if row_admin:
-            diagnosis = dict(row_admin)
-            if selected_secret:
-                diagnosis['mac'] = selected_secret['last_caller_id']
-                real_ip = selected_secret['router_ip']
-                if real_ip and real_ip != diagnosis['nodo_ip']:
-                    self.cursor.execute("SELECT name, ip_address, puerto FROM nodes WHERE ip_address = ?", (real_ip,))
-                    real_node = self.cursor.fetchone()
-                    if real_node:
-                        diagnosis.update({"nodo_nombre": real_node['name'], "nodo_ip": real_node['ip_address'], "puerto": real_node['puerto']})
-                    else:
-                        diagnosis.update({"nodo_nombre": f"Router {real_ip}", "nodo_ip": real_ip, "puerto": None})
-            return diagnosis
-
-        # Caso No Vinculado
-        self.cursor.execute("SELECT * FROM subscribers WHERE pppoe_username = ?", (pppoe_user,))
-        sub_row = self.cursor.fetchone()
-
-        if not sub_row and not selected_secret:
-             return {"error": f"Cliente {pppoe_user} no encontrado."}
-
-        diagnosis = {
-            "cliente_nombre": "No Vinculado", "direccion": "N/A", "plan": "N/A", "pppoe_username": pppoe_user,
-            "onu_sn": "N/A", "Modo": "N/A", "OLT": "N/A", "nodo_nombre": "Desconocido", "nodo_ip": None,
-            "puerto": None, "unique_external_id": None, "mac": None
-        }
-        if sub_row:
-             diagnosis.update({"unique_external_id": sub_row['unique_external_id'], "onu_sn": sub_row['sn'], "OLT": sub_row['olt_name'], "Modo": sub_row['mode']})
-        if selected_secret:
-            diagnosis['mac'] = selected_secret['last_caller_id']
-            if selected_secret['comment']: diagnosis['cliente_nombre'] += f" ({selected_secret['comment']})"
-            real_ip = selected_secret['router_ip']
-            if real_ip:
-                self.cursor.execute("SELECT name, ip_address, puerto FROM nodes WHERE ip_address = ?", (real_ip,))
-                node_row = self.cursor.fetchone()
-                if node_row:
-                    diagnosis.update({"nodo_nombre": node_row['name'], "nodo_ip": node_row['ip_address'], "puerto": node_row['puerto']})
-                else:
-                    diagnosis.update({"nodo_nombre": f"Router {real_ip}", "nodo_ip": real_ip, "puerto": None})
-
-        return diagnosis
+        # Lectura por PK sobre pppoe_identity (el cruce ISPCube/Mikrotik/SmartOLT se hace en el sync)
+        self.cursor.execute("""
+        SELECT unique_external_id, pppoe_username, onu_sn, Modo, OLT, nodo_nombre, nodo_ip, puerto,
+               plan, direccion, cliente_nombre, mac
+        FROM pppoe_identity
+        WHERE pppoe_key = LOWER(TRIM(?))
+        """, (pppoe_user,))
+        row = self.cursor.fetchone()
+        if not row:
+            return {"error": f"Cliente {pppoe_user} no encontrado."}
+        return dict(row)
 
     def commit(self): self.conn.commit()
     def close(self): self.conn.close()
 
-# ------------------ INIT DB ------------------
-def init_db():
-    conn = sqlite3.connect(config.DB_PATH)
-    cursor = conn.cursor()
-    
-    # ... (Otras tablas iguales) ...
-    cursor.execute("CREATE TABLE IF NOT EXISTS subscribers (unique_external_id TEXT PRIMARY KEY, pppoe_username TEXT, sn TEXT, olt_name TEXT, olt_id TEXT, board TEXT, port TEXT, onu TEXT, onu_type_id TEXT, mode TEXT, node_id TEXT, connection_id TEXT, vlan TEXT)")
-    cursor.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, name TEXT, ip_address TEXT, puerto TEXT)")
-    cursor.execute("CREATE TABLE IF NOT EXISTS plans (plan_id TEXT PRIMARY KEY, name TEXT, speed TEXT, description TEXT)")
-    cursor.execute("CREATE TABLE IF NOT EXISTS connections (connection_id TEXT PRIMARY KEY, pppoe_username TEXT, customer_id TEXT, node_id TEXT, plan_id TEXT, direccion TEXT)")
-    
+# ------------------ POOL DE LECTURA ------------------
+_read_local = threading.local()
+
+_SNAPSHOT_POINTER = "CURRENT"
+_snapshot_lock = threading.Lock()
+_snapshot_actual = {"mtime": None, "path": None}
+
+def current_snapshot(directory=config.DB_SNAPSHOT_DIR):
+    """Ruta del último snapshot publicado (None si todavía no hay). Solo relee CURRENT si cambió."""
+    puntero = os.path.join(directory, _SNAPSHOT_POINTER)
+    try:
+        mtime = os.stat(puntero).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _snapshot_lock:
+        if mtime != _snapshot_actual["mtime"]:
+            with open(puntero) as f:
+                _snapshot_actual["path"] = os.path.join(directory, f.read().strip())
+            _snapshot_actual["mtime"] = mtime
+        return _snapshot_actual["path"]
+
+def get_read_db() -> Database:
+    """
+    Devuelve la conexión de solo lectura del thread actual, creándola la primera vez.
+    Los workers de la API la reutilizan entre requests: no se debe cerrar.
+    Con WAL, el nightly_sync escribe sin bloquear a estos lectores.
+    En modo snapshot se abre el último snapshot inmutable; cuando el sync publica
+    otro, cada thread cambia de archivo en su próxima consulta (sin reiniciar).
+    """
+    snapshot = current_snapshot() if config.DB_SNAPSHOT_MODE else None
+    path = snapshot or config.DB_PATH
+    db = getattr(_read_local, "db", None)
+    if db is None or db.path != path:
+        if db is not None:
+            db.close()
+        db = Database(path, readonly=True, immutable=snapshot is not None)
+        _read_local.db = db
+    return db
+
+# ------------------ CACHÉ DE DIAGNÓSTICO ------------------
+class DiagnosisCache:
+    """
+    LRU acotado con la base del diagnóstico (get_diagnosis) por usuario PPPoE.
+    Cada lectura compara la generación de pppoe_identity: cuando el nightly_sync
+    publica una nueva, la caché se vacía sola. Guarda también los "no encontrado".
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generacion = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidaciones = 0
+
+    def get(self, db: "Database", pppoe_user: str) -> dict:
+        # La generación se lee antes que el dato: si el sync publica en el medio,
+        # el valor queda etiquetado con la generación vieja y se descarta en la próxima lectura
+        generacion = db.get_generation("pppoe_identity")
+        clave = pppoe_user.strip().lower()
+        with self._lock:
+            if generacion != self._generacion:
+                if self._generacion is not None:
+                    self.invalidaciones += 1
+                self._data.clear()
+                self._generacion = generacion
+            base = self._data.get(clave)
+            if base is not None:
+                self._data.move_to_end(clave)
+                self.hits += 1
+                return dict(base)
+            self.misses += 1
+
+        base = db.get_diagnosis(pppoe_user)
+        with self._lock:
+            if generacion == self._generacion and self.maxsize > 0:
+                self._data[clave] = base
+                self._data.move_to_end(clave)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return dict(base)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generacion = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "generacion": self._generacion,
+                "invalidaciones": self.invalidaciones,
+            }
+
+diagnosis_cache = DiagnosisCache(config.DIAG_CACHE_SIZE)
+
+def get_cached_diagnosis(pppoe_user: str) -> dict:
+    """get_diagnosis a través de la caché compartida (solo datos locales; lo vivo no se cachea)."""
+    return diagnosis_cache.get(get_read_db(), pppoe_user)
+
+# ------------------ ESQUEMA ------------------
+# Tablas que el nightly_sync carga por staging + swap. Las plantillas llevan {table}
+# para poder crear la copia "<tabla>__staging" con el mismo esquema.
+_SCHEMAS = {
+    # Las claves de join llevan el mismo tipo en ambos lados (ids de ISPCube = INTEGER):
+    # connections.customer_id -> clientes.id, node_id -> nodes, plan_id -> plans
+    "subscribers": "CREATE TABLE IF NOT EXISTS {table} (unique_external_id TEXT PRIMARY KEY, pppoe_username TEXT, sn TEXT, olt_name TEXT, olt_id TEXT, board TEXT, port TEXT, onu TEXT, onu_type_id TEXT, mode TEXT, node_id INTEGER, connection_id TEXT, vlan TEXT, row_hash INTEGER)",
+    "nodes": "CREATE TABLE IF NOT EXISTS {table} (node_id INTEGER PRIMARY KEY, name TEXT, ip_address TEXT, puerto TEXT, row_hash INTEGER)",
+    "plans": "CREATE TABLE IF NOT EXISTS {table} (plan_id INTEGER PRIMARY KEY, name TEXT, speed TEXT, description TEXT, row_hash INTEGER)",
+    "connections": "CREATE TABLE IF NOT EXISTS {table} (connection_id TEXT PRIMARY KEY, pppoe_username TEXT, customer_id INTEGER, node_id INTEGER, plan_id INTEGER, direccion TEXT, row_hash INTEGER)",
     # TRIPLE COMILLA para evitar errores
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS clientes (
+    "clientes": """
+        CREATE TABLE IF NOT EXISTS {table} (
             id INTEGER PRIMARY KEY, code TEXT, name TEXT, tax_residence TEXT, type TEXT, 
             tax_situation_id INTEGER, identification_type_id INTEGER, doc_number TEXT, 
             auto_bill_sending INTEGER, auto_payment_recipe_sending INTEGER, nickname TEXT, 
@@ -248,28 +1024,506 @@ def init_db():
             second_expiration_date TEXT, next_month_corresponding_date INTEGER, start_date TEXT, 
             perception_id INTEGER, phonekey TEXT, debt TEXT, duedebt TEXT, speed_limited INTEGER, 
             status TEXT, enable_date TEXT, block_date TEXT, created_at TEXT, updated_at TEXT, 
-            deleted_at TEXT, temporary INTEGER
+            deleted_at TEXT, temporary INTEGER, row_hash INTEGER
         )
-    """)
-    
-    cursor.execute("CREATE TABLE IF NOT EXISTS clientes_emails (id INTEGER PRIMARY KEY AUTOINCREMENT, customer_id INTEGER NOT NULL, email TEXT NOT NULL, FOREIGN KEY (customer_id) REFERENCES clientes(id))")
-    cursor.execute("CREATE TABLE IF NOT EXISTS clientes_telefonos (id INTEGER PRIMARY KEY AUTOINCREMENT, customer_id INTEGER NOT NULL, number TEXT NOT NULL, FOREIGN KEY (customer_id) REFERENCES clientes(id))")
-    cursor.execute("CREATE TABLE IF NOT EXISTS sync_status (id INTEGER PRIMARY KEY AUTOINCREMENT, fuente TEXT NOT NULL, ultima_actualizacion TEXT NOT NULL, estado TEXT NOT NULL, detalle TEXT)")
-    
+    """,
+    "clientes_emails": "CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, customer_id INTEGER NOT NULL, email TEXT NOT NULL, FOREIGN KEY (customer_id) REFERENCES clientes(id))",
+    "clientes_telefonos": "CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, customer_id INTEGER NOT NULL, number TEXT NOT NULL, FOREIGN KEY (customer_id) REFERENCES clientes(id))",
     # PK COMPUESTA para soportar usuarios en múltiples nodos
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS ppp_secrets (
-            name TEXT, password TEXT, profile TEXT, service TEXT, last_caller_id TEXT, comment TEXT, router_ip TEXT, last_logged_out TEXT,
+    "ppp_secrets": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            name TEXT, password TEXT, profile TEXT, service TEXT, last_caller_id TEXT, comment TEXT, router_ip TEXT, last_logged_out TEXT, row_hash INTEGER,
             PRIMARY KEY (name, router_ip)
         )
+    """,
+}
+
+# Tabla derivada: identidad PPPoE resuelta (clave = LOWER(TRIM(usuario)))
+_SCHEMAS["pppoe_identity"] = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        pppoe_key TEXT PRIMARY KEY, vinculado INTEGER NOT NULL,
+        unique_external_id TEXT, pppoe_username TEXT, onu_sn TEXT, Modo TEXT, OLT TEXT,
+        nodo_nombre TEXT, nodo_ip TEXT, puerto TEXT, plan TEXT, direccion TEXT, cliente_nombre TEXT, mac TEXT,
+        router_ip TEXT, router_puerto TEXT
+    ) WITHOUT ROWID
+"""
+
+# Resuelve la identidad de cada PPPoE con las mismas reglas que tenía get_diagnosis:
+# - adm: conexión + cliente de ISPCube (vinculado), con su nodo y plan
+# - sec: secret preferido (el del nodo de ISPCube; si no, el primero cargado)
+# - si el secret vive en otro router, el nodo real es ese (o "Router <ip>" si no está en nodes)
+# - los no vinculados llevan "N/A" / "No Vinculado (<comment>)" / "Desconocido"
+_IDENTITY_SQL = """
+INSERT INTO {table} (
+    pppoe_key, vinculado, unique_external_id, pppoe_username, onu_sn, Modo, OLT,
+    nodo_nombre, nodo_ip, puerto, plan, direccion, cliente_nombre, mac, router_ip, router_puerto
+)
+WITH
+adm AS (
+    SELECT LOWER(TRIM(c.pppoe_username)) AS k, c.pppoe_username AS pppoe, l.name AS cliente_nombre, c.direccion,
+           p.name AS plan, n.name AS nodo_nombre, n.ip_address AS nodo_ip, n.puerto,
+           ROW_NUMBER() OVER (PARTITION BY LOWER(TRIM(c.pppoe_username)) ORDER BY c.rowid) AS rn
+    FROM connections c
+    JOIN clientes l ON c.customer_id = l.id
+    LEFT JOIN nodes n ON c.node_id = n.node_id
+    LEFT JOIN plans p ON c.plan_id = p.plan_id
+    WHERE TRIM(c.pppoe_username) != '' {filtro_c}
+),
+onu AS (
+    SELECT LOWER(TRIM(pppoe_username)) AS k, pppoe_username AS pppoe, unique_external_id, sn, olt_name, mode,
+           ROW_NUMBER() OVER (PARTITION BY LOWER(TRIM(pppoe_username)) ORDER BY rowid) AS rn
+    FROM subscribers o
+    WHERE TRIM(pppoe_username) != '' {filtro_o}
+),
+sec AS (
+    SELECT LOWER(TRIM(s.name)) AS k, s.name AS pppoe, s.router_ip, s.last_caller_id, s.comment,
+           ROW_NUMBER() OVER (
+               PARTITION BY LOWER(TRIM(s.name))
+               ORDER BY (a.nodo_ip IS NOT NULL AND s.router_ip = a.nodo_ip) DESC, s.rowid
+           ) AS rn
+    FROM ppp_secrets s
+    LEFT JOIN adm a ON a.k = LOWER(TRIM(s.name)) AND a.rn = 1
+    WHERE TRIM(s.name) != '' {filtro_s}
+),
+nod AS (
+    SELECT ip_address, name, puerto, ROW_NUMBER() OVER (PARTITION BY ip_address ORDER BY node_id) AS rn
+    FROM nodes
+    WHERE ip_address IS NOT NULL AND ip_address != ''
+),
+claves AS (
+    SELECT k FROM adm UNION SELECT k FROM onu UNION SELECT k FROM sec
+),
+base AS (
+    SELECT ck.k, a.k IS NOT NULL AS vinculado, a.pppoe AS a_pppoe, a.cliente_nombre, a.direccion, a.plan,
+           a.nodo_nombre, a.nodo_ip, a.puerto,
+           o.k IS NOT NULL AS con_onu, o.pppoe AS o_pppoe, o.unique_external_id, o.sn, o.olt_name, o.mode,
+           s.pppoe AS s_pppoe, s.router_ip, s.last_caller_id, s.comment,
+           nd.ip_address AS nd_ip, nd.name AS nd_name, nd.puerto AS nd_puerto,
+           -- el secret está en un router distinto al nodo de ISPCube (o no hay nodo)
+           (s.router_ip IS NOT NULL AND s.router_ip != '' AND (a.nodo_ip IS NULL OR s.router_ip != a.nodo_ip)) AS nodo_real
+    FROM claves ck
+    LEFT JOIN adm a ON a.k = ck.k AND a.rn = 1
+    LEFT JOIN onu o ON o.k = ck.k AND o.rn = 1
+    LEFT JOIN sec s ON s.k = ck.k AND s.rn = 1
+    LEFT JOIN nod nd ON nd.ip_address = s.router_ip AND nd.rn = 1
+)
+SELECT
+    k, vinculado, unique_external_id, COALESCE(a_pppoe, o_pppoe, s_pppoe),
+    CASE WHEN vinculado OR con_onu THEN sn ELSE 'N/A' END,
+    CASE WHEN vinculado OR con_onu THEN mode ELSE 'N/A' END,
+    CASE WHEN vinculado OR con_onu THEN olt_name ELSE 'N/A' END,
+    CASE WHEN nodo_real THEN (CASE WHEN nd_ip IS NOT NULL THEN nd_name ELSE 'Router ' || router_ip END)
+         WHEN vinculado THEN nodo_nombre ELSE 'Desconocido' END,
+    CASE WHEN nodo_real THEN router_ip WHEN vinculado THEN nodo_ip END,
+    CASE WHEN nodo_real THEN nd_puerto WHEN vinculado THEN puerto END,
+    CASE WHEN vinculado THEN plan ELSE 'N/A' END,
+    CASE WHEN vinculado THEN direccion ELSE 'N/A' END,
+    CASE WHEN vinculado THEN cliente_nombre
+         WHEN comment IS NOT NULL AND comment != '' THEN 'No Vinculado (' || comment || ')'
+         ELSE 'No Vinculado' END,
+    last_caller_id,
+    router_ip,
+    nd_puerto
+FROM base
+"""
+
+# Búsqueda rankeada sobre el índice FTS5 (que ya tiene una fila por PPPoE, ver rebuild_search_index).
+# Niveles: 0 = PPPoE o DNI exacto, 1 = prefijo de PPPoE/DNI/nombre, 2 = el resto por bm25.
+# Los niveles 0 y 1 salen de search_keys por rango sobre su índice (el exacto cae dentro
+# del rango del prefijo): entran todos, por amplio que sea el término. SEARCH_MAX_HITS
+# acota solo la cola por bm25, así un término de 3 letras que matchea todo no cuesta más
+# que uno preciso. La página se corta con el keyset (nivel, score, rid) y recién ahí se
+# leen las columnas de las filas devueltas.
+_SEARCH_SQL = """
+WITH claves AS (
+    SELECT rid, MIN(CASE WHEN clave = :q AND campo != 'nombre' THEN 0 ELSE 1 END) AS nivel
+    FROM search_keys
+    WHERE clave >= :q AND clave < :q_fin
+    GROUP BY rid
+),
+cola AS (
+    SELECT rowid AS rid, bm25(search_index, 10.0, 5.0, 10.0, 2.0, 3.0, 3.0) AS score
+    FROM search_index
+    WHERE search_index MATCH :match
+    LIMIT :max_hits
+),
+hits AS (
+    SELECT rid, nivel, 0.0 AS score FROM claves
+    UNION ALL
+    SELECT rid, 2, score FROM cola WHERE rid NOT IN (SELECT rid FROM claves)
+),
+pagina AS (
+    SELECT rid, nivel, score FROM hits
+    WHERE (nivel, score, rid) > (:nivel, :score, :rid)
+    ORDER BY nivel, score, rid
+    LIMIT :limit OFFSET :offset
+)
+SELECT s.pppoe, s.r_nombre AS nombre, s.r_direccion AS direccion, s.cliente_id AS id, s.origen,
+       p.nivel, p.score, p.rid
+FROM pagina p
+JOIN search_index s ON s.rowid = p.rid
+ORDER BY p.nivel, p.score, p.rid
+"""
+
+# Claves de search_keys de las filas del índice de búsqueda (PPPoE, DNI y nombre en
+# minúsculas), para resolver exactos y prefijos sin recorrer el FTS. {filtro}: todas
+# las filas o solo las de temp.refresh_keys.
+_SEARCH_KEYS_SQL = """
+INSERT OR IGNORE INTO search_keys (clave, campo, rid)
+SELECT clave, campo, rid FROM (
+    SELECT LOWER(TRIM(CASE c.campo WHEN 'pppoe' THEN s.pppoe WHEN 'doc' THEN s.doc_number ELSE s.nombre END)) AS clave,
+           c.campo, s.rowid AS rid
+    FROM search_index s
+    CROSS JOIN (SELECT 'pppoe' AS campo UNION ALL SELECT 'doc' UNION ALL SELECT 'nombre') c
+    {filtro}
+)
+WHERE clave != ''
+"""
+
+def _encode_cursor(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Cursor inválido.") from e
+    if not isinstance(data, dict) or not ("o" in data or ("g" in data and len(data.get("k", ())) == 3)):
+        raise ValueError("Cursor inválido.")
+    return data
+
+# Índices por tabla: se recrean con el mismo nombre después de cada swap
+_INDEXES = {
+    "connections": [("idx_connections_pppoe", "pppoe_username")],
+    "subscribers": [("idx_subscribers_pppoe", "pppoe_username"), ("idx_subscribers_connection", "connection_id")],
+    "clientes": [("idx_clientes_name", "name")],
+    "ppp_secrets": [("idx_secrets_lastcaller", "last_caller_id"), ("idx_secrets_name", "name")],
+}
+
+# Columnas que carga el sync (orden de las tuplas de bulk_insert / insert_*)
+COLUMNS = {
+    "subscribers": ("unique_external_id", "sn", "olt_name", "olt_id", "board", "port", "onu", "onu_type_id", "pppoe_username", "mode"),
+    "nodes": ("node_id", "name", "ip_address", "puerto"),
+    "plans": ("plan_id", "name", "speed", "description"),
+    "connections": ("connection_id", "pppoe_username", "customer_id", "node_id", "plan_id", "direccion"),
+    "clientes": (
+        "id", "code", "name", "tax_residence", "type", "tax_situation_id", "identification_type_id", "doc_number",
+        "auto_bill_sending", "auto_payment_recipe_sending", "nickname", "comercial_activity", "address",
+        "between_address1", "between_address2", "city_id", "lat", "lng", "extra1", "extra2", "entity_id",
+        "collector_id", "seller_id", "block", "free", "apply_late_payment_due", "apply_reconnection", "contract",
+        "contract_type_id", "contract_expiration_date", "paycomm", "expiration_type_id", "business_id",
+        "first_expiration_date", "second_expiration_date", "next_month_corresponding_date", "start_date",
+        "perception_id", "phonekey", "debt", "duedebt", "speed_limited", "status", "enable_date", "block_date",
+        "created_at", "updated_at", "deleted_at", "temporary",
+    ),
+    "clientes_emails": ("customer_id", "email"),
+    "clientes_telefonos": ("customer_id", "number"),
+    "ppp_secrets": ("name", "password", "profile", "service", "last_caller_id", "comment", "router_ip", "last_logged_out"),
+}
+
+# Filas del índice de búsqueda, en tres partes. Los {filtro_*} quedan vacíos al reconstruir
+# todo y limitan a temp.refresh_keys cuando se rehacen solo algunos PPPoE (ver _filtros).
+_SEARCH_INSERTS = (
+    # 1. ISPCube (La fuente de verdad) - MAC y SN se indexan para encontrar al cliente por datos técnicos
+    """
+    INSERT INTO search_index (pppoe, nombre, doc_number, direccion, mac, onu_sn, r_nombre, r_direccion, cliente_id, origen)
+    SELECT
+        c.pppoe_username, cl.name, cl.doc_number, c.direccion,
+        (SELECT group_concat(s.last_caller_id, ' ') FROM ppp_secrets s WHERE s.name = c.pppoe_username),
+        (SELECT group_concat(o.sn, ' ') FROM subscribers o WHERE o.pppoe_username = c.pppoe_username),
+        cl.name, c.direccion, cl.id, 'ispcube'
+    FROM clientes cl
+    JOIN connections c ON cl.id = c.customer_id
+    WHERE (c.pppoe_username IS NULL OR c.rowid = (
+        SELECT MIN(c2.rowid) FROM connections c2 JOIN clientes cl2 ON cl2.id = c2.customer_id
+        WHERE c2.pppoe_username = c.pppoe_username
+    )) {filtro_c}
+    """,
+    # 2. Mikrotik - Solo los secrets que no están vinculados a un cliente de ISPCube
+    """
+    INSERT INTO search_index (pppoe, nombre, doc_number, direccion, mac, onu_sn, r_nombre, r_direccion, cliente_id, origen)
+    SELECT
+        s.name, NULL, NULL, NULL, group_concat(s.last_caller_id, ' '),
+        (SELECT group_concat(o.sn, ' ') FROM subscribers o WHERE o.pppoe_username = s.name),
+        'No Vinculado',
+        CASE WHEN s.comment IS NOT NULL AND s.comment != '' THEN 'MK: ' || s.comment ELSE 'Sin Datos' END,
+        0, 'mikrotik'
+    FROM ppp_secrets s
+    WHERE s.name NOT IN (
+        SELECT c.pppoe_username FROM connections c JOIN clientes cl ON cl.id = c.customer_id
+        WHERE c.pppoe_username IS NOT NULL
+    ) {filtro_s}
+    GROUP BY s.name
+    """,
+    # 3. SmartOLT - Lo mismo para las ONUs (si el PPPoE ya salió de Mikrotik, su SN quedó en esa fila)
+    """
+    INSERT INTO search_index (pppoe, nombre, doc_number, direccion, mac, onu_sn, r_nombre, r_direccion, cliente_id, origen)
+    SELECT
+        o.pppoe_username, NULL, NULL, NULL, NULL, group_concat(o.sn, ' '),
+        'No Vinculado', 'OLT SN: ' || group_concat(o.sn, ', '), 0, 'smartolt'
+    FROM subscribers o
+    WHERE (o.pppoe_username IS NULL OR (
+        o.pppoe_username NOT IN (
+            SELECT c.pppoe_username FROM connections c JOIN clientes cl ON cl.id = c.customer_id
+            WHERE c.pppoe_username IS NOT NULL
+        )
+        AND o.pppoe_username NOT IN (SELECT name FROM ppp_secrets WHERE name IS NOT NULL)
+    )) {filtro_o}
+    GROUP BY COALESCE(o.pppoe_username, 'rowid:' || o.rowid)
+    """,
+)
+
+def _filtros(parcial: bool) -> dict:
+    """Condiciones {filtro_*} de _IDENTITY_SQL y _SEARCH_INSERTS: nada, o solo las claves de temp.refresh_keys."""
+    columnas = {"filtro_c": "c.pppoe_username", "filtro_s": "s.name", "filtro_o": "o.pppoe_username"}
+    return {f: f"AND LOWER(TRIM({col})) IN (SELECT k FROM temp.refresh_keys)" if parcial else "" for f, col in columnas.items()}
+
+# Tablas de las que salen las derivadas (si ninguna cambió de generación, no se rehacen)
+_IDENTITY_SOURCES = ("connections", "clientes", "nodes", "plans", "subscribers", "ppp_secrets")
+_SEARCH_SOURCES = ("connections", "clientes", "subscribers", "ppp_secrets")
+
+# Tablas que el sync publica por diferencia (ver Database._apply_diff): clave de cada fila
+_DIFF_KEYS = {
+    "clientes": ("id",),
+    "connections": ("connection_id",),
+    "subscribers": ("unique_external_id",),
+    "ppp_secrets": ("name", "router_ip"),
+    "nodes": ("node_id",),
+    "plans": ("plan_id",),
+    # Sin columnas fuera de la clave: solo altas y bajas (la clave de changelog es "<cliente>@<dato>")
+    "clientes_emails": ("customer_id", "email"),
+    "clientes_telefonos": ("customer_id", "number"),
+}
+
+# Columna con el usuario PPPoE de cada tabla, para consultar el changelog por PPPoE
+_CHANGELOG_PPPOE = {
+    "connections": "pppoe_username",
+    "subscribers": "pppoe_username",
+    "ppp_secrets": "name",
+}
+
+def _row_hash(*valores) -> int:
+    """Hash de contenido de una fila (64 bits con signo: entra en un INTEGER de SQLite)."""
+    return int.from_bytes(hashlib.blake2b(repr(valores).encode(), digest_size=8).digest(), "big", signed=True)
+
+# Columnas de sync_run_stages (además de run_id)
+_STAGE_COLUMNS = (
+    "etapa", "fuente", "inicio", "fin", "segundos", "fetch_segundos", "write_segundos",
+    "filas", "bytes", "reintentos", "resultado", "detalle",
+)
+
+_STAGING_SUFFIX = "__staging"
+
+# Claves de sync_state con el progreso de la corrida en curso (etapas terminadas, páginas, routers)
+_CHECKPOINT_PREFIX = "checkpoint:"
+# Leases entre procesos en sync_state (ej. "lease:nightly" mientras corre el nightly_sync)
+_LEASE_PREFIX = "lease:"
+# Lease que tiene el nightly_sync mientras corre
+NIGHTLY_LEASE = "nightly"
+
+def _dueno_lease() -> str:
+    # Al pedirlo y no al importar: un proceso hijo (fork) no hereda el dueño del padre
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _dueno_vivo(dueno: str) -> bool:
+    """False si el dueño es un proceso de esta máquina que ya no existe (ej. un nightly matado)."""
+    host, _, pid = dueno.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def staging(table: str) -> str:
+    """Nombre de la tabla staging donde el sync carga la próxima generación de <table>."""
+    return f"{table}{_STAGING_SUFFIX}"
+
+@lru_cache(maxsize=None)
+def _insert_sql(table: str) -> str:
+    # Sirve tanto para la tabla viva como para su staging
+    columns = COLUMNS[table.removesuffix(_STAGING_SUFFIX)]
+    return f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+
+def secret_row(secret_data: dict, router_ip: str) -> tuple:
+    """Secret tal como lo devuelve RouterOS -> tupla en el orden de COLUMNS['ppp_secrets']."""
+    return (
+        secret_data.get("name"), secret_data.get("password"), secret_data.get("profile"), secret_data.get("service"),
+        secret_data.get("last-caller-id"), secret_data.get("comment"), router_ip, secret_data.get("last-logged-out")
+    )
+
+def _create_indexes(cursor, table: str):
+    for index_name, columns in _INDEXES.get(table, []):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table}({columns})")
+
+def _migrar_tipos(cursor, table: str) -> bool:
+    """
+    Reconstruye una tabla creada con tipos de columna distintos de los de _SCHEMAS (ej. los
+    ids TEXT de antes de alinear los joins en INTEGER): tabla nueva con el esquema actual,
+    INSERT ... SELECT con CAST, y rename. Las filas se aplican por diferencia, no se
+    reemplazan, así que sin esto la tabla conservaría los tipos viejos para siempre.
+    El row_hash se recalcula con los valores convertidos. Devuelve True si la reconstruyó.
+    """
+    actuales = {fila[1]: fila[2].upper() for fila in cursor.execute(f"PRAGMA table_info({table})")}
+    nueva = f"{table}__migracion"
+    cursor.execute(f"DROP TABLE IF EXISTS {nueva}")
+    cursor.execute(_SCHEMAS[table].format(table=nueva))
+    esperadas = {fila[1]: fila[2].upper() for fila in cursor.execute(f"PRAGMA table_info({nueva})")}
+    distintas = {c for c, tipo in esperadas.items() if c in actuales and actuales[c] != tipo}
+    if not distintas:
+        cursor.execute(f"DROP TABLE {nueva}")
+        return False
+
+    def valor(columna):
+        if columna in distintas and esperadas[columna] == "INTEGER":
+            # Como a_entero() en el sync: lo no numérico (o vacío) queda NULL
+            return (f"CASE WHEN typeof({columna}) = 'integer' THEN {columna} "
+                    f"WHEN TRIM({columna}) != '' AND TRIM({columna}) NOT GLOB '*[^0-9]*' THEN CAST(TRIM({columna}) AS INTEGER) END")
+        return f"CAST({columna} AS {esperadas[columna]})" if columna in distintas else columna
+
+    comunes = [c for c in esperadas if c in actuales and c != "row_hash"]
+    # OR IGNORE: dos ids de texto que dan el mismo entero ('7' y '07') no frenan el arranque
+    cursor.execute(f"INSERT OR IGNORE INTO {nueva} ({', '.join(comunes)}) SELECT {', '.join(map(valor, comunes))} FROM {table}")
+    if "row_hash" in esperadas:
+        cursor.execute(f"UPDATE {nueva} SET row_hash = row_hash({', '.join(COLUMNS[table])})")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {nueva} RENAME TO {table}")
+    _create_indexes(cursor, table)
+    config.logger.info(f"[DB] {table}: columnas {', '.join(sorted(distintas))} migradas al tipo del esquema actual.")
+    return True
+
+# ------------------ INIT DB ------------------
+class LeaseTomado(Exception):
+    """El lease lo tiene otro proceso (ej. otro nightly_sync todavía corriendo)."""
+
+@contextmanager
+def lease(nombre: str, segundos: float = config.SYNC_LEASE_SEC):
+    """
+    Tiene el lease `nombre` mientras dura el bloque. Lo toma, renueva y suelta un thread
+    con su propia conexión, porque el dueño puede estar horas en una etapa. Si lo tiene
+    otro proceso, lanza LeaseTomado sin entrar al bloque.
+    """
+    resultado = {}
+    listo, fin = threading.Event(), threading.Event()
+
+    def sostener():
+        db = Database()
+        try:
+            try:
+                resultado["tomado"] = db.acquire_lease(nombre, segundos)
+            except Exception as e:
+                resultado["error"] = e
+            listo.set()
+            if not resultado.get("tomado"):
+                return
+            while not fin.wait(segundos / 3):
+                try:
+                    db.acquire_lease(nombre, segundos)
+                except sqlite3.Error as e:
+                    # Base ocupada: se reintenta en la próxima vuelta, el lease todavía no venció
+                    config.logger.warning(f"[DB] No se pudo renovar el lease {nombre}: {e}")
+            db.release_lease(nombre)
+        finally:
+            db.close()
+
+    hilo = threading.Thread(target=sostener, name=f"lease-{nombre}", daemon=True)
+    hilo.start()
+    listo.wait()
+    if "error" in resultado:
+        raise resultado["error"]
+    if not resultado["tomado"]:
+        raise LeaseTomado(f"El lease {nombre} lo tiene otro proceso")
+    try:
+        yield
+    finally:
+        fin.set()
+        hilo.join()
+
+def init_db(path=config.DB_PATH):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+
+    # WAL: los lectores de la API no se bloquean mientras el sync escribe
+    cursor.execute("PRAGMA journal_mode = WAL")
+
+    for table, ddl in _SCHEMAS.items():
+        cursor.execute(ddl.format(table=table))
+        _create_indexes(cursor, table)
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS sync_status (id INTEGER PRIMARY KEY AUTOINCREMENT, fuente TEXT NOT NULL, ultima_actualizacion TEXT NOT NULL, estado TEXT NOT NULL, detalle TEXT)")
+    # Generación vigente de cada tabla: se incrementa en cada swap
+    cursor.execute("CREATE TABLE IF NOT EXISTS sync_generations (tabla TEXT PRIMARY KEY, generacion INTEGER NOT NULL, filas INTEGER, actualizado TEXT)")
+    # Estado persistente entre corridas del sync (ej. generaciones del último match_connections)
+    cursor.execute("CREATE TABLE IF NOT EXISTS sync_state (clave TEXT PRIMARY KEY, valor TEXT, actualizado TEXT)")
+    conn.create_function("row_hash", -1, _row_hash, deterministic=True)
+    # Migración: tablas con los tipos de columna viejos (antes del backfill de row_hash,
+    # que tiene que hashear los valores ya convertidos, como los trae el sync)
+    for table in _SCHEMAS:
+        _migrar_tipos(cursor, table)
+    # Migración: tablas creadas antes del hash de contenido
+    for table in ("clientes", "connections", "subscribers", "ppp_secrets", "nodes", "plans"):
+        existentes = [fila[1] for fila in cursor.execute(f"PRAGMA table_info({table})")]
+        if "row_hash" not in existentes:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN row_hash INTEGER")
+            cursor.execute(f"UPDATE {table} SET row_hash = row_hash({', '.join(COLUMNS[table])})")
+
+    # Cambios aplicados por el sync (altas/bajas/modificaciones), consultables por PPPoE
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_changelog (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT NOT NULL, tabla TEXT NOT NULL, generacion INTEGER NOT NULL,
+            op TEXT NOT NULL, clave TEXT, pppoe_key TEXT, columnas TEXT
+        )
     """)
-    
-    # Índices
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_connections_pppoe ON connections(pppoe_username)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_subscribers_pppoe ON subscribers(pppoe_username)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_clientes_name ON clientes(name)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_secrets_lastcaller ON ppp_secrets(last_caller_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_secrets_name ON ppp_secrets(name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_changelog_pppoe ON sync_changelog(pppoe_key, fecha)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_changelog_clave ON sync_changelog(tabla, clave, fecha)")
+
+    # Telemetría: una fila por corrida del sync y una por etapa de cada corrida
+    cursor.execute("CREATE TABLE IF NOT EXISTS sync_runs (id INTEGER PRIMARY KEY AUTOINCREMENT, inicio TEXT NOT NULL, fin TEXT, segundos REAL, resultado TEXT)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_run_stages (
+            run_id INTEGER NOT NULL, etapa TEXT NOT NULL, fuente TEXT, inicio TEXT, fin TEXT,
+            segundos REAL, fetch_segundos REAL, write_segundos REAL,
+            filas INTEGER, bytes INTEGER, reintentos INTEGER, resultado TEXT, detalle TEXT,
+            PRIMARY KEY (run_id, etapa)
+        )
+    """)
+
+    # Índice de búsqueda (FTS5 trigram): columnas indexadas + columnas de respuesta (r_*)
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                pppoe, nombre, doc_number, direccion, mac, onu_sn,
+                r_nombre UNINDEXED, r_direccion UNINDEXED, cliente_id UNINDEXED, origen UNINDEXED,
+                tokenize = 'trigram'
+            )
+        """)
+        # Exactos y prefijos de la búsqueda por índice (ver _SEARCH_SQL)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS search_keys (
+                clave TEXT NOT NULL, campo TEXT NOT NULL, rid INTEGER NOT NULL,
+                PRIMARY KEY (clave, campo, rid)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_keys_rid ON search_keys(rid)")
+        # Migración: índice de búsqueda ya construido antes de que existiera search_keys
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM search_keys), EXISTS (SELECT 1 FROM search_index)")
+        if cursor.fetchone() == (0, 1):
+            cursor.execute(_SEARCH_KEYS_SQL.format(filtro=""))
+    except sqlite3.OperationalError as e:
+        config.logger.warning(f"[DB] FTS5 trigram no disponible, la búsqueda usa LIKE: {e}")
     
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
+
+    # Migración: si pppoe_identity nunca se construyó, la armamos con los datos actuales
+    db = Database(path)
+    try:
+        if db.get_generation("pppoe_identity") == 0:
+            db.rebuild_pppoe_identity()
+    except sqlite3.Error as e:
+        config.logger.warning(f"[DB] No se pudo construir pppoe_identity: {e}")
+    finally:
+        db.close()
\ No newline at end of file
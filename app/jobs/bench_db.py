@@ -0,0 +1,253 @@
+"""
+Benchmark + regresión de planes de consulta de la base local.
+
+Arma un dataset sintético con el tamaño de producción (100k clientes, 120k conexiones,
+150k secrets en 60 routers, 80k ONUs) en un archivo temporal, mide las consultas del
+camino caliente y verifica con EXPLAIN QUERY PLAN que sigan usando índices.
+
+Uso:
+    python -m app.jobs.bench_db                 # escala completa
+    python -m app.jobs.bench_db --escala 0.1    # dataset al 10% (más rápido)
+
+Sale con código 1 si algún plan hace un SCAN no permitido o si los tipos de las
+columnas de join no coinciden, así se puede correr antes de mergear cambios en sqlite.py.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from app import config
+from app.db.sqlite import COLUMNS, Database, init_db, secret_row, staging
+
+# Tamaños de producción (se multiplican por --escala)
+CLIENTES = 100_000
+CONEXIONES = 120_000
+SECRETS = 150_000
+ROUTERS = 60
+ONUS = 80_000
+PLANES = 40
+
+# Reglas de plan por consulta: SCANs permitidos (tabla/alias) y fragmentos que tienen que aparecer
+REGLAS_PLAN = {
+    "get_diagnosis": {
+        "scans": set(),
+        "requiere": ["SEARCH pppoe_identity USING PRIMARY KEY"],
+    },
+    "get_router_for_pppoe": {
+        "scans": set(),
+        "requiere": ["SEARCH pppoe_identity USING PRIMARY KEY"],
+    },
+    "search_client": {
+        # El índice FTS5 se recorre como tabla virtual; ":M" = resuelto por MATCH.
+        # hits = coincidencias materializadas (<= SEARCH_MAX_HITS); p = página ya cortada;
+        # s = relectura por rowid ("0:=") de las filas de la página
+        "scans": {"search_index", "hits", "p", "s"},
+        "requiere": ["VIRTUAL TABLE INDEX 0:M", "SCAN s VIRTUAL TABLE INDEX 0:="],
+    },
+    "match_connections": {
+        # m = agrupado de connections por PPPoE; subscribers se recorre para desvincular
+        "scans": {"m", "subscribers"},
+        "requiere": ["SEARCH subscribers USING INDEX idx_subscribers_pppoe", "SEARCH connections USING"],
+    },
+}
+
+# Columnas que se cruzan en joins: el tipo declarado tiene que ser el mismo de ambos lados
+JOINS_TIPADOS = [
+    (("connections", "customer_id"), ("clientes", "id")),
+    (("connections", "node_id"), ("nodes", "node_id")),
+    (("connections", "plan_id"), ("plans", "plan_id")),
+    (("subscribers", "node_id"), ("nodes", "node_id")),
+    (("subscribers", "pppoe_username"), ("connections", "pppoe_username")),
+    (("ppp_secrets", "name"), ("connections", "pppoe_username")),
+]
+
+
+# --- DATASET SINTÉTICO ---
+def _pppoe(i):
+    return f"cliente{i:06d}"
+
+def generar_dataset(db, escala=1.0, seed=42):
+    rnd = random.Random(seed)
+    n_clientes = int(CLIENTES * escala)
+    n_conexiones = int(CONEXIONES * escala)
+    n_secrets = int(SECRETS * escala)
+    n_onus = int(ONUS * escala)
+    routers = [f"10.{i // 250}.{i % 250}.1" for i in range(ROUTERS)]
+
+    tablas = ("nodes", "plans", "clientes", "connections", "ppp_secrets", "subscribers")
+    db.begin_staging(*tablas)
+    db.bulk_insert(staging("nodes"), ((i + 1, f"Nodo {i + 1}", ip, "8728") for i, ip in enumerate(routers)))
+    db.bulk_insert(staging("plans"), ((i + 1, f"Plan {i + 1}", f"{(i + 1) * 10}M", None) for i in range(PLANES)))
+
+    columnas_clientes = len(COLUMNS["clientes"])
+    def clientes():
+        for i in range(n_clientes):
+            fila = [None] * columnas_clientes
+            fila[0], fila[2], fila[7] = i + 1, f"Apellido{i % 5000} Nombre{i}", str(20_000_000 + i)
+            yield tuple(fila)
+    db.bulk_insert(staging("clientes"), clientes())
+
+    # Las conexiones extra (más que clientes) son segundas conexiones de clientes existentes
+    db.bulk_insert(staging("connections"), (
+        (str(i + 1), _pppoe(i), (i % n_clientes) + 1, rnd.randrange(ROUTERS) + 1,
+         rnd.randrange(PLANES) + 1, f"Calle {i % 900} {i}")
+        for i in range(n_conexiones)
+    ))
+
+    # Secrets: la mayoría vinculados, el resto solo existe en el Mikrotik
+    db.bulk_insert(staging("ppp_secrets"), (
+        secret_row({
+            "name": _pppoe(i), "password": "x", "profile": "default", "service": "pppoe",
+            "last-caller-id": f"AA:BB:{i >> 16 & 255:02X}:{i >> 8 & 255:02X}:{i & 255:02X}:01",
+            "comment": f"secret {i}" if i >= n_conexiones else "",
+        }, routers[i % ROUTERS])
+        for i in range(n_secrets)
+    ))
+
+    db.bulk_insert(staging("subscribers"), (
+        (f"ext{i}", f"HWTC{i:08X}", f"OLT {i % 8}", str(i % 8), "1", str(i % 16), str(i % 128), "1",
+         _pppoe(rnd.randrange(n_secrets)) if i % 10 else None, "Routing")
+        for i in range(n_onus)
+    ))
+    return db.swap_staging(*tablas)
+
+
+# --- MEDICIÓN ---
+def medir(fn, argumentos, repeticiones):
+    tiempos = []
+    for i in range(repeticiones):
+        t0 = time.perf_counter()
+        fn(*argumentos[i % len(argumentos)])
+        tiempos.append((time.perf_counter() - t0) * 1000)
+    tiempos.sort()
+    return {
+        "n": len(tiempos),
+        "media": statistics.fmean(tiempos),
+        "p50": tiempos[len(tiempos) // 2],
+        "p95": tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.95))],
+    }
+
+def capturar_sql(db, fn, *args):
+    """Ejecuta fn registrando el SQL (con parámetros expandidos) que llega a SQLite."""
+    sentencias = []
+    db.conn.set_trace_callback(sentencias.append)
+    try:
+        fn(*args)
+    finally:
+        db.conn.set_trace_callback(None)
+    return [s for s in sentencias if s.lstrip().upper().startswith(("SELECT", "UPDATE", "WITH"))]
+
+def verificar_plan(db, nombre, sentencias):
+    regla = REGLAS_PLAN[nombre]
+    errores, detalle = [], []
+    for sql in sentencias:
+        plan = [r[3] for r in db.conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+        detalle.extend(plan)
+        for paso in plan:
+            if paso.startswith("SCAN "):
+                tabla = paso.split()[1]
+                if tabla not in regla["scans"]:
+                    errores.append(f"{nombre}: SCAN no permitido -> {paso}")
+    texto = "\n".join(detalle)
+    for fragmento in regla["requiere"]:
+        if fragmento not in texto:
+            errores.append(f"{nombre}: falta '{fragmento}' en el plan")
+    return errores, detalle
+
+def verificar_tipos(db):
+    errores = []
+    def tipo(tabla, columna):
+        for fila in db.conn.execute(f"PRAGMA table_info({tabla})"):
+            if fila[1] == columna:
+                return (fila[2] or "").upper()
+        return None
+    for (t1, c1), (t2, c2) in JOINS_TIPADOS:
+        a, b = tipo(t1, c1), tipo(t2, c2)
+        if a != b:
+            errores.append(f"tipos: {t1}.{c1} ({a}) != {t2}.{c2} ({b})")
+    return errores
+
+
+def run(escala=1.0, repeticiones=2000, path=None):
+    tmpdir = None
+    if path is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix="beholder-bench-")
+        path = os.path.join(tmpdir.name, "bench.db")
+
+    errores = []
+    try:
+        print(f"🔵 [BENCH] Generando dataset (escala {escala}) en {path}...")
+        init_db(path)
+        db = Database(path)
+        t0 = time.perf_counter()
+        filas = generar_dataset(db, escala)
+        print(f"   ↳ Carga: {time.perf_counter() - t0:.2f}s {filas}")
+
+        for paso in ("match_connections", "rebuild_pppoe_identity", "rebuild_search_index"):
+            t0 = time.perf_counter()
+            resultado = getattr(db, paso)()
+            print(f"   ↳ {paso}: {time.perf_counter() - t0:.3f}s ({resultado})")
+
+        lector = Database(path, readonly=True)
+        rnd = random.Random(7)
+        n_secrets = int(SECRETS * escala)
+        usuarios = [(_pppoe(rnd.randrange(n_secrets)),) for _ in range(500)]
+        terminos = [(t,) for t in ("cliente0001", "Apellido12", "Calle 45", "2000012", "AA:BB:00:01", "HWTC0000", "no-existe")]
+
+        def match_forzado():
+            # Sin esto match_connections detecta que no cambió la generación y no hace nada
+            db.set_state("match_connections", None)
+            db.cursor.execute("UPDATE subscribers SET node_id = NULL, connection_id = NULL")
+            return db.match_connections()
+
+        casos = [
+            ("get_diagnosis", lector, lector.get_diagnosis, usuarios, repeticiones),
+            ("get_router_for_pppoe", lector, lector.get_router_for_pppoe, usuarios, repeticiones),
+            ("search_client", lector, lector.search_client, terminos, max(1, repeticiones // 10)),
+            ("match_connections", db, match_forzado, [()], 3),
+        ]
+
+        print("⏱️  [BENCH] Latencias (ms):")
+        for nombre, conn_db, fn, argumentos, n in casos:
+            r = medir(fn, argumentos, n)
+            print(f"   ↳ {nombre:<22} n={r['n']:<5} media={r['media']:.3f} p50={r['p50']:.3f} p95={r['p95']:.3f}")
+
+        print("🔍 [BENCH] Planes de consulta:")
+        for nombre, conn_db, fn, argumentos, _ in casos:
+            if nombre == "match_connections":
+                conn_db.set_state("match_connections", None)
+                fn = conn_db.match_connections
+            sentencias = capturar_sql(conn_db, fn, *argumentos[0])
+            errs, plan = verificar_plan(conn_db, nombre, sentencias)
+            errores.extend(errs)
+            print(f"   {'✅' if not errs else '❌'} {nombre}")
+            for paso in plan:
+                print(f"      {paso}")
+
+        errores.extend(verificar_tipos(db))
+        lector.close()
+        db.close()
+    finally:
+        if tmpdir:
+            tmpdir.cleanup()
+
+    if errores:
+        print("❌ [BENCH] Regresiones detectadas:")
+        for e in errores:
+            print(f"   - {e}")
+            config.logger.error(f"[BENCH] {e}")
+    else:
+        print("✅ [BENCH] Planes y tipos OK.")
+    return errores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark y regresión de planes de la base local")
+    parser.add_argument("--escala", type=float, default=1.0, help="Multiplicador del tamaño del dataset (1.0 = producción)")
+    parser.add_argument("--repeticiones", type=int, default=2000, help="Consultas por medición")
+    parser.add_argument("--db", default=None, help="Archivo donde generar el dataset (por defecto, uno temporal)")
+    args = parser.parse_args()
+    sys.exit(1 if run(args.escala, args.repeticiones, args.db) else 0)
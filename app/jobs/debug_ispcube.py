@@ -1,7 +1,7 @@
 import time
-from app.db.sqlite import Database, init_db
+from app.db.sqlite import Database, init_db, staging
 from app.clients import ispcube
-from app.jobs.sync import mapear_cliente, insertar_contactos_relacionados
+from app.jobs.sync import mapear_cliente, filas_emails, filas_telefonos, CLIENTES_TABLES
 
 def debug_sync_clientes():
     print("🔵 [DEBUG] Iniciando entorno local...")
@@ -24,15 +24,11 @@ def debug_sync_clientes():
             
             # Guardamos para verificar que la DB local quede bien
             print("💾 [DEBUG] Guardando en SQLite local...")
-            db.cursor.execute("DELETE FROM clientes")
-            db.cursor.execute("DELETE FROM clientes_emails")
-            db.cursor.execute("DELETE FROM clientes_telefonos")
-
-            for c in clientes:
-                db.insert_cliente(mapear_cliente(c))
-                insertar_contactos_relacionados(db, c)
-            
-            db.commit()
+            db.begin_staging(*CLIENTES_TABLES)
+            db.bulk_insert(staging("clientes"), (tuple(mapear_cliente(c).values()) for c in clientes))
+            db.bulk_insert(staging("clientes_emails"), filas_emails(clientes))
+            db.bulk_insert(staging("clientes_telefonos"), filas_telefonos(clientes))
+            db.swap_staging(*CLIENTES_TABLES)
             print("✅ [FIN] Datos guardados correctamente.")
         else:
             print(f"⚠️ [WARN] La API respondió OK pero la lista está vacía. Tiempo: {duration:.2f}s")
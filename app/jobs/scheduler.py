@@ -0,0 +1,241 @@
+"""
+Scheduler de etapas del sync (DAG).
+
+Cada etapa corre en su propio thread apenas terminan sus dependencias, así las
+descargas de ISPCube, SmartOLT y Mikrotik se solapan. SQLite se escribe desde un
+único thread (el que llama a ejecutar): las etapas reciben un proxy de Database
+que encola cada operación en ese writer y espera el resultado.
+"""
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import islice
+from app import config
+from app.utils import telemetria
+from app.utils.telemetria import Medicion
+
+
+@dataclass
+class Etapa:
+    nombre: str
+    fn: callable
+    depende: tuple = ()
+    fuente: str = None  # upstream del que baja (para la telemetría); None = etapa local
+
+
+@dataclass
+class ResultadoEtapa:
+    nombre: str
+    inicio: float
+    fin: float
+    error: Exception = None
+    depende: tuple = field(default_factory=tuple)
+    medicion: Medicion = None
+
+    @property
+    def segundos(self) -> float:
+        return self.fin - self.inicio
+
+    @property
+    def resultado(self) -> str:
+        if self.error is not None:
+            return "error"
+        return (self.medicion and self.medicion.resultado) or "ok"
+
+
+class DbWriter:
+    """Ejecuta en el thread dueño de la conexión las operaciones que le piden otros threads."""
+
+    def __init__(self, db):
+        self.db = db
+        self._owner = threading.get_ident()
+        self._cola = queue.Queue()
+
+    def call(self, fn, *args, **kwargs):
+        # El tiempo de escritura se le suma a la etapa que pidió la operación
+        medicion = telemetria.actual()
+        if threading.get_ident() == self._owner:
+            return _medido(medicion, fn, args, kwargs)
+        futuro = Future()
+        self._cola.put((futuro, fn, args, kwargs, medicion))
+        return futuro.result()
+
+    def avisar(self, evento):
+        """Mensajes para el loop principal (ej. etapa terminada) por la misma cola."""
+        self._cola.put((None, evento, (), {}, None))
+
+    def atender(self):
+        """Procesa una operación de la cola; devuelve el evento si lo que llegó fue un aviso."""
+        futuro, fn, args, kwargs, medicion = self._cola.get()
+        if futuro is None:
+            return fn
+        if futuro.set_running_or_notify_cancel():
+            try:
+                futuro.set_result(_medido(medicion, fn, args, kwargs))
+            except BaseException as e:
+                futuro.set_exception(e)
+        return None
+
+
+def _medido(medicion, fn, args, kwargs):
+    t0 = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        if medicion is not None:
+            medicion.sumar(write_segundos=time.perf_counter() - t0)
+
+
+class DbProxy:
+    """Misma interfaz que Database para las etapas, pero cada método corre en el writer."""
+
+    def __init__(self, writer: DbWriter):
+        self._writer = writer
+
+    def __getattr__(self, name):
+        attr = getattr(self._writer.db, name)
+        if not callable(attr):
+            return attr
+        return lambda *args, **kwargs: self._writer.call(attr, *args, **kwargs)
+
+    def bulk_insert(self, table: str, rows, chunk_size: int = None) -> int:
+        # Las filas se arman en el thread de la etapa (puede ser un stream de red) y al
+        # writer solo llegan lotes listos, para no bloquearlo mientras se descarga.
+        chunk_size = chunk_size or config.SYNC_BATCH_SIZE
+        rows = iter(rows)
+        total = 0
+        t0 = time.perf_counter()
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            total += self._writer.call(self._writer.db.insert_rows, table, chunk)
+        elapsed = time.perf_counter() - t0
+        rate = total / elapsed if elapsed > 0 else 0
+        config.logger.info(f"[DB] {table}: {total} filas en {elapsed:.3f}s ({rate:,.0f} filas/s)")
+        telemetria.sumar(filas=total)
+        return total
+
+    def log_sync_status(self, fuente: str, estado: str, detalle: str = ""):
+        # El estado que la etapa deja en sync_status también queda como resultado de su telemetría
+        medicion = telemetria.actual()
+        if medicion is not None:
+            medicion.fuente = medicion.fuente or fuente
+            medicion.reportar(estado, detalle)
+        return self._writer.call(self._writer.db.log_sync_status, fuente, estado, detalle)
+
+
+class _SalidaPorEtapa:
+    """
+    stdout que junta lo que imprime cada etapa y lo vuelca entero al terminar,
+    así las líneas de etapas que corren a la vez no se mezclan.
+    """
+
+    def __init__(self, real):
+        self._real = real
+        self._local = threading.local()
+
+    def capturar(self):
+        self._local.buf = []
+
+    def volcar(self):
+        buf, self._local.buf = getattr(self._local, "buf", None), None
+        if buf:
+            self._real.write("".join(buf))
+            self._real.flush()
+
+    def write(self, s):
+        buf = getattr(self._local, "buf", None)
+        if buf is None:
+            return self._real.write(s)
+        buf.append(s)
+        return len(s)
+
+    def flush(self):
+        if getattr(self._local, "buf", None) is None:
+            self._real.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._real, name)
+
+
+def camino_critico(resultados: dict) -> list:
+    """
+    Cadena de etapas que determinó la duración total: desde la que terminó última,
+    se sigue hacia atrás por la dependencia que terminó más tarde.
+    """
+    if not resultados:
+        return []
+    actual = max(resultados.values(), key=lambda r: r.fin)
+    camino = [actual]
+    while actual.depende:
+        actual = max((resultados[d] for d in actual.depende), key=lambda r: r.fin)
+        camino.append(actual)
+    return list(reversed(camino))
+
+
+def ejecutar(etapas: list, db, max_workers: int = None) -> dict:
+    """
+    Corre las etapas respetando `depende` (orden, no éxito: si una etapa falla, las que
+    dependen de ella corren igual con los datos de la generación anterior, como antes).
+    Devuelve {nombre: ResultadoEtapa}. Debe llamarse desde el thread dueño de `db`.
+    """
+    por_nombre = {e.nombre: e for e in etapas}
+    for e in etapas:
+        faltantes = [d for d in e.depende if d not in por_nombre]
+        if faltantes:
+            raise ValueError(f"Etapa {e.nombre}: dependencias desconocidas {faltantes}")
+
+    writer = DbWriter(db)
+    proxy = DbProxy(writer)
+    salida = _SalidaPorEtapa(sys.stdout)
+    resultados = {}
+    pendientes = dict(por_nombre)
+    en_curso = set()
+    t0 = time.perf_counter()
+
+    def correr(etapa):
+        salida.capturar()
+        medicion = Medicion(etapa.nombre, etapa.fuente)
+        inicio = time.perf_counter()
+        error = None
+        try:
+            with telemetria.usar(medicion):
+                etapa.fn(proxy)
+        except Exception as e:
+            error = e
+            medicion.reportar("error", str(e))
+            print(f"   ❌ Etapa {etapa.nombre}: {e}")
+            config.logger.exception(f"[SYNC] Etapa {etapa.nombre} falló: {e}")
+        finally:
+            salida.volcar()
+            writer.avisar(ResultadoEtapa(etapa.nombre, inicio - t0, time.perf_counter() - t0, error, etapa.depende, medicion))
+
+    sys.stdout = salida
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or config.SYNC_STAGE_WORKERS, thread_name_prefix="sync") as pool:
+            while pendientes or en_curso:
+                listas = [e for e in pendientes.values() if all(d in resultados for d in e.depende)]
+                for etapa in listas:
+                    del pendientes[etapa.nombre]
+                    en_curso.add(etapa.nombre)
+                    pool.submit(correr, etapa)
+                if not en_curso:
+                    raise RuntimeError(f"Dependencias circulares entre {sorted(pendientes)}")
+                evento = writer.atender()
+                if evento is not None:
+                    en_curso.discard(evento.nombre)
+                    resultados[evento.nombre] = evento
+    finally:
+        sys.stdout = salida._real
+    return resultados
+
+
+def reporte(resultados: dict, total: float) -> str:
+    camino = camino_critico(resultados)
+    suma = sum(r.segundos for r in resultados.values())
+    cadena = " → ".join(f"{r.nombre} {r.segundos:.1f}s" for r in camino)
+    return f"{total:.1f}s totales (suma de etapas {suma:.1f}s). Camino crítico: {cadena}"
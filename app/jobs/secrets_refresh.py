@@ -0,0 +1,202 @@
+"""
+Refresco intradía de ppp_secrets, de a un router por vez.
+
+Cada router tiene su propio intervalo: se acorta a la mitad cuando el refresco trajo
+cambios y se alarga cuando no (o cuando no respondió), entre SECRETS_REFRESH_MIN_SEC y
+SECRETS_REFRESH_MAX_SEC, con jitter para que los routers no terminen todos al mismo
+tiempo. Cada refresco reemplaza los secrets de ese router en una transacción y rehace
+identidad y búsqueda solo para los PPPoE que cambiaron; el resto de la base no se toca.
+
+Corre como job aparte (python -m app.jobs.secrets_refresh) o dentro del servicio con
+SECRETS_REFRESH_IN_SERVICE=1 (un solo worker de uvicorn: cada proceso arrancaría el suyo).
+"""
+import random
+import threading
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from app import config
+from app.clients import mikrotik
+from app.db.sqlite import NIGHTLY_LEASE, Database, init_db
+
+
+@dataclass
+class EstadoRouter:
+    ip: str
+    port: int
+    name: str
+    intervalo: float
+    proximo: float  # time.monotonic() del próximo refresco
+    refrescos: int = 0
+    cambios: int = 0
+    errores: int = 0
+    ultimo: str = None
+    ultimo_resultado: str = None
+
+
+def siguiente_intervalo(intervalo: float, cambios: int, error: bool = False) -> float:
+    """Con cambios el router se mira más seguido; sin cambios o sin respuesta, menos."""
+    if error:
+        intervalo *= 2
+    elif cambios:
+        intervalo /= 2
+    else:
+        intervalo *= config.SECRETS_REFRESH_BACKOFF
+    return min(config.SECRETS_REFRESH_MAX_SEC, max(config.SECRETS_REFRESH_MIN_SEC, intervalo))
+
+
+def con_jitter(segundos: float) -> float:
+    jitter = config.SECRETS_REFRESH_JITTER
+    return segundos * random.uniform(1 - jitter, 1 + jitter)
+
+
+class RefrescoSecrets:
+    def __init__(self):
+        self._routers = {}
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._generacion_nodos = None
+        self._snapshot_pendiente = False
+        self._ultimo_snapshot = time.monotonic()
+        self._en_pausa = False
+
+    def _cargar_nodos(self, db):
+        """Relee los nodos solo si el sync publicó una generación nueva; los routers conocidos conservan su intervalo."""
+        generacion = db.get_generation("nodes")
+        if generacion == self._generacion_nodos:
+            return
+        ahora = time.monotonic()
+        nodos = db.get_nodes_for_sync()
+        with self._lock:
+            anteriores = self._routers
+            self._routers = {}
+            for n in nodos:
+                estado = anteriores.get(n["ip"])
+                if estado is None:
+                    # Arranque escalonado: los routers nuevos se reparten en el primer intervalo
+                    estado = EstadoRouter(n["ip"], n["port"], n["name"], config.SECRETS_REFRESH_MIN_SEC,
+                                          ahora + random.uniform(0, config.SECRETS_REFRESH_MIN_SEC))
+                estado.port, estado.name = n["port"], n["name"]
+                self._routers[n["ip"]] = estado
+        self._generacion_nodos = generacion
+        config.logger.info(f"[SECRETS] {len(nodos)} routers en el refresco intradía (generación de nodos {generacion}).")
+
+    def refrescar(self, db, estado: EstadoRouter) -> int:
+        """Baja los secrets del router y los aplica; devuelve la cantidad de cambios (-1 si no respondió)."""
+        t0 = time.perf_counter()
+        secrets = mikrotik.get_all_secrets(estado.ip, estado.port or config.MK_PORT)
+        if not secrets:
+            # get_all_secrets ya logueó el error: se conserva lo que hay de este router
+            cambios, resultado = -1, "sin respuesta"
+        else:
+            previas = db.derived_generations()
+            aplicado = db.replace_router_secrets(estado.ip, secrets)
+            cambios = aplicado["altas"] + aplicado["modificaciones"] + aplicado["bajas"]
+            if aplicado["pppoes"]:
+                db.refresh_derived(aplicado["pppoes"], previas)
+                self._snapshot_pendiente = True
+            resultado = f"{aplicado['altas']} altas, {aplicado['modificaciones']} modificaciones, {aplicado['bajas']} bajas"
+
+        with self._lock:
+            estado.refrescos += 1
+            estado.errores += cambios < 0
+            estado.cambios += max(cambios, 0)
+            estado.intervalo = siguiente_intervalo(estado.intervalo, max(cambios, 0), error=cambios < 0)
+            estado.proximo = time.monotonic() + con_jitter(estado.intervalo)
+            estado.ultimo = datetime.now().isoformat(timespec="seconds")
+            estado.ultimo_resultado = resultado
+        config.logger.info(
+            f"[SECRETS] {estado.name} ({estado.ip}): {resultado} en {time.perf_counter() - t0:.1f}s "
+            f"(próximo en {estado.intervalo:.0f}s)."
+        )
+        return cambios
+
+    def _publicar_snapshot(self, db):
+        # En modo snapshot la API no ve la base viva: se republica, como mucho cada SECRETS_REFRESH_SNAPSHOT_SEC
+        if not (config.DB_SNAPSHOT_MODE and self._snapshot_pendiente):
+            return
+        if time.monotonic() - self._ultimo_snapshot < config.SECRETS_REFRESH_SNAPSHOT_SEC:
+            return
+        from app.jobs.sync import publicar_snapshot
+        publicar_snapshot(db)
+        self._snapshot_pendiente = False
+        self._ultimo_snapshot = time.monotonic()
+
+    def paso(self, db) -> bool:
+        """Espera al router que toca y lo refresca. Devuelve False si se pidió detener."""
+        self._cargar_nodos(db)
+        with self._lock:
+            estado = min(self._routers.values(), key=lambda r: r.proximo, default=None)
+        if estado is None:
+            return not self._detener.wait(config.SECRETS_REFRESH_MIN_SEC)
+        if self._detener.wait(max(0.0, estado.proximo - time.monotonic())):
+            return False
+        if db.get_lease(NIGHTLY_LEASE):
+            # El nightly está recargando secrets: se espera a que termine sin tocar sus tablas
+            if not self._en_pausa:
+                config.logger.info("[SECRETS] nightly_sync en curso: refresco en pausa.")
+                self._en_pausa = True
+            return not self._detener.wait(config.SECRETS_REFRESH_MIN_SEC)
+        self._en_pausa = False
+        try:
+            self.refrescar(db, estado)
+        except Exception as e:
+            # Ej. base ocupada por el nightly: el router vuelve a la cola con su intervalo alargado
+            with self._lock:
+                estado.errores += 1
+                estado.intervalo = siguiente_intervalo(estado.intervalo, 0, error=True)
+                estado.proximo = time.monotonic() + con_jitter(estado.intervalo)
+                estado.ultimo_resultado = f"error: {e}"
+            config.logger.error(f"[SECRETS] Error refrescando {estado.name} ({estado.ip}): {e}")
+        self._publicar_snapshot(db)
+        return True
+
+    def correr(self):
+        db = Database()
+        config.logger.info("[SECRETS] Refresco intradía de secrets iniciado.")
+        try:
+            while self.paso(db):
+                pass
+        finally:
+            db.close()
+            config.logger.info("[SECRETS] Refresco intradía de secrets detenido.")
+
+    def detener(self):
+        self._detener.set()
+
+    def stats(self) -> dict:
+        ahora = time.monotonic()
+        with self._lock:
+            routers = [
+                {**asdict(r), "proximo_en": round(max(0.0, r.proximo - ahora), 1), "intervalo": round(r.intervalo, 1)}
+                for r in sorted(self._routers.values(), key=lambda r: r.proximo)
+            ]
+        for r in routers:
+            del r["proximo"]
+        return {"activo": not self._detener.is_set(), "routers": routers}
+
+
+# ------------------ DENTRO DEL SERVICIO ------------------
+_en_servicio = None
+
+def iniciar_en_servicio():
+    global _en_servicio
+    if _en_servicio is None:
+        _en_servicio = RefrescoSecrets()
+        threading.Thread(target=_en_servicio.correr, name="secrets-refresh", daemon=True).start()
+
+def detener_en_servicio():
+    if _en_servicio is not None:
+        _en_servicio.detener()
+
+def stats() -> dict:
+    return _en_servicio.stats() if _en_servicio is not None else {"activo": False, "routers": []}
+
+
+if __name__ == "__main__":
+    init_db()
+    refresco = RefrescoSecrets()
+    try:
+        refresco.correr()
+    except KeyboardInterrupt:
+        refresco.detener()
@@ -1,78 +1,144 @@
-from app.db.sqlite import Database, init_db
+from app.db.sqlite import COLUMNS, NIGHTLY_LEASE, Database, LeaseTomado, init_db, lease, secret_row, staging
 from app.clients import smartolt, ispcube, mikrotik
 from app import config
 from app.utils.safe_call import safe_call
+from app.jobs import scheduler
+from app.jobs.scheduler import Etapa
+from app.utils import telemetria
+from datetime import datetime, timedelta
+import argparse
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 def sync_nodes(db):
     print("   ↳ Buscando Nodos en ISPCube...", end=" ", flush=True)
     try:
         nodes = ispcube.obtener_nodos()
         if nodes:
-            db.cursor.execute("DELETE FROM nodes")
-            for n in nodes:
-                db.insert_node(n["id"], n["name"], n["ip"], n["puerto"])
+            db.begin_staging("nodes")
+            db.bulk_insert(staging("nodes"), ((a_entero(n["id"]), n["name"], n["ip"], n["puerto"]) for n in nodes))
+            db.swap_staging("nodes")
             config.logger.info(f"[SYNC] {len(nodes)} nodos sincronizados.")
             db.log_sync_status("ispcube", "ok", f"{len(nodes)} nodos sincronizados")
             print(f"✅ ({len(nodes)} encontrados)")
         else:
-            print("⚠️ Lista vacía")
+            db.log_sync_status("ispcube", "sin_datos", "Nodos: lista vacía")
+            print("⚠️ Lista vacía (se mantiene la generación anterior)")
     except Exception as e:
+        db.discard_staging("nodes")
+        db.log_sync_status("ispcube", "error", f"Nodos: {e}")
         print(f"❌ Error: {e}")
         config.logger.error(f"[SYNC] Error Nodos: {e}")
 
+def _harvest_secrets(node):
+    """Corre en el pool: baja los secrets de un router y mide cuánto tardó."""
+    t0 = time.perf_counter()
+    try:
+        secrets = mikrotik.get_all_secrets(node["ip"], node["port"] or config.MK_PORT)
+        return node, secrets, None, time.perf_counter() - t0
+    except Exception as e:
+        return node, None, e, time.perf_counter() - t0
+
 def sync_secrets(db):
     nodes = db.get_nodes_for_sync()
     if not nodes:
+        # Sin nodos no se consulta ningún router: quedan los secrets de la generación anterior
+        # (y se descarta lo que haya dejado una corrida cortada)
+        db.discard_staging("ppp_secrets")
+        db.clear_checkpoints("secrets")
         config.logger.warning("[SYNC] No hay nodos para sync secrets.")
+        db.log_sync_status("mikrotik", "sin_datos", "Secrets: sin nodos para consultar")
+        print("   ↳ ⚠️ Sin nodos para consultar (se mantiene la generación anterior de secrets)")
         return
 
-    db.cursor.execute("DELETE FROM ppp_secrets")
-    print(f"   ↳ Consultando {len(nodes)} Mikrotiks:")
-    total_secrets = 0
-
-    for node in nodes:
-        ip = node["ip"]
-        name = node["name"]
-        port = node["port"] if node["port"] else config.MK_PORT
-        print(f"      > {name} ({ip})...", end=" ", flush=True)
-        
-        try:
-            secrets = mikrotik.get_all_secrets(ip, port)
-            if secrets is not None:
-                for s in secrets:
-                    db.insert_secret(s, ip)
-                count = len(secrets)
-                total_secrets += count
-                print(f"✅ ({count})")
+    # Checkpoint = routers ya guardados en staging ({ip: secrets, o None si se conservaron
+    # los anteriores}): una corrida cortada se retoma sin volver a consultarlos.
+    checkpoint = db.begin_resumable_staging("secrets", "ppp_secrets") or {"routers": {}}
+    hechos = checkpoint["routers"]
+    pendientes = [n for n in nodes if n["ip"] not in hechos]
+    if hechos:
+        print(f"   ↳ Retomando: {len(hechos)} routers ya guardados por la corrida anterior")
+    workers = max(1, min(config.SYNC_MK_WORKERS, len(pendientes)))
+    print(f"   ↳ Consultando {len(pendientes)} Mikrotiks ({workers} en paralelo):")
+    reporte = []
+    t0 = time.perf_counter()
+
+    # Los routers se consultan en paralelo; la escritura en SQLite queda en este thread
+    # y se hace a medida que cada router termina (con su checkpoint, en el mismo commit).
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mk-secrets") as pool:
+        futuros = [pool.submit(_harvest_secrets, node) for node in pendientes]
+        for futuro in as_completed(futuros):
+            node, secrets, error, segundos = futuro.result()
+            ip, name = node["ip"], node["name"]
+            if secrets:
+                hechos[ip] = len(secrets)
+                count = db.stage_with_checkpoint("secrets", checkpoint, {"ppp_secrets": (secret_row(s, ip) for s in secrets)})
+                telemetria.sumar(filas=count)
+                reporte.append((name, ip, "ok", count, segundos))
+                print(f"      > {name} ({ip}) ✅ ({count}) en {segundos:.1f}s")
+            elif error is None:
+                # Router sin respuesta: conservamos sus secrets de la generación anterior
+                hechos[ip] = None
+                kept = db.stage_with_checkpoint("secrets", checkpoint, carry_over=("ppp_secrets", "router_ip = ?", (ip,)))
+                reporte.append((name, ip, "sin respuesta", kept, segundos))
+                print(f"      > {name} ({ip}) ⚠️ Sin respuesta en {segundos:.1f}s (se mantienen {kept})")
             else:
-                print("⚠️ Sin respuesta")
-        except Exception as e:
-            print(f"❌ Error: {e}")
-            config.logger.error(f"[SYNC] Error en router {ip}: {e}")
-    
-    db.commit()
-    config.logger.info(f"[SYNC] {total_secrets} secrets sincronizados.")
+                hechos[ip] = None
+                kept = db.stage_with_checkpoint("secrets", checkpoint, carry_over=("ppp_secrets", "router_ip = ?", (ip,)))
+                reporte.append((name, ip, "error", kept, segundos))
+                print(f"      > {name} ({ip}) ❌ Error: {error} (se mantienen {kept})")
+                config.logger.error(f"[SYNC] Error en router {ip}: {error}")
+
+    duracion = time.perf_counter() - t0
+    for name, ip, estado, filas, segundos in sorted(reporte, key=lambda r: r[4], reverse=True):
+        config.logger.info(f"[SYNC] secrets {name} ({ip}): {estado}, {filas} filas, {segundos:.2f}s")
+    lentos = ", ".join(f"{r[0]} {r[4]:.1f}s" for r in sorted(reporte, key=lambda r: r[4], reverse=True)[:3])
+    print(f"   ↳ {len(pendientes)} routers en {duracion:.1f}s (más lentos: {lentos})")
+
+    total_secrets = sum(n for n in hechos.values() if n is not None)
+    routers_ok = sum(1 for n in hechos.values() if n is not None)
+    if routers_ok == 0:
+        db.discard_staging("ppp_secrets")
+        db.clear_checkpoints("secrets")
+        config.logger.error("[SYNC] Ningún router respondió, se mantiene la generación anterior de secrets.")
+        db.log_sync_status("mikrotik", "error", "Ningún router respondió")
+        print("   ↳ Resumen: ningún router respondió, secrets sin cambios.")
+        return
+
+    db.swap_staging("ppp_secrets")
+    db.clear_checkpoints("secrets")
+    if routers_ok < len(nodes):
+        telemetria.reportar("parcial", f"{len(nodes) - routers_ok} routers sin responder")
+    config.logger.info(f"[SYNC] {total_secrets} secrets sincronizados ({routers_ok}/{len(nodes)} routers) en {duracion:.1f}s.")
+    db.log_sync_status("mikrotik", "ok", f"{total_secrets} secrets de {routers_ok}/{len(nodes)} routers")
     print(f"   ↳ Resumen: {total_secrets} secrets guardados.")
 
 def sync_onus(db):
     print("   ↳ Consultando SmartOLT...", end=" ", flush=True)
     try:
-        onus = smartolt.get_all_onus()
-        if onus:
-            db.cursor.execute("DELETE FROM subscribers")
-            for onu in onus:
-                db.insert_subscriber(
-                    onu.get("unique_external_id"), onu.get("sn"), onu.get("olt_name"), 
-                    onu.get("olt_id"), onu.get("board"), onu.get("port"), onu.get("onu"), 
-                    onu.get("onu_type_id"), onu.get("name"), onu.get("mode")
-                )
-            db.log_sync_status("smartolt", "ok", f"{len(onus)} ONUs sincronizadas")
-            config.logger.info(f"[SYNC] {len(onus)} ONUs sincronizadas.")
-            print(f"✅ ({len(onus)} ONUs)")
+        # Las ONUs se parsean del stream y van directo a staging en lotes de SYNC_BATCH_SIZE
+        db.begin_staging("subscribers")
+        total = db.bulk_insert(staging("subscribers"), (
+            (
+                onu.get("unique_external_id"), onu.get("sn"), onu.get("olt_name"), 
+                onu.get("olt_id"), onu.get("board"), onu.get("port"), onu.get("onu"), 
+                onu.get("onu_type_id"), onu.get("name"), onu.get("mode"),
+            )
+            for onu in smartolt.iterar_onus()
+        ))
+        if total:
+            db.swap_staging("subscribers")
+            db.log_sync_status("smartolt", "ok", f"{total} ONUs sincronizadas")
+            config.logger.info(f"[SYNC] {total} ONUs sincronizadas.")
+            print(f"✅ ({total} ONUs)")
         else:
-            print("⚠️ Sin datos")
+            db.discard_staging("subscribers")
+            db.log_sync_status("smartolt", "sin_datos", "Sin ONUs")
+            print("⚠️ Sin datos (se mantiene la generación anterior)")
     except Exception as e:
+        db.discard_staging("subscribers")
+        db.log_sync_status("smartolt", "error", str(e))
         print(f"❌ Error: {e}")
         config.logger.error(f"[SYNC] Error SmartOLT: {e}")
 
@@ -81,13 +147,20 @@ def sync_plans(db):
     try:
         planes = ispcube.obtener_planes()
         if planes:
-            db.cursor.execute("DELETE FROM plans")
-            for p in planes:
-                db.insert_plan(p["id"], p["name"], p.get("speed"), p.get("comment"))
+            db.begin_staging("plans")
+            db.bulk_insert(staging("plans"), ((a_entero(p["id"]), p["name"], p.get("speed"), p.get("comment")) for p in planes))
+            db.swap_staging("plans")
             config.logger.info(f"[SYNC] {len(planes)} planes sincronizados.")
+            db.log_sync_status("ispcube", "ok", f"{len(planes)} planes sincronizados")
             print(f"✅ ({len(planes)})")
-        else: print("⚠️")
-    except Exception as e: print(f"❌ {e}")
+        else:
+            db.log_sync_status("ispcube", "sin_datos", "Planes: lista vacía")
+            print("⚠️ Vacío (se mantiene la generación anterior)")
+    except Exception as e:
+        db.discard_staging("plans")
+        db.log_sync_status("ispcube", "error", f"Planes: {e}")
+        print(f"❌ {e}")
+        config.logger.error(f"[SYNC] Error Planes: {e}")
 
 def sync_connections(db):
     print("   ↳ [ISPCube] Bajando Conexiones (Lista Completa)...", end=" ", flush=True)
@@ -95,127 +168,366 @@ def sync_connections(db):
         # VOLVEMOS AL MÉTODO CLÁSICO
         conexiones = ispcube.obtener_todas_conexiones()
         if conexiones:
-            db.cursor.execute("DELETE FROM connections")
-            for c in conexiones:
-                if not c.get("id") or not c.get("user"): continue
-                db.insert_connection(
-                    str(c["id"]), str(c["user"]), str(c["customer_id"]), 
-                    str(c["node_id"]), str(c["plan_id"]), c.get("direccion")
+            db.begin_staging("connections")
+            db.bulk_insert(staging("connections"), (
+                (
+                    str(c["id"]), str(c["user"]), a_entero(c["customer_id"]), 
+                    a_entero(c["node_id"]), a_entero(c["plan_id"]), c.get("direccion"),
                 )
+                for c in conexiones
+                if c.get("id") and c.get("user")
+            ))
+            db.swap_staging("connections")
             config.logger.info(f"[SYNC] {len(conexiones)} conexiones sincronizadas.")
             db.log_sync_status("ispcube", "ok", f"{len(conexiones)} conexiones sincronizadas")
             print(f"✅ ({len(conexiones)})")
         else:
-            print("⚠️ Vacío")
+            db.log_sync_status("ispcube", "sin_datos", "Conexiones: lista vacía")
+            print("⚠️ Vacío (se mantiene la generación anterior)")
     except Exception as e:
+        db.discard_staging("connections")
+        db.log_sync_status("ispcube", "error", f"Conexiones: {e}")
         print(f"❌ {e}")
         config.logger.error(f"[SYNC] Error Connections: {e}")
 
+CLIENTES_TABLES = ("clientes", "clientes_emails", "clientes_telefonos")
+# sync_state: última modificación (updated_at/deleted_at) de ISPCube ya aplicada a clientes
+MARCA_CLIENTES = "clientes_watermark"
+
+def _cargar_paginas_clientes(db, paginas) -> tuple:
+    """Escribe las páginas en staging (clientes, emails, teléfonos); devuelve (clientes, marca más nueva)."""
+    total, marca = 0, None
+    for pagina in paginas:
+        total += db.bulk_insert(staging("clientes"), (tuple(mapear_cliente(c).values()) for c in pagina))
+        db.bulk_insert(staging("clientes_emails"), filas_emails(pagina))
+        db.bulk_insert(staging("clientes_telefonos"), filas_telefonos(pagina))
+        marca = _marca_mayor(marca, pagina)
+    return total, marca
+
+def _marca_mayor(marca, pagina):
+    marcas = [m for m in map(ispcube.marca_actualizacion, pagina) if m]
+    return max([marca, *marcas] if marca else marcas) if marcas else marca
+
 def sync_clientes(db):
     print("   ↳ [ISPCube] Bajando Clientes...", end=" ", flush=True)
     try:
-        clientes = ispcube.obtener_clientes()
-        if clientes:
-            db.cursor.execute("DELETE FROM clientes")
-            db.cursor.execute("DELETE FROM clientes_emails")
-            db.cursor.execute("DELETE FROM clientes_telefonos")
-
-            for c in clientes:
-                db.insert_cliente(mapear_cliente(c))
-                insertar_contactos_relacionados(db, c)
-
-            db.commit()
-            config.logger.info(f"[SYNC] {len(clientes)} clientes sincronizados.")
-            db.log_sync_status("ispcube", "ok", f"{len(clientes)} clientes sincronizados")
-            print(f"✅ ({len(clientes)})")
+        # Cada página se escribe apenas llega, junto con su checkpoint: si el proceso se
+        # corta, la próxima corrida retoma sin volver a pedir las páginas ya guardadas.
+        limit = config.ISPCUBE_PAGE_SIZE
+        checkpoint = db.begin_resumable_staging("clientes", *CLIENTES_TABLES)
+        if checkpoint is not None and checkpoint["limit"] != limit:
+            # Cambió el tamaño de página: los offsets guardados no sirven
+            db.clear_checkpoints("clientes")
+            db.begin_staging(*CLIENTES_TABLES, reanudable=True)
+            checkpoint = None
+        if checkpoint is None:
+            checkpoint = {"limit": limit, "paginas": [], "filas": 0, "marca": None}
+        elif checkpoint["paginas"]:
+            print(f"(retomando: {len(checkpoint['paginas'])} páginas, {checkpoint['filas']} clientes ya bajados)", end=" ", flush=True)
+        # customers_list no informa el total: si entre las dos corridas hubo altas o bajas
+        # en ISPCube, los offsets se corrieron y pudo quedar algún cliente sin bajar
+        reanudada = bool(checkpoint["paginas"])
+        marca = datetime.fromisoformat(checkpoint["marca"]) if checkpoint["marca"] else None
+
+        for offset, pagina in ispcube.iterar_paginas_clientes_offset(limit, saltear=checkpoint["paginas"]):
+            marca = _marca_mayor(marca, pagina)
+            checkpoint["paginas"].append(offset)
+            checkpoint["filas"] += len(pagina)
+            checkpoint["marca"] = marca.isoformat() if marca else None
+            db.stage_with_checkpoint("clientes", checkpoint, {
+                "clientes": [tuple(mapear_cliente(c).values()) for c in pagina],
+                "clientes_emails": filas_emails(pagina),
+                "clientes_telefonos": filas_telefonos(pagina),
+            })
+            # Las filas de la etapa son clientes: emails y teléfonos no se cuentan
+            telemetria.sumar(filas=len(pagina))
+        total = checkpoint["filas"]
+
+        if total:
+            # Clientes, emails y teléfonos se publican juntos
+            if reanudada:
+                # Sin bajas: un cliente que faltó no se borra; las bajas quedan para la próxima carga completa
+                alcance = f"l.customer_id IN (SELECT id FROM {staging('clientes')})"
+                db.merge_staging(*CLIENTES_TABLES, bajas={"clientes_emails": alcance, "clientes_telefonos": alcance})
+                config.logger.warning("[SYNC] Clientes retomados de una corrida cortada: se publican sin bajas.")
+            else:
+                db.swap_staging(*CLIENTES_TABLES)
+            db.clear_checkpoints("clientes")
+            if marca:
+                # Punto de partida de los deltas intradía
+                db.set_state(MARCA_CLIENTES, marca.isoformat())
+                db.commit()
+            config.logger.info(f"[SYNC] {total} clientes sincronizados.")
+            db.log_sync_status("ispcube", "ok", f"{total} clientes sincronizados")
+            print(f"✅ ({total})")
         else:
-            print("⚠️ Vacío")
+            db.discard_staging(*CLIENTES_TABLES)
+            db.clear_checkpoints("clientes")
+            db.log_sync_status("ispcube", "sin_datos", "Clientes: lista vacía")
+            print("⚠️ Vacío (se mantiene la generación anterior)")
     except Exception as e:
-        print(f"❌ {e}")
+        db.discard_staging(*CLIENTES_TABLES)
+        db.clear_checkpoints("clientes")
+        db.log_sync_status("ispcube", "error", f"Clientes: {e}")
+        print(f"❌ {e} (se mantiene la generación anterior)")
+        config.logger.error(f"[SYNC] Error Clientes: {e}")
+
+def sync_clientes_delta(db):
+    """
+    Delta intradía de clientes: baja solo los modificados desde la marca de agua (menos
+    ISPCUBE_DELTA_OVERLAP_SEC), los aplica por diferencia sin dar de baja a los que no
+    vinieron y refresca identidad y búsqueda solo para los PPPoE de esos clientes.
+    Sin marca (nunca corrió la carga completa) hace la carga completa.
+    Devuelve True si cambió algo publicado.
+    """
+    if db.get_lease(NIGHTLY_LEASE):
+        # El nightly está cargando clientes: el delta esperaría su staging o pisaría su publicación
+        print("   ↳ [ISPCube] nightly_sync en curso: el delta de clientes se saltea.")
+        config.logger.info("[SYNC] Delta de clientes salteado: nightly_sync en curso.")
+        return False
+    valor = db.get_state(MARCA_CLIENTES)
+    if not valor:
+        print("   ↳ [ISPCube] Sin marca de agua de clientes: se hace la carga completa.")
+        sync_clientes(db)
+        return True
+    marca = datetime.fromisoformat(valor)
+    desde = marca - timedelta(seconds=config.ISPCUBE_DELTA_OVERLAP_SEC)
+    print(f"   ↳ [ISPCube] Bajando clientes modificados desde {desde:%Y-%m-%d %H:%M:%S}...", end=" ", flush=True)
+    try:
+        db.begin_staging(*CLIENTES_TABLES)
+        total, nueva = _cargar_paginas_clientes(db, ispcube.iterar_clientes_modificados(desde))
+        if not total:
+            db.discard_staging(*CLIENTES_TABLES)
+            db.log_sync_status("ispcube", "ok", "Delta de clientes: sin cambios")
+            print("✅ (sin cambios)")
+            return False
+
+        ids = db.get_staged_customer_ids()
+        previas = db.derived_generations()
+        # Emails y teléfonos: se reemplazan solo los de los clientes que vinieron en el delta
+        alcance = f"l.customer_id IN (SELECT id FROM {staging('clientes')})"
+        cambios = db.merge_staging(*CLIENTES_TABLES, bajas={"clientes_emails": alcance, "clientes_telefonos": alcance})
+        derivadas = {"pppoe_identity": 0}
+        hubo_cambios = any(sum(c.values()) for c in cambios.values())
+        if hubo_cambios:
+            # Lo que vuelve igual (ej. por el solape de la marca) no toca las derivadas
+            derivadas = db.refresh_derived(db.get_pppoes_for_customers(ids), previas)
+        db.set_state(MARCA_CLIENTES, max(marca, nueva or marca).isoformat())
+        db.commit()
+
+        c = cambios["clientes"]
+        detalle = f"Delta de clientes: {total} recibidos ({c['altas']} altas, {c['modificaciones']} modificaciones)"
+        config.logger.info(f"[SYNC] {detalle}, {derivadas['pppoe_identity']} identidades refrescadas.")
+        db.log_sync_status("ispcube", "ok", detalle)
+        print(f"✅ ({total} recibidos, {c['altas']} altas, {c['modificaciones']} modificaciones)")
+        return hubo_cambios
+    except Exception as e:
+        db.discard_staging(*CLIENTES_TABLES)
+        db.log_sync_status("ispcube", "error", f"Delta de clientes: {e}")
+        print(f"❌ {e} (la marca de agua no avanza)")
+        config.logger.error(f"[SYNC] Error delta de clientes: {e}")
+        return False
 
 # --- UTILIDADES ---
-def insertar_contactos_relacionados(db, json_cliente: dict):
-    for email_obj in json_cliente.get("contact_emails", []):
-        if email_obj.get("email"):
-            db.insert_cliente_email(json_cliente["id"], email_obj.get("email"))
-    for tel_obj in json_cliente.get("phones", []):
-        if tel_obj.get("number"):
-            db.insert_cliente_telefono(json_cliente["id"], tel_obj.get("number"))
+def a_entero(valor):
+    """Ids de ISPCube -> int (None si vienen vacíos o no numéricos), para que los joins comparen INTEGER con INTEGER."""
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
+
+def filas_emails(clientes):
+    for c in clientes:
+        for email_obj in c.get("contact_emails", []):
+            if email_obj.get("email"):
+                yield (c["id"], email_obj.get("email"))
+
+def filas_telefonos(clientes):
+    for c in clientes:
+        for tel_obj in c.get("phones", []):
+            if tel_obj.get("number"):
+                yield (c["id"], tel_obj.get("number"))
 
 def mapear_cliente(json_cliente: dict) -> dict:
-    return {
-        "id": json_cliente.get("id"),
-        "code": json_cliente.get("code"),
-        "name": json_cliente.get("name"),
-        "tax_residence": json_cliente.get("tax_residence"),
-        "type": json_cliente.get("type"),
-        "tax_situation_id": json_cliente.get("tax_situation_id"),
-        "identification_type_id": json_cliente.get("identification_type_id"),
-        "doc_number": json_cliente.get("doc_number"),
-        "auto_bill_sending": json_cliente.get("auto_bill_sending"),
-        "auto_payment_recipe_sending": json_cliente.get("auto_payment_recipe_sending"),
-        "nickname": json_cliente.get("nickname"),
-        "comercial_activity": json_cliente.get("comercial_activity"),
-        "address": json_cliente.get("address"),
-        "between_address1": json_cliente.get("between_address1"),
-        "between_address2": json_cliente.get("between_address2"),
-        "city_id": json_cliente.get("city_id"),
-        "lat": json_cliente.get("lat"),
-        "lng": json_cliente.get("lng"),
-        "extra1": json_cliente.get("extra1"),
-        "extra2": json_cliente.get("extra2"),
-        "entity_id": json_cliente.get("entity_id"),
-        "collector_id": json_cliente.get("collector_id"),
-        "seller_id": json_cliente.get("seller_id"),
-        "block": json_cliente.get("block"),
-        "free": json_cliente.get("free"),
-        "apply_late_payment_due": json_cliente.get("apply_late_payment_due"),
-        "apply_reconnection": json_cliente.get("apply_reconnection"),
-        "contract": json_cliente.get("contract"),
-        "contract_type_id": json_cliente.get("contract_type_id"),
-        "contract_expiration_date": json_cliente.get("contract_expiration_date"),
-        "paycomm": json_cliente.get("paycomm"),
-        "expiration_type_id": json_cliente.get("expiration_type_id"),
-        "business_id": json_cliente.get("business_id"),
-        "first_expiration_date": json_cliente.get("first_expiration_date"),
-        "second_expiration_date": json_cliente.get("second_expiration_date"),
-        "next_month_corresponding_date": json_cliente.get("next_month_corresponding_date"),
-        "start_date": json_cliente.get("start_date"),
-        "perception_id": json_cliente.get("perception_id"),
-        "phonekey": json_cliente.get("phonekey"),
-        "debt": json_cliente.get("debt"),
-        "duedebt": json_cliente.get("duedebt"),
-        "speed_limited": json_cliente.get("speed_limited"),
-        "status": json_cliente.get("status"),
-        "enable_date": json_cliente.get("enable_date"),
-        "block_date": json_cliente.get("block_date"),
-        "created_at": json_cliente.get("created_at"),
-        "updated_at": json_cliente.get("updated_at"),
-        "deleted_at": json_cliente.get("deleted_at"),
-        "temporary": json_cliente.get("temporary"),
-    }
+    # Mismo orden que COLUMNS["clientes"]: tuple(mapear_cliente(c).values()) sirve para bulk_insert
+    return {col: json_cliente.get(col) for col in COLUMNS["clientes"]}
+
+def sync_match(db):
+    cambios = db.match_connections()
+    telemetria.sumar(filas=cambios)
+    print(f"   ↳ Cruzando datos (Match Connections)... ✅ OK ({cambios} ONUs actualizadas)")
+
+def sync_identidad(db):
+    try:
+        total = db.rebuild_pppoe_identity()
+        telemetria.sumar(filas=total)
+        if total:
+            config.logger.info(f"[SYNC] pppoe_identity reconstruida ({total} usuarios).")
+        print(f"   ↳ Materializando identidad PPPoE... ✅ ({total or 'sin cambios'})")
+    except Exception as e:
+        db.discard_staging("pppoe_identity")
+        telemetria.reportar("error", str(e))
+        print(f"   ↳ Materializando identidad PPPoE... ❌ {e}")
+        config.logger.error(f"[SYNC] Error pppoe_identity: {e}")
+
+def sync_busqueda(db):
+    try:
+        total = db.rebuild_search_index()
+        telemetria.sumar(filas=total)
+        if total:
+            config.logger.info(f"[SYNC] Índice de búsqueda reconstruido ({total} filas).")
+        print(f"   ↳ Reconstruyendo índice de búsqueda... ✅ ({total or 'sin cambios'})")
+    except Exception as e:
+        telemetria.reportar("error", str(e))
+        print(f"   ↳ Reconstruyendo índice de búsqueda... ❌ {e}")
+        config.logger.error(f"[SYNC] Error índice de búsqueda: {e}")
+
+# Dependencias reales entre etapas: lo demás corre en paralelo
+ETAPAS = [
+    Etapa("nodes", sync_nodes, fuente="ispcube"),
+    Etapa("secrets", sync_secrets, ("nodes",), fuente="mikrotik"),
+    Etapa("onus", sync_onus, fuente="smartolt"),
+    Etapa("plans", sync_plans, fuente="ispcube"),
+    Etapa("connections", sync_connections, fuente="ispcube"),
+    Etapa("clientes", sync_clientes, fuente="ispcube"),
+    Etapa("match", sync_match, ("onus", "connections")),
+    Etapa("identidad", sync_identidad, ("match", "nodes", "secrets", "plans", "clientes")),
+    Etapa("busqueda", sync_busqueda, ("onus", "connections", "secrets", "clientes")),
+]
+
+def filas_telemetria(inicio: datetime, resultados: dict) -> list:
+    """ResultadoEtapa -> filas de sync_run_stages (fetch = tiempo de la etapa fuera de SQLite)."""
+    filas = []
+    for r in sorted(resultados.values(), key=lambda r: r.inicio):
+        m = r.medicion
+        filas.append({
+            "etapa": r.nombre,
+            "fuente": m.fuente,
+            "inicio": (inicio + timedelta(seconds=r.inicio)).isoformat(timespec="seconds"),
+            "fin": (inicio + timedelta(seconds=r.fin)).isoformat(timespec="seconds"),
+            "segundos": round(r.segundos, 3),
+            "fetch_segundos": round(max(0.0, r.segundos - m.write_segundos), 3),
+            "write_segundos": round(m.write_segundos, 3),
+            "filas": m.filas,
+            "bytes": m.bytes,
+            "reintentos": m.reintentos,
+            "resultado": r.resultado,
+            "detalle": m.detalle,
+        })
+    return filas
+
+def guardar_telemetria(db, inicio, total, resultados):
+    try:
+        run_id = db.log_sync_run(inicio, total, filas_telemetria(inicio, resultados))
+        config.logger.info(f"[SYNC] Telemetría guardada (corrida {run_id}).")
+    except Exception as e:
+        # La telemetría nunca hace fallar el sync
+        config.logger.error(f"[SYNC] Error guardando telemetría: {e}")
+
+def publicar_snapshot(db):
+    """Publica el snapshot de solo lectura que lee la API en DB_SNAPSHOT_MODE (nunca hace fallar al que lo llama)."""
+    print("   ↳ Publicando snapshot de solo lectura...", end=" ", flush=True)
+    try:
+        destino = db.publish_snapshot()
+        config.logger.info(f"[SYNC] Snapshot publicado: {destino}")
+        print(f"✅ ({os.path.basename(destino)})")
+    except Exception as e:
+        print(f"❌ {e}")
+        config.logger.error(f"[SYNC] Error publicando snapshot: {e}")
+
+def etapas_reanudables(etapas: list, hechas: set) -> list:
+    """
+    Envuelve las etapas para la corrida con checkpoints: las que ya terminaron en la
+    corrida cortada no se repiten (sus datos ya están publicados) y cada una que termina
+    sin error queda registrada en el checkpoint "corrida".
+    """
+    def envolver(etapa):
+        def fn(db):
+            if etapa.nombre in hechas:
+                print(f"   ↳ {etapa.nombre}: ya completada por la corrida anterior, se saltea")
+                telemetria.reportar("ok", "retomada: completada por la corrida anterior")
+                return
+            etapa.fn(db)
+            medicion = telemetria.actual()
+            if medicion is None or medicion.resultado != "error":
+                db.checkpoint_stage_done(etapa.nombre)
+        return Etapa(etapa.nombre, fn, etapa.depende, etapa.fuente)
+    return [envolver(e) for e in etapas]
+
+def _corrida_a_retomar(db, ahora: datetime):
+    """Checkpoint de una corrida cortada todavía fresca (None si no hay o si es más vieja que SYNC_RESUME_MAX_AGE_MIN)."""
+    corrida = db.get_checkpoint("corrida")
+    if corrida is None:
+        return None
+    edad = ahora - datetime.fromisoformat(corrida["inicio"])
+    if edad > timedelta(minutes=config.SYNC_RESUME_MAX_AGE_MIN):
+        config.logger.info(f"[SYNC] Checkpoint de {corrida['inicio']} demasiado viejo, se empieza de cero.")
+        return None
+    return corrida
 
 def nightly_sync():
     init_db()
+    try:
+        with lease(NIGHTLY_LEASE):
+            _nightly_sync()
+    except LeaseTomado as e:
+        # Otro nightly_sync sigue corriendo (o su lease todavía no venció)
+        print(f"\n[SYNC] ⚠️ {e}: no se inicia otra corrida.\n")
+        config.logger.warning(f"[SYNC] nightly_sync no iniciado: {e}")
+
+def _nightly_sync():
     db = Database()
     print("\n[SYNC] 🚀 Iniciando Sincronización...\n")
+    inicio = datetime.now()
+    t0 = time.perf_counter()
     try:
-        sync_nodes(db)
-        sync_secrets(db)
-        sync_onus(db)
-        sync_plans(db)
-        sync_connections(db) # Vuelve a usar el método "todo de una vez"
-        sync_clientes(db)
-        
-        print("\n   ↳ Cruzando datos (Match Connections)...", end=" ", flush=True)
-        db.match_connections()
-        db.commit()
-        print("✅ OK")
-        
-        config.logger.info("[SYNC] Sincronización completa finalizada.")
+        corrida = _corrida_a_retomar(db, inicio)
+        if corrida is None:
+            db.clear_checkpoints()
+            db.set_checkpoint("corrida", {"inicio": inicio.isoformat(timespec="seconds"), "etapas": []})
+        else:
+            print(f"   ↳ Retomando la corrida cortada de {corrida['inicio']} (etapas completas: {', '.join(corrida['etapas']) or 'ninguna'})\n")
+            config.logger.info(f"[SYNC] Retomando corrida de {corrida['inicio']}: {corrida['etapas']}")
+
+        with db.sync_pragmas():
+            resultados = scheduler.ejecutar(etapas_reanudables(ETAPAS, set(corrida["etapas"]) if corrida else set()), db)
+        # Corrida terminada (con o sin errores de etapa): la próxima empieza de cero
+        db.clear_checkpoints()
+        total = time.perf_counter() - t0
+        resumen = scheduler.reporte(resultados, total)
+        print(f"\n   ↳ {resumen}")
+        config.logger.info(f"[SYNC] {resumen}")
+        guardar_telemetria(db, inicio, total, resultados)
+        borrados = db.prune_changelog()
+        if borrados:
+            config.logger.info(f"[SYNC] Changelog: {borrados} cambios viejos eliminados.")
+
+        if config.DB_SNAPSHOT_MODE:
+            # Después del checkpoint de sync_pragmas: el snapshot sale de una base sin WAL pendiente
+            publicar_snapshot(db)
+
+        config.logger.info(f"[SYNC] Sincronización completa finalizada en {time.perf_counter() - t0:.1f}s.")
     finally:
         db.close()
         print("\n[SYNC] ✨ Finalizado.\n")
 
+def delta_clientes():
+    """Corrida suelta del delta de clientes (cron cada 10-15 min), fuera del nightly."""
+    init_db()
+    db = Database()
+    t0 = time.perf_counter()
+    try:
+        if sync_clientes_delta(db) and config.DB_SNAPSHOT_MODE:
+            publicar_snapshot(db)
+        config.logger.info(f"[SYNC] Delta de clientes finalizado en {time.perf_counter() - t0:.1f}s.")
+    finally:
+        db.close()
+
 if __name__ == "__main__":
-    nightly_sync()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Sincronización de Beholder")
+    parser.add_argument("--delta-clientes", action="store_true", help="solo clientes modificados desde la última corrida")
+    args = parser.parse_args()
+    if args.delta_clientes:
+        delta_clientes()
+    else:
+        nightly_sync()
@@ -1,13 +1,19 @@
-from fastapi import FastAPI, Depends, HTTPException, Request
-from fastapi.responses import JSONResponse
+from datetime import datetime, timedelta
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from app import config
 from app.services.diagnostico import consultar_diagnostico
+from app.services.historial_sync import historial_sync
+from app.services import ppp_activos, trafico_vivo
 from app.security import get_api_key
-from app.db.sqlite import Database # Importación necesaria
+from app.db.sqlite import diagnosis_cache, get_read_db, init_db
 from app.config import logger
-from app.clients import mikrotik
+from app.clients import http, mikrotik, mikrotik_async
+from app.clients.mikrotik_async import mikrotik_api
+from app.jobs import secrets_refresh
 from app.oraculo_router import router as oraculo_router
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
 
 app = FastAPI(title="Beholder - Diagnóstico Centralizado")
 
@@ -19,12 +25,24 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
+    # Crea el esquema (y activa WAL) si la base todavía no existe
+    init_db()
+    if config.SECRETS_REFRESH_IN_SERVICE:
+        secrets_refresh.iniciar_en_servicio()
+    if config.PPP_ACTIVE_IN_SERVICE:
+        ppp_activos.iniciar()
     config.logger.info("Servicio Beholder iniciado.")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    secrets_refresh.detener_en_servicio()
+    ppp_activos.detener()
+
 @app.middleware("http")
 async def check_api_key(request: Request, call_next):
     if request.method == "OPTIONS":
@@ -38,10 +56,93 @@ async def check_api_key(request: Request, call_next):
 def health():
     return {"ok": True, "service": "beholder", "status": "running"}
 
+@app.get("/cache/stats")
+def cache_stats():
+    """Hits/misses de la caché de diagnóstico (datos locales del sync)."""
+    return {"diagnosis": diagnosis_cache.stats()}
+
+@app.get("/http/stats")
+def http_stats():
+    """Requests, conexiones abiertas y % de reuso keep-alive por upstream (ISPCube, SmartOLT, Graylog)."""
+    return http.stats()
+
+@app.get("/mikrotik/stats")
+async def mikrotik_stats():
+    """
+    Sesiones RouterOS por router: pool del cliente bloqueante (abiertas, ociosas, logins,
+    reusos), conexiones del cliente asyncio (comandos en vuelo, segundos ociosa) y
+    monitores de tráfico en vivo abiertos (oyentes por usuario) y edad de la foto de
+    /ppp/active de cada router.
+    """
+    return {
+        "pool": mikrotik.stats(),
+        "async": mikrotik_async.stats(),
+        "monitores": trafico_vivo.stats(),
+        "ppp_activos": ppp_activos.stats(),
+    }
+
+@app.get("/sync/runs")
+def sync_runs(limit: int = Query(default=10, ge=1, le=180)):
+    """
+    Últimas corridas del nightly_sync con la telemetría de cada etapa (descarga, escritura,
+    filas, bytes, reintentos, resultado) y tendencias por etapa y por upstream.
+    """
+    try:
+        return historial_sync(limit)
+    except Exception as e:
+        logger.exception("Error leyendo telemetría del sync")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _foto_activa():
+    if not ppp_activos.activo():
+        raise HTTPException(status_code=503, detail="La foto de /ppp/active no corre en este proceso (PPP_ACTIVE_IN_SERVICE=0).")
+
+@app.get("/ppp/active/ip/{address}")
+async def ppp_active_by_ip(address: str):
+    """Quién tiene hoy esa IP, según la foto de /ppp/active de toda la flota."""
+    _foto_activa()
+    entrada = ppp_activos.sesion_de_ip(address)
+    if entrada is None:
+        raise HTTPException(status_code=404, detail=f"Ninguna sesión vigente con la IP {address}.")
+    router_ip, sesion = entrada
+    return {**sesion, "router_ip": router_ip}
+
+@app.get("/ppp/active/{pppoe_user}")
+async def ppp_active_by_user(pppoe_user: str):
+    """Si el usuario está conectado en algún router de la flota (y en cuál), según la foto."""
+    _foto_activa()
+    _, entrada = ppp_activos.sesion_de_usuario(pppoe_user)
+    if entrada is None:
+        raise HTTPException(status_code=404, detail=f"{pppoe_user} no tiene una sesión vigente en la foto.")
+    router_ip, sesion = entrada
+    return {**sesion, "router_ip": router_ip}
+
+@app.get("/secrets/refresh")
+def secrets_refresh_stats():
+    """Estado del refresco intradía de secrets por router (intervalo actual, próximo refresco, cambios)."""
+    return secrets_refresh.stats()
+
+@app.get("/changes")
+def changes_feed(after: int = Query(default=0, ge=0), limit: int = Query(default=1000, ge=1, le=5000)):
+    """
+    Changelog del sync en orden (altas/bajas/modificaciones por tabla). Para seguirlo se pide
+    de nuevo con after = id del último cambio recibido.
+    """
+    return get_read_db().get_changelog(after_id=after, limit=limit)
+
+@app.get("/changes/{pppoe_user}")
+def changes_for_pppoe(pppoe_user: str, hours: int = Query(default=24, ge=1, le=24 * 90), limit: int = Query(default=200, ge=1, le=1000)):
+    """Qué cambió para este PPPoE (conexión, ONU, secrets, cliente, nodo, plan) en las últimas `hours` horas."""
+    try:
+        return get_read_db().get_changes(pppoe_user, datetime.now() - timedelta(hours=hours), limit=limit)
+    except Exception as e:
+        logger.exception(f"Error leyendo changelog de {pppoe_user}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/diagnosis/{pppoe_user}")
-def diagnosis(pppoe_user: str):
+async def diagnosis(pppoe_user: str):
     try:
-        row = consultar_diagnostico(pppoe_user)
+        row = await consultar_diagnostico(pppoe_user)
     except Exception as e:
         logger.exception(f"Error en diagnóstico de {pppoe_user}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -51,34 +152,48 @@ def diagnosis(pppoe_user: str):
 
 # --- NUEVO ENDPOINT DE BÚSQUEDA ---
 @app.get("/search")
-def search_clients(q: str):
+def search_clients(
+    response: Response,
+    q: str,
+    limit: int = Query(default=50, ge=1, le=200),
+    offset: int = Query(default=0, ge=0),
+    cursor: str | None = None,
+):
     """
-    Busca clientes por nombre, dirección o PPPoE (Gestión + OLT).
+    Busca clientes por nombre, DNI, dirección, PPPoE, MAC o SN de ONU (Gestión + Mikrotik + OLT).
+    Primero PPPoE/DNI exactos, después prefijos, después por relevancia; un resultado por PPPoE.
+    Paginación: el header X-Next-Cursor trae el cursor de la página siguiente (se pasa en ?cursor=).
     """
     if not q or len(q) < 3:
         return []
     
-    db = Database()
+    db = get_read_db()
     try:
-        results = db.search_client(q)
+        if cursor or not offset:
+            results, next_cursor = db.search_page(q, limit=limit, cursor=cursor)
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+        else:
+            # Compatibilidad con clientes que todavía paginan por offset
+            results = db.search_client(q, limit=limit, offset=offset)
         return results
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.exception(f"Error buscando cliente: {q}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
 
 @app.get("/")
 def read_root(api_key: str = Depends(get_api_key)):
     return {"status": "ok", "service": "Beholder API"}
 
 @app.get("/live/{pppoe_user}")
-def live_traffic(pppoe_user: str):
+async def live_traffic(pppoe_user: str):
     """
     Obtiene el consumo en tiempo real resolviendo internamente 
     en qué nodo está el cliente.
     """
-    db = Database()
+    db = get_read_db()
     try:
         # 1. Buscamos la IP del router en nuestra DB local
         router_data = db.get_router_for_pppoe(pppoe_user)
@@ -97,25 +212,49 @@ def live_traffic(pppoe_user: str):
             router_port = config.MK_PORT
         
         # 2. Consultamos al Mikrotik
-        trafico = mikrotik.obtener_trafico_en_vivo(router_ip, pppoe_user, int(router_port))
+        trafico = await mikrotik_api("obtener_trafico_en_vivo", router_ip, pppoe_user, int(router_port))
         
-        if "error" in trafico:
-             return {"status": "error", "detail": trafico["error"]}
-             
         # 3. Formateamos respuesta
-        rx_mbps = round(int(trafico["rx"]) / 1000000, 2)
-        tx_mbps = round(int(trafico["tx"]) / 1000000, 2)
-        
-        return {
-            "status": "ok",
-            "router_ip": router_ip, # Dato útil para debug, opcional
-            "download_mbps": rx_mbps,
-            "upload_mbps": tx_mbps,
-            "raw": trafico
-        }
+        return trafico_vivo.formatear(router_ip, trafico)
         
     except Exception as e:
         config.logger.error(f"Fallo endpoint live traffic: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
\ No newline at end of file
+
+@app.get("/live/{pppoe_user}/stream")
+def live_traffic_stream(pppoe_user: str):
+    """
+    Consumo en tiempo real como Server-Sent Events: una muestra (mismo formato que /live)
+    cada LIVE_STREAM_INTERVAL_SEC. Todos los que miran al mismo usuario comparten un
+    único monitor-traffic en el router, que se corta cuando se va el último.
+    Como pide el header x-api-key, desde el navegador se lee con fetch (EventSource no manda headers).
+    """
+    router_data = get_read_db().get_router_for_pppoe(pppoe_user)
+    if not router_data:
+        raise HTTPException(status_code=404, detail="Cliente no vinculado o no encontrado en base de datos local.")
+    router_ip, router_port = router_data
+    return StreamingResponse(
+        trafico_vivo.eventos(pppoe_user, router_ip, int(router_port or config.MK_PORT)),
+        media_type="text/event-stream",
+        # Sin caché ni buffer del proxy: cada muestra tiene que llegar cuando sale
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+class LiveBatch(BaseModel):
+    usuarios: list[str]
+
+@app.post("/live/batch")
+async def live_traffic_batch(pedido: LiveBatch):
+    """
+    Consumo en tiempo real de muchos clientes a la vez (ej. el muro del NOC): un solo
+    monitor-traffic por router con todas sus interfaces, todos los routers en paralelo.
+    Cada usuario trae la misma respuesta que /live/{pppoe_user}.
+    """
+    usuarios = list(dict.fromkeys(u.strip() for u in pedido.usuarios if u and u.strip()))
+    if len(usuarios) > config.LIVE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Máximo {config.LIVE_BATCH_MAX} usuarios por pedido.")
+    try:
+        return await trafico_vivo.consultar_lote(usuarios)
+    except Exception as e:
+        config.logger.error(f"Fallo endpoint live traffic batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
@@ -12,7 +12,8 @@ from fastapi import APIRouter, HTTPException, Query
 from influxdb_client.client.influxdb_client import InfluxDBClient
 from pydantic import BaseModel
 from app import config
-from app.db.sqlite import Database
+from app.clients.http import get_session
+from app.db.sqlite import get_cached_diagnosis
 
 
 router = APIRouter(prefix="/api/v1/oraculo", tags=["oraculo"])
@@ -519,9 +520,8 @@ async def _query_influx_interval_async(
 
 
 def _resolve_pppoe_node_context(usuario_pppoe: str) -> tuple[Optional[str], Optional[str]]:
-    db = Database()
     try:
-        diagnosis = db.get_diagnosis(usuario_pppoe)
+        diagnosis = get_cached_diagnosis(usuario_pppoe)
     except Exception as exc:
         config.logger.warning(
             "[ORACULO][NODO] No se pudo resolver nodo para %s: %s",
@@ -529,8 +529,6 @@ def _resolve_pppoe_node_context(usuario_pppoe: str) -> tuple[Optional[str], Opti
             str(exc)[:180],
         )
         return None, None
-    finally:
-        db.close()
 
     nodo_ip = diagnosis.get("nodo_ip")
     nodo_influx_ip = _resolve_influx_node_ip(str(nodo_ip)) if nodo_ip else None
@@ -805,7 +803,7 @@ def _query_graylog_raw(usuario_pppoe: str, limite: int, range_sec: Optional[int]
     last_exc: Optional[Exception] = None
     for attempt in range(1, attempts + 1):
         try:
-            response = requests.get(
+            response = get_session("graylog").get(
                 endpoint,
                 params=params,
                 auth=(graylog_user, graylog_password),
@@ -930,7 +928,7 @@ def _probe_graylog() -> ProbeResult:
 
     endpoint = f"{graylog_url.rstrip('/')}/api/search/universal/relative"
     try:
-        response = requests.get(
+        response = get_session("graylog").get(
             endpoint,
             params={
                 "query": "*",
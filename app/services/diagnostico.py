@@ -1,13 +1,38 @@
-﻿from app.db.sqlite import Database
-from app.clients import mikrotik, smartolt, ispcube
+﻿import asyncio
+from app.db.sqlite import get_cached_diagnosis, get_read_db
+from app.clients import smartolt, ispcube
+from app.clients.mikrotik_async import mikrotik_api
+from app.services import ppp_activos
 from app.config import logger
 from app import config # Importar config para fallback
 
-def consultar_diagnostico(pppoe_user: str) -> dict:
-    db = Database()
+async def _smartolt(external_id: str) -> dict:
+    # SmartOLT sigue siendo HTTP bloqueante: va en threads, en paralelo entre sí y con el router
+    estado, senales, vlans = await asyncio.gather(
+        asyncio.to_thread(smartolt.get_onu_status, external_id),
+        asyncio.to_thread(smartolt.get_onu_signals, external_id),
+        asyncio.to_thread(smartolt.get_attached_vlans, external_id),
+    )
+    return {"onu_status_smrt": estado, "onu_signal_smrt": senales, "onu_vlan": vlans}
+
+async def _sesion_pppoe(router_ip: str, pppoe_user: str, puerto) -> dict:
+    """
+    Estado PPP del usuario desde la foto de sesiones activas de la flota; si la foto de
+    su router está vencida (o no hay), en vivo con validar_pppoe. Misma respuesta en los dos.
+    """
+    vigente, entrada = ppp_activos.sesion_de_usuario(pppoe_user, router_ip)
+    if not vigente:
+        return await mikrotik_api("validar_pppoe", router_ip, pppoe_user, puerto)
+    if entrada is not None:
+        return {"active": True, **entrada[1]}
+    # Desconectado según la foto: el secret sale de la base (sync + refresco intradía)
+    secret = get_read_db().get_secret(pppoe_user, router_ip)
+    return {"active": False, "secret": secret or {"error": f"Secret {pppoe_user} no encontrado"}}
+
+async def consultar_diagnostico(pppoe_user: str) -> dict:
     try:
-        # Esto ahora busca en ISPCube primero, luego en SmartOLT
-        base = db.get_diagnosis(pppoe_user)
+        # Base local (ISPCube + SmartOLT + Mikrotik ya cruzados), cacheada por generación de sync
+        base = get_cached_diagnosis(pppoe_user)
         if "error" in base:
             return base
 
@@ -20,19 +45,24 @@ def consultar_diagnostico(pppoe_user: str) -> dict:
             logger.warning(f"Sin IP de nodo para {pppoe_user}. Usando MK_HOST por defecto.")
             router_ip = config.MK_HOST
 
+        # Router y SmartOLT se consultan a la vez
+        external_id = base.get("unique_external_id")
+        consultas = []
+
         # Validamos PPPoE (si router_ip es válido)
         if router_ip:
-            pppoe_info = mikrotik.validar_pppoe(router_ip, pppoe_user, base.get("puerto", config.MK_PORT))
-            diagnosis["mikrotik"] = pppoe_info
+            consultas.append(_sesion_pppoe(router_ip, pppoe_user, base.get("puerto") or config.MK_PORT))
         else:
              diagnosis["mikrotik"] = {"active": False, "error": "No Router IP"}
 
         # SmartOLT (Solo si tenemos unique_external_id)
-        external_id = base.get("unique_external_id")
         if external_id:
-            diagnosis["onu_status_smrt"] = smartolt.get_onu_status(external_id)
-            diagnosis["onu_signal_smrt"] = smartolt.get_onu_signals(external_id)
-            diagnosis["onu_vlan"] = smartolt.get_attached_vlans(external_id)
+            consultas.append(_smartolt(external_id))
+        resultados = await asyncio.gather(*consultas)
+        if router_ip:
+            diagnosis["mikrotik"] = resultados.pop(0)
+        if external_id:
+            diagnosis.update(resultados.pop(0))
         else:
              # Caso raro: Cliente en ISPCube pero sin ONU vinculada
              diagnosis["onu_status_smrt"] = {"status": False, "error": "Sin ONU asociada"}
@@ -40,6 +70,4 @@ def consultar_diagnostico(pppoe_user: str) -> dict:
         return diagnosis
     except Exception as e:
         logger.exception(f"Error en diagnóstico de {pppoe_user}. Detalles: {e}")
-        return diagnosis # Retornamos lo que tengamos
-    finally:
-        db.close()
\ No newline at end of file
+        return diagnosis # Retornamos lo que tengamos
\ No newline at end of file
@@ -0,0 +1,80 @@
+import statistics
+from app.db.sqlite import get_read_db
+
+# Métricas de etapa que se siguen como serie entre corridas
+METRICAS = ("segundos", "fetch_segundos", "write_segundos", "filas", "bytes")
+# Métricas que no se miden sino que se calculan a partir de otras (van en la respuesta)
+DERIVADAS = {
+    "fetch_segundos": "derivada: segundos - write_segundos (todo el tiempo de la etapa fuera de SQLite, no solo la descarga)",
+}
+
+
+def _tendencia(serie: list) -> dict:
+    """
+    Serie en orden cronológico -> última, mediana de las anteriores, variación % de la
+    última contra esa mediana y pendiente (cambio por corrida, mínimos cuadrados).
+    """
+    valores = [v for v in serie if v is not None]
+    resumen = {"serie": serie, "ultima": valores[-1] if valores else None}
+    anteriores = valores[:-1]
+    mediana = statistics.median(anteriores) if anteriores else None
+    resumen["mediana_anterior"] = mediana
+    resumen["variacion_pct"] = round((valores[-1] - mediana) / mediana * 100, 1) if mediana else None
+    if len(valores) >= 2:
+        xs = range(len(valores))
+        media_x, media_y = statistics.fmean(xs), statistics.fmean(valores)
+        cov = sum((x - media_x) * (y - media_y) for x, y in zip(xs, valores))
+        var = sum((x - media_x) ** 2 for x in xs)
+        resumen["pendiente"] = round(cov / var, 3)
+    else:
+        resumen["pendiente"] = None
+    return resumen
+
+
+def tendencias(corridas: list) -> dict:
+    """
+    Series por etapa (todas las métricas) y por upstream (fetch_segundos sumados de sus
+    etapas), de la corrida más vieja a la más nueva. Una etapa que no corrió en una
+    corrida aparece como None en su serie.
+    """
+    cronologicas = list(reversed(corridas))
+    nombres = []
+    for c in cronologicas:
+        for e in c["etapas"]:
+            if e["etapa"] not in nombres:
+                nombres.append(e["etapa"])
+
+    por_etapa = {}
+    for nombre in nombres:
+        filas = [next((e for e in c["etapas"] if e["etapa"] == nombre), None) for c in cronologicas]
+        fuente = next((f["fuente"] for f in reversed(filas) if f and f["fuente"]), None)
+        por_etapa[nombre] = {
+            "fuente": fuente,
+            "resultados": [f["resultado"] if f else None for f in filas],
+            **{m: _tendencia([f[m] if f else None for f in filas]) for m in METRICAS},
+        }
+
+    fuentes = sorted({e["fuente"] for c in cronologicas for e in c["etapas"] if e["fuente"]})
+    por_fuente = {}
+    for fuente in fuentes:
+        serie = []
+        for c in cronologicas:
+            tiempos = [e["fetch_segundos"] for e in c["etapas"] if e["fuente"] == fuente and e["fetch_segundos"] is not None]
+            serie.append(round(sum(tiempos), 3) if tiempos else None)
+        por_fuente[fuente] = _tendencia(serie)
+
+    # Upstream que más empeoró en la última corrida respecto de su mediana
+    variaciones = [(t["variacion_pct"], f) for f, t in por_fuente.items() if t["variacion_pct"] is not None]
+    return {
+        "corridas": [c["id"] for c in cronologicas],
+        "segundos_totales": _tendencia([c["segundos"] for c in cronologicas]),
+        "metricas_derivadas": DERIVADAS,
+        "por_fuente": por_fuente,
+        "por_etapa": por_etapa,
+        "mas_demorada": max(variaciones)[1] if variaciones else None,
+    }
+
+
+def historial_sync(limit: int = 10) -> dict:
+    corridas = get_read_db().get_sync_runs(limit)
+    return {"corridas": corridas, "tendencias": tendencias(corridas)}
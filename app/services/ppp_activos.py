@@ -0,0 +1,142 @@
+"""
+Foto de las sesiones PPP activas de toda la flota, en memoria.
+
+Cada PPP_ACTIVE_POLL_SEC se baja /ppp/active de todos los nodos (en paralelo) y se
+indexa por usuario y por dirección IP: "¿está conectado en algún lado?" y "¿quién tiene
+esta IP?" se contestan sin preguntarle a ningún router. La foto de cada router vale
+PPP_ACTIVE_STALE_SEC; pasado eso (o si el router no respondió) quien la lee tiene que
+ir al router en vivo.
+
+Corre como tarea del event loop del servicio solo con PPP_ACTIVE_IN_SERVICE=1 (un solo
+worker de uvicorn: cada proceso arrancaría su poller contra toda la flota y tendría su
+propia foto). Apagada, nadie encuentra la foto vigente y todo va al router en vivo.
+"""
+import asyncio
+import time
+from app import config
+from app.config import logger
+from app.db.sqlite import get_read_db
+from app.clients.mikrotik_async import mikrotik_api
+
+# Cada entrada: (router_ip, sesión tal como la devuelve el router en validar_pppoe)
+_por_usuario = {}   # usuario (minúsculas) -> entrada
+_por_ip = {}        # address -> entrada
+_routers = {}       # router_ip -> {"nombre", "actualizado" (monotonic), "sesiones", "error"}
+_claves = {}        # router_ip -> (usuarios, ips) que aportó en su última foto
+_tarea = None
+
+
+def _clave(usuario: str) -> str:
+    return (usuario or "").strip().lower()
+
+def _reemplazar(router_ip: str, sesiones: list):
+    """Saca del índice las sesiones anteriores de este router y pone las nuevas."""
+    usuarios, ips = _claves.pop(router_ip, ((), ()))
+    for indice, claves in ((_por_usuario, usuarios), (_por_ip, ips)):
+        for clave in claves:
+            # Si el usuario ya apareció en otro router, esa entrada es la buena
+            if indice.get(clave, (None,))[0] == router_ip:
+                del indice[clave]
+    usuarios, ips = [], []
+    for fila in sesiones:
+        entrada = (router_ip, fila)
+        if fila.get("name"):
+            usuarios.append(_clave(fila["name"]))
+            _por_usuario[usuarios[-1]] = entrada
+        if fila.get("address"):
+            ips.append(fila["address"])
+            _por_ip[fila["address"]] = entrada
+    _claves[router_ip] = (usuarios, ips)
+
+def _fresco(router_ip: str) -> bool:
+    estado = _routers.get(router_ip)
+    return bool(estado and estado["actualizado"] is not None
+                and time.monotonic() - estado["actualizado"] <= config.PPP_ACTIVE_STALE_SEC)
+
+async def _refrescar_router(nodo: dict):
+    ip = nodo["ip"]
+    sesiones = await mikrotik_api("get_ppp_active", ip, nodo["port"] or config.MK_PORT)
+    estado = _routers.setdefault(ip, {"nombre": nodo["name"], "actualizado": None, "sesiones": 0, "error": None})
+    estado["nombre"] = nodo["name"]
+    if sesiones is None:
+        # Se conservan las sesiones anteriores hasta que venzan; el error queda a la vista
+        estado["error"] = "sin respuesta"
+        return
+    _reemplazar(ip, sesiones)
+    estado.update(actualizado=time.monotonic(), sesiones=len(sesiones), error=None)
+
+async def refrescar():
+    """Una vuelta completa: todos los nodos en paralelo."""
+    t0 = time.perf_counter()
+    nodos = await asyncio.to_thread(lambda: get_read_db().get_nodes_for_sync())
+    await asyncio.gather(*(_refrescar_router(n) for n in nodos))
+    # Nodos que ya no están en la base: fuera del índice
+    vigentes = {n["ip"] for n in nodos}
+    for ip in [ip for ip in _routers if ip not in vigentes]:
+        _reemplazar(ip, [])
+        del _routers[ip]
+    errores = sum(1 for n in nodos if _routers[n["ip"]]["error"])
+    logger.info(
+        f"[PPP] {len(_por_usuario)} sesiones activas en {len(nodos)} routers "
+        f"({errores} sin respuesta) en {time.perf_counter() - t0:.1f}s."
+    )
+
+async def _correr():
+    while True:
+        try:
+            await refrescar()
+        except Exception as e:
+            logger.error(f"[PPP] Error refrescando sesiones activas: {e}")
+        await asyncio.sleep(config.PPP_ACTIVE_POLL_SEC)
+
+
+def iniciar():
+    """Arranca el poller en el event loop del servicio (PPP_ACTIVE_POLL_SEC=0 lo desactiva)."""
+    global _tarea
+    if config.PPP_ACTIVE_POLL_SEC > 0 and _tarea is None:
+        _tarea = asyncio.create_task(_correr(), name="ppp-activos")
+
+def activo() -> bool:
+    return _tarea is not None
+
+def detener():
+    global _tarea
+    if _tarea is not None:
+        _tarea.cancel()
+        _tarea = None
+
+
+def sesion_de_usuario(pppoe_user: str, router_ip: str = None):
+    """
+    (vigente, (router_ip, sesión) o None) según la foto. vigente=False si no se puede
+    confiar en ella: la foto de router_ip (el router donde debería estar) venció, o nunca
+    llegó. Una sesión vigente en cualquier router de la flota cuenta aunque no sea router_ip.
+    """
+    entrada = _por_usuario.get(_clave(pppoe_user))
+    if entrada is not None and _fresco(entrada[0]):
+        return True, entrada
+    if router_ip is not None and _fresco(router_ip):
+        return True, None
+    return False, None
+
+def sesion_de_ip(address: str):
+    """(router_ip, sesión) que tiene hoy esa IP (None si no está o si la foto de su router venció)."""
+    entrada = _por_ip.get(address.strip())
+    return entrada if entrada is not None and _fresco(entrada[0]) else None
+
+def stats() -> dict:
+    ahora = time.monotonic()
+    return {
+        "activo": activo(),
+        "sesiones": len(_por_usuario),
+        "routers": {
+            ip: {
+                "nombre": r["nombre"],
+                "sesiones": r["sesiones"],
+                "edad_seg": round(ahora - r["actualizado"], 1) if r["actualizado"] is not None else None,
+                "vigente": _fresco(ip),
+                "error": r["error"],
+            }
+            for ip, r in _routers.items()
+        },
+    }
@@ -0,0 +1,165 @@
+import asyncio
+import contextlib
+import json
+from app import config
+from app.config import logger
+from app.clients import mikrotik_async
+from app.clients.mikrotik_async import mikrotik_api
+from app.db.sqlite import get_read_db
+
+def formatear(router_ip: str, trafico: dict) -> dict:
+    """Respuesta de /live: bits por segundo del router -> Mbps (o el error tal cual)."""
+    if "error" in trafico:
+        return {"status": "error", "detail": trafico["error"]}
+    return {
+        "status": "ok",
+        "router_ip": router_ip, # Dato útil para debug, opcional
+        "download_mbps": round(int(trafico["rx"]) / 1000000, 2),
+        "upload_mbps": round(int(trafico["tx"]) / 1000000, 2),
+        "raw": trafico
+    }
+
+async def consultar_lote(usuarios: list) -> dict:
+    """
+    Tráfico en vivo de muchos PPPoE: los routers se resuelven en una sola consulta a la
+    base, cada router recibe un único monitor-traffic con todas sus interfaces y los
+    routers se consultan en paralelo. Un router caído solo afecta a sus usuarios.
+    """
+    routers = get_read_db().get_routers_for_pppoes(usuarios)
+    grupos = {}
+    for usuario in usuarios:
+        if usuario in routers:
+            router_ip, router_port = routers[usuario]
+            # Usamos puerto default si la DB lo tiene null/vacío
+            grupos.setdefault((router_ip, int(router_port or config.MK_PORT)), []).append(usuario)
+
+    respuestas = await asyncio.gather(*(
+        mikrotik_api("obtener_trafico_varios", router_ip, grupo, router_port)
+        for (router_ip, router_port), grupo in grupos.items()
+    ))
+
+    resultados = {
+        usuario: {"status": "error", "detail": "Cliente no vinculado o no encontrado en base de datos local."}
+        for usuario in usuarios if usuario not in routers
+    }
+    for (router_ip, _), trafico in zip(grupos, respuestas):
+        for usuario, datos in trafico.items():
+            resultados[usuario] = formatear(router_ip, datos)
+    return {
+        "routers": len(grupos),
+        "resultados": {usuario: resultados[usuario] for usuario in usuarios},
+    }
+
+
+# ------------------ STREAMING ------------------
+# Segundos sin muestras tras los que se manda un comentario SSE (mantiene viva la conexión)
+KEEPALIVE_SEC = 15
+
+class _Monitor:
+    """
+    Un monitor-traffic continuo por usuario y router, compartido por todos los que lo
+    están mirando: cada muestra se reparte a la cola de cada oyente. Cuando se va el
+    último oyente, la tarea se cancela y el monitor se corta en el router.
+    """
+    def __init__(self, usuario, router_ip, router_port):
+        self.usuario = usuario
+        self.router_ip = router_ip
+        self.router_port = router_port
+        self.oyentes = set()
+        self.ultima = None
+        self.tarea = asyncio.create_task(self._correr(), name=f"live-{usuario}")
+
+    def _publicar(self, muestra: dict):
+        self.ultima = muestra
+        for cola in self.oyentes:
+            # Un oyente lento recibe la muestra más nueva, no una fila de viejas
+            if cola.full():
+                cola.get_nowait()
+            cola.put_nowait(muestra)
+
+    async def _muestras(self):
+        if config.MK_API_ASYNC:
+            async with contextlib.aclosing(mikrotik_async.monitorear_trafico(
+                self.router_ip, self.usuario, self.router_port, config.LIVE_STREAM_INTERVAL_SEC
+            )) as muestras:
+                async for trafico in muestras:
+                    yield trafico
+        else:
+            # Cliente bloqueante: no hay comando continuo, se consulta con once cada intervalo
+            while True:
+                trafico = await mikrotik_api("obtener_trafico_en_vivo", self.router_ip, self.usuario, self.router_port)
+                if "error" in trafico:
+                    raise RuntimeError(trafico["error"])
+                yield trafico
+                await asyncio.sleep(config.LIVE_STREAM_INTERVAL_SEC)
+
+    async def _correr(self):
+        logger.info(f"[LIVE] Monitor de {self.usuario} abierto en {self.router_ip}.")
+        try:
+            while True:
+                try:
+                    async for trafico in self._muestras():
+                        self._publicar(formatear(self.router_ip, trafico))
+                    error = "El router cortó el monitor"
+                except Exception as e:
+                    # Cualquier falla (router, conexión o una respuesta rara) se reintenta:
+                    # la tarea solo termina cuando se va el último oyente
+                    error = str(e) or type(e).__name__
+                # Ej. el usuario se desconectó y su interfaz no existe: se avisa y se reintenta
+                logger.warning(f"[LIVE] Monitor de {self.usuario} en {self.router_ip}: {error}")
+                self._publicar({"status": "error", "detail": error})
+                await asyncio.sleep(config.LIVE_STREAM_RETRY_SEC)
+        finally:
+            logger.info(f"[LIVE] Monitor de {self.usuario} cerrado.")
+
+
+_monitores = {}
+
+def _clave(usuario: str, router_ip: str, router_port: int) -> tuple:
+    # Con el router en la clave: si el usuario pasa a otro router, los nuevos oyentes
+    # abren un monitor allá y el viejo se cierra cuando se van los suyos
+    return usuario.strip().lower(), router_ip, router_port
+
+def _suscribir(usuario: str, router_ip: str, router_port: int) -> asyncio.Queue:
+    clave = _clave(usuario, router_ip, router_port)
+    monitor = _monitores.get(clave)
+    if monitor is None or monitor.tarea.done():
+        monitor = _monitores[clave] = _Monitor(usuario, router_ip, router_port)
+    cola = asyncio.Queue(maxsize=1)
+    if monitor.ultima is not None:
+        cola.put_nowait(monitor.ultima)
+    monitor.oyentes.add(cola)
+    return cola
+
+def _desuscribir(usuario: str, router_ip: str, router_port: int, cola: asyncio.Queue):
+    clave = _clave(usuario, router_ip, router_port)
+    monitor = _monitores.get(clave)
+    if monitor is None:
+        return
+    monitor.oyentes.discard(cola)
+    if not monitor.oyentes:
+        monitor.tarea.cancel()
+        del _monitores[clave]
+
+async def eventos(usuario: str, router_ip: str, router_port: int):
+    """
+    Server-Sent Events con el tráfico del usuario (mismo formato que /live). Al
+    desconectarse el cliente, Starlette cancela este generador y se libera su lugar.
+    """
+    cola = _suscribir(usuario, router_ip, router_port)
+    try:
+        while True:
+            try:
+                muestra = await asyncio.wait_for(cola.get(), KEEPALIVE_SEC)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield f"data: {json.dumps(muestra)}\n\n"
+    finally:
+        _desuscribir(usuario, router_ip, router_port, cola)
+
+def stats() -> dict:
+    return {
+        f"{m.usuario}@{m.router_ip}:{m.router_port}": {"oyentes": len(m.oyentes)}
+        for m in _monitores.values()
+    }
@@ -0,0 +1,100 @@
+import codecs
+import json
+
+_WS = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+class _Buffer:
+    """Texto decodificado del stream, con relleno a demanda y recorte de lo ya consumido."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """Agrega el próximo chunk; False si el stream terminó."""
+        if self.eof:
+            return False
+        # Lo ya consumido se descarta para que el buffer no crezca con el documento
+        if self.pos:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        for chunk in self._chunks:
+            if chunk:
+                self.text += self._utf8.decode(chunk)
+                return True
+        self.text += self._utf8.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def peek(self) -> str:
+        """Próximo carácter significativo (salteando espacios), '' al final del stream."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WS:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"JSON inválido: se esperaba '{char}' y llegó '{found or 'EOF'}'")
+        self.pos += 1
+
+    def value(self):
+        """Decodifica un valor completo; si el buffer lo corta a la mitad, pide más datos."""
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.text, self.pos)
+                # Un número al final del buffer puede seguir en el próximo chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_json_array(chunks, key: str, meta: dict = None):
+    """
+    Recorre un objeto JSON que llega en chunks (bytes) y va devolviendo, uno por uno,
+    los elementos del array `key` del nivel superior, sin cargar el documento entero.
+    Los demás campos del nivel superior (ej. "status") se guardan en `meta` si se pasa.
+    """
+    buf = _Buffer(chunks)
+    meta = {} if meta is None else meta
+    buf.expect("{")
+    if buf.peek() == "}":
+        return
+    while True:
+        clave = buf.value()
+        buf.expect(":")
+        if clave == key and buf.peek() == "[":
+            buf.pos += 1
+            if buf.peek() == "]":
+                buf.pos += 1
+            else:
+                while True:
+                    yield buf.value()
+                    sep = buf.peek()
+                    buf.pos += 1
+                    if sep == "]":
+                        break
+                    if sep != ",":
+                        raise ValueError(f"JSON inválido dentro de '{key}': '{sep or 'EOF'}'")
+        else:
+            meta[clave] = buf.value()
+        sep = buf.peek()
+        buf.pos += 1
+        if sep == "}":
+            return
+        if sep != ",":
+            raise ValueError(f"JSON inválido: '{sep or 'EOF'}'")
@@ -0,0 +1,69 @@
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+# Gravedad de los resultados: una etapa queda con el peor que se haya reportado
+_GRAVEDAD = {"ok": 0, "sin_datos": 1, "parcial": 2, "error": 3}
+
+_local = threading.local()
+
+
+@dataclass
+class Medicion:
+    """
+    Métricas de una etapa del sync. Los clientes HTTP y el proxy de la base suman acá
+    lo que hacen mientras corren dentro de la etapa (ver `usar`).
+    bytes queda en None si el upstream no lo expone (ej. API de RouterOS).
+    """
+    etapa: str
+    fuente: str = None
+    filas: int = 0
+    bytes: int = None
+    reintentos: int = 0
+    write_segundos: float = 0.0
+    resultado: str = None
+    detalle: str = None
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def sumar(self, filas=0, bytes=None, reintentos=0, write_segundos=0.0):
+        with self._lock:
+            self.filas += filas
+            self.reintentos += reintentos
+            self.write_segundos += write_segundos
+            if bytes is not None:
+                self.bytes = (self.bytes or 0) + bytes
+
+    def reportar(self, estado: str, detalle: str = None):
+        """Resultado informado por la etapa (log_sync_status); gana el más grave."""
+        with self._lock:
+            if self.resultado is None or _GRAVEDAD.get(estado, 0) >= _GRAVEDAD.get(self.resultado, 0):
+                self.resultado = estado
+                self.detalle = detalle
+
+
+def actual() -> Medicion:
+    """Medición de la etapa que corre en este thread (None fuera del sync)."""
+    return getattr(_local, "medicion", None)
+
+
+@contextmanager
+def usar(medicion: Medicion):
+    """Asocia la medición al thread actual (también sirve para los workers de una etapa)."""
+    anterior = actual()
+    _local.medicion = medicion
+    try:
+        yield medicion
+    finally:
+        _local.medicion = anterior
+
+
+def sumar(**valores):
+    medicion = actual()
+    if medicion is not None:
+        medicion.sumar(**valores)
+
+
+def reportar(estado: str, detalle: str = None):
+    medicion = actual()
+    if medicion is not None:
+        medicion.reportar(estado, detalle)